@@ -31,16 +31,34 @@ _add_path(_parent)
 _add_path(_hooks)
 
 
-from charmhelpers.core.hookenv import action_fail
+import json
+
+from collections import OrderedDict
+
+from charmhelpers.contrib.openstack.utils import openstack_upgrade_available
+
+from charmhelpers.core.hookenv import (
+    action_fail,
+    action_get,
+    action_set,
+    is_leader,
+    leader_get,
+)
 
 sys.path.append('hooks/')
 
 from heat_utils import (
     pause_unit_helper,
+    prepare_upgrade,
+    resume_upgrade,
     resume_unit_helper,
+    UPGRADE_ORIGIN_KEY,
+    UPGRADE_PAUSED_KEY,
     register_configs,
 )
 
+from heat_profile import last_profiles
+
 
 def pause(args):
     """Pause all the Glance services.
@@ -58,9 +76,46 @@ def resume(args):
     resume_unit_helper(register_configs())
 
 
+def hook_profiles(args):
+    """Return the most recently recorded hook profiles, newest first."""
+    profiles = last_profiles(int(action_get('count')))
+    action_set({'profiles': json.dumps(profiles, indent=2)})
+
+
+def prepare_upgrade_action(args):
+    """Download the packages of the upgrade to openstack-origin.
+
+    @raises Exception if the packages can't all be downloaded
+    """
+    if not openstack_upgrade_available('heat-common'):
+        action_set({'outcome': 'no upgrade available'})
+        return
+    timings = OrderedDict()
+    prepare_upgrade(timings)
+    action_set({'outcome': 'packages downloaded'})
+    action_set({'timings.{}'.format(k): v for k, v in timings.items()})
+
+
+def resume_upgrade_action(args):
+    """Resume a paused canary upgrade.
+
+    @raises Exception if not run on the leader
+    """
+    if not is_leader():
+        raise Exception('resume-upgrade must be run on the leader')
+    if not leader_get(UPGRADE_PAUSED_KEY):
+        action_set({'outcome': 'no paused upgrade'})
+        return
+    resume_upgrade()
+    action_set({'outcome': 'resumed upgrade to {}'
+                .format(leader_get(UPGRADE_ORIGIN_KEY))})
+
+
 # A dictionary of all the defined actions to callables (which take
 # parsed arguments).
-ACTIONS = {"pause": pause, "resume": resume}
+ACTIONS = {"pause": pause, "resume": resume, "hook-profiles": hook_profiles,
+           "prepare-upgrade": prepare_upgrade_action,
+           "resume-upgrade": resume_upgrade_action}
 
 
 def main(args):
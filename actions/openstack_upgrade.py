@@ -14,8 +14,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import os
 import sys
+import time
+
+from collections import OrderedDict
 
 _path = os.path.dirname(os.path.realpath(__file__))
 _root = os.path.abspath(os.path.join(_path, '..'))
@@ -32,6 +36,8 @@ from charmhelpers.contrib.openstack.utils import (
     do_action_openstack_upgrade,
 )
 
+from charmhelpers.core.hookenv import action_set
+
 from heat_relations import (
     config_changed,
     CONFIGS,
@@ -51,12 +57,19 @@ def openstack_upgrade():
     If the charm was installed from source we cannot upgrade it.
     For backwards compatibility a config flag (action-managed-upgrade) must
     be set for this code to run, otherwise a full service level upgrade will
-    fire on config-changed."""
+    fire on config-changed.
+
+    The time spent in each phase of the upgrade is reported as timings."""
 
+    timings = OrderedDict()
     if (do_action_openstack_upgrade('heat-common',
-                                    do_openstack_upgrade,
+                                    functools.partial(do_openstack_upgrade,
+                                                      timings=timings),
                                     CONFIGS)):
+        start = time.time()
         config_changed()
+        timings['config-changed'] = round(time.time() - start, 3)
+        action_set({'timings.{}'.format(k): v for k, v in timings.items()})
 
 
 if __name__ == '__main__':
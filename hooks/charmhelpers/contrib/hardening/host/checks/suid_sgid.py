@@ -12,10 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import stat
 import subprocess
+import time
 
+from charmhelpers.core import unitdata
 from charmhelpers.core.hookenv import (
     log,
+    DEBUG,
     INFO,
 )
 from charmhelpers.contrib.hardening.audits.file import NoSUIDSGIDAudit
@@ -42,6 +47,30 @@ BLACKLIST = ['/usr/bin/rcp', '/usr/bin/rlogin', '/usr/bin/rsh',
              '/usr/lib/eject/dmcrypt-get-device',
              '/usr/lib/mc/cons.saver']
 
+# Paths that are never descended into.
+PRUNE_PATHS = ['/proc']
+
+# Pseudo and container filesystems whose mount points (from /proc/mounts)
+# are not descended into either.
+PRUNE_FSTYPES = ['proc', 'sysfs', 'cgroup', 'cgroup2', 'debugfs',
+                 'securityfs', 'tracefs', 'devtmpfs', 'devpts', 'pstore',
+                 'bpf', 'configfs', 'fusectl', 'mqueue', 'hugetlbfs',
+                 'binfmt_misc', 'nsfs', 'efivarfs', 'overlay', 'fuse.lxcfs']
+PROC_MOUNTS = '/proc/mounts'
+
+# Trees whose content only changes with the packages installed.  One is
+# skipped, its previous results re-checked file by file, while its mtime
+# and DPKG_STAMPS are unchanged since the last scan; all are rescanned at
+# least every FULL_SCAN_INTERVAL seconds, as a chmod of a file changes
+# neither.
+PACKAGE_TREES = ['/bin', '/sbin', '/lib', '/lib32', '/lib64', '/libx32',
+                 '/usr/bin', '/usr/sbin', '/usr/lib', '/usr/lib32',
+                 '/usr/lib64', '/usr/libx32', '/usr/libexec', '/usr/share']
+DPKG_STAMPS = ['/var/lib/dpkg/status', '/var/lib/dpkg/statoverride']
+FULL_SCAN_INTERVAL = 24 * 60 * 60
+# unitdata key of the state of the last scan.
+SCAN_STATE_KEY = 'hardening:suid-sgid-scan'
+
 WHITELIST = ['/bin/mount', '/bin/ping', '/bin/su', '/bin/umount',
              '/sbin/pam_timestamp_check', '/sbin/unix_chkpwd', '/usr/bin/at',
              '/usr/bin/gpasswd', '/usr/bin/locate', '/usr/bin/newgrp',
@@ -115,15 +144,131 @@ def get_audits():
     return checks
 
 
+def _pruned_paths(root_path):
+    """Return the paths the suid/sgid scan should not descend into."""
+    pruned = set(PRUNE_PATHS)
+    try:
+        with open(PROC_MOUNTS) as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) > 2 and fields[2] in PRUNE_FSTYPES:
+                    pruned.add(fields[1].replace('\\040', ' '))
+    except (IOError, OSError):
+        pass
+    # Never prune the root of the scan itself.
+    pruned.discard(root_path)
+    return pruned
+
+
+def _has_suid_sgid(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (stat.S_ISREG(st.st_mode) and
+            bool(st.st_mode & (stat.S_ISUID | stat.S_ISGID)))
+
+
+def _tree_stamp(path, dpkg_stamp):
+    """Return what must be unchanged for the scan to skip tree path."""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode):
+        return None
+    return [st.st_mtime_ns] + dpkg_stamp
+
+
+def _start_points(root_path, pruned):
+    """Return the paths to run find from for it to scan root_path without
+    entering any of pruned.
+
+    Each directory holding a pruned path is replaced by its entries, which
+    costs a listing per level rather than a pattern match per directory
+    scanned as with find -prune.
+    """
+    points = [root_path]
+    for path in sorted(pruned):
+        while True:
+            parent = next((p for p in points
+                           if path.startswith(p.rstrip('/') + '/')), None)
+            if parent is None:
+                break
+            points.remove(parent)
+            try:
+                points.extend(sorted(e.path for e in os.scandir(parent)))
+            except OSError:
+                pass
+        if path in points:
+            points.remove(path)
+    return points
+
+
+def _find(root_path, pruned):
+    """Run find for the suid/sgid files under root_path, pruning pruned."""
+    points = _start_points(root_path, pruned)
+    if not points:
+        return set()
+    cmd = ['find'] + points + ['-type', 'f', '(', '-perm', '-4000', '-o',
+                               '-perm', '-2000', ')', '-print0']
+    # find exits non-zero for the directories it couldn't read, the files
+    # found elsewhere are still printed.
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL)
+    out, _ = p.communicate()
+    return set(os.fsdecode(f) for f in out.split(b'\0') if f)
+
+
 def find_paths_with_suid_sgid(root_path):
     """Finds all paths/files which have an suid/sgid bit enabled.
 
     Starting with the root_path, this will recursively find all paths which
     have an suid or sgid bit set.
+
+    PRUNE_PATHS and the mount points of PRUNE_FSTYPES are not descended
+    into, nor are the PACKAGE_TREES unchanged since the last scan.
     """
-    cmd = ['find', root_path, '-perm', '-4000', '-o', '-perm', '-2000',
-           '-type', 'f', '!', '-path', '/proc/*', '-print']
+    start = time.time()
+    db = unitdata.kv()
+    state = db.get(SCAN_STATE_KEY) or {}
+    if (state.get('root') != root_path or
+            start - state.get('full', 0) > FULL_SCAN_INTERVAL):
+        state = {'root': root_path, 'full': start, 'trees': {}}
+    dpkg_stamp = []
+    for stamp in DPKG_STAMPS:
+        try:
+            dpkg_stamp.append(os.stat(stamp).st_mtime_ns)
+        except OSError:
+            dpkg_stamp.append(None)
 
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, _ = p.communicate()
-    return set(out.split('\n'))
+    paths = set()
+    skipped = set()
+    trees = {}
+    for tree in PACKAGE_TREES:
+        path = os.path.join(root_path, tree.lstrip('/'))
+        stamp = _tree_stamp(path, dpkg_stamp)
+        if stamp is None:
+            continue
+        previous = state['trees'].get(path)
+        if previous and previous['stamp'] == stamp:
+            skipped.add(path)
+            paths.update(f for f in previous['paths'] if _has_suid_sgid(f))
+        trees[path] = stamp
+
+    paths.update(_find(root_path, _pruned_paths(root_path) | skipped))
+
+    state['trees'] = {
+        path: {'stamp': stamp,
+               'paths': sorted(f for f in paths
+                               if f.startswith(path.rstrip('/') + '/'))}
+        for path, stamp in trees.items()}
+    db.set(SCAN_STATE_KEY, state)
+    db.flush()
+
+    log("suid/sgid scan of {} took {:.2f}s: {} of {} package trees "
+        "skipped, {} files found".format(root_path, time.time() - start,
+                                         len(skipped), len(trees),
+                                         len(paths)), level=INFO)
+    log("suid/sgid files: {}".format(' '.join(sorted(paths))), level=DEBUG)
+    return paths
@@ -594,6 +594,114 @@ def port_has_listener(address, port, sslinfo=None):
         return False
 
 
+PROC_NET_TCP = ('/proc/net/tcp', '/proc/net/tcp6')
+_TCP_ESTABLISHED = '01'
+_TCP_LISTEN = '0A'
+# Local addresses of listening sockets that a connection to 0.0.0.0 (as made
+# by port_has_listener) reaches.
+_LOCAL_LISTEN_ADDRESSES = ('0.0.0.0', '127.0.0.1', '::', '::ffff:0.0.0.0',
+                           '::ffff:127.0.0.1')
+
+
+def _decode_proc_net_address(hex_address):
+    """Decode an address from /proc/net/tcp{,6}.
+
+    The address is made of 32 bit words, each in host (little endian) byte
+    order.
+    """
+    words = [int(hex_address[i:i + 8], 16)
+             for i in range(0, len(hex_address), 8)]
+    packed = b''.join(w.to_bytes(4, 'little') for w in words)
+    family = socket.AF_INET if len(words) == 1 else socket.AF_INET6
+    return socket.inet_ntop(family, packed)
+
+
+def _proc_net_tcp_sockets(proc_files=None):
+    """Return the (local address, local port, state) of every TCP socket.
+
+    :param proc_files: the /proc/net files to read, default PROC_NET_TCP
+    :type proc_files: Optional[Tuple[str, ...]]
+    :rtype: List[Tuple[str, int, str]]
+    :raises: IOError if none of the proc files can be read
+    """
+    proc_files = proc_files or PROC_NET_TCP
+    sockets = []
+    read = 0
+    for proc_file in proc_files:
+        try:
+            with open(proc_file, 'r') as f:
+                lines = f.readlines()[1:]
+        except (IOError, OSError):
+            continue
+        read += 1
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            address, port = fields[1].split(':')
+            sockets.append((address, int(port, 16), fields[3]))
+    if not read:
+        raise IOError('Unable to read any of {}'.format(', '.join(proc_files)))
+    return sockets
+
+
+def listening_ports(proc_files=None):
+    """Return the TCP ports listened to on the local wildcard addresses.
+
+    Reads every listening socket in a single pass over /proc/net/tcp and
+    /proc/net/tcp6 rather than probing each port with 'nc'.
+
+    :param proc_files: the /proc/net files to read, default PROC_NET_TCP
+    :type proc_files: Optional[Tuple[str, ...]]
+    :returns: the listening ports
+    :rtype: Set[int]
+    :raises: IOError if none of the proc files can be read
+    """
+    return {port for address, port, state in _proc_net_tcp_sockets(proc_files)
+            if state == _TCP_LISTEN and
+            _decode_proc_net_address(address) in _LOCAL_LISTEN_ADDRESSES}
+
+
+def established_connections(ports, proc_files=None):
+    """Return the number of established TCP connections to local ports.
+
+    :param ports: the local port numbers
+    :type ports: List[int]
+    :param proc_files: the /proc/net files to read, default PROC_NET_TCP
+    :type proc_files: Optional[Tuple[str, ...]]
+    :rtype: int
+    :raises: IOError if none of the proc files can be read
+    """
+    ports = set(int(p) for p in ports)
+    return len([port for _, port, state in _proc_net_tcp_sockets(proc_files)
+                if state == _TCP_ESTABLISHED and port in ports])
+
+
+def ports_have_listeners(ports, sslinfo=None):
+    """Return whether each of ports is open on this unit.
+
+    Without sslinfo, this is the same as calling
+    port_has_listener('0.0.0.0', port) for each port, but done with a single
+    read of /proc/net/tcp{,6}.
+
+    :param ports: the port numbers
+    :type ports: List[int]
+    :param sslinfo: optional SSLPortCheckInfo object, in which case each port
+                    is checked with an SSL connection.
+    :returns: a bool for each of the ports, in order
+    :rtype: List[bool]
+    """
+    ports = list(ports)
+    if not sslinfo:
+        try:
+            listening = listening_ports()
+        except (IOError, OSError, ValueError):
+            pass
+        else:
+            return [int(p) in listening for p in ports]
+    return [port_has_listener('0.0.0.0', p, sslinfo) for p in ports]
+
+
 def assert_charm_supports_ipv6():
     """Check whether we are able to support charms ipv6."""
     release = lsb_release()['DISTRIB_CODENAME'].lower()
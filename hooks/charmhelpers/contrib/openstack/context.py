@@ -81,6 +81,7 @@ from charmhelpers.core.host import (
     pwgen,
     lsb_release,
     CompareHostReleases,
+    is_container,
 )
 from charmhelpers.contrib.hahelpers.cluster import (
     determine_apache_port,
@@ -1054,11 +1055,18 @@ class HAProxyContext(OSContextGenerator):
             ctxt['stat_password'] = db.set('stat-password', pwgen(32))
             db.flush()
 
+        haproxy_version = get_installed_version("haproxy")
+        # haproxy >= 1.8 can be reloaded without dropping connections by
+        # running in master-worker mode and passing the listening sockets
+        # to the new workers over the admin socket.
+        if (haproxy_version and
+                haproxy_version.ver_str >= LooseVersion("1.8")):
+            ctxt['haproxy_seamless_reload'] = True
+
         # NOTE(rgildein): configure prometheus exporter for haproxy > 2.0.0
         #                 New bind will be created and a prometheus-exporter
         #                 will be used for path /metrics. At the same time,
         #                 prometheus-exporter avoids using auth.
-        haproxy_version = get_installed_version("haproxy")
         if (haproxy_version and
                 haproxy_version.ver_str >= LooseVersion("2.0.0") and
                 is_relation_made("haproxy-exporter")):
@@ -1695,47 +1703,227 @@ class BindHostContext(OSContextGenerator):
 
 MAX_DEFAULT_WORKERS = 4
 DEFAULT_MULTIPLIER = 2
+CGROUP_ROOT = '/sys/fs/cgroup'
+# (quota, period) files of cgroup v2 then v1 cpu controllers, and the
+# cpuset files listing the CPUs the unit may run on.
+CGROUP_CPU_QUOTA_FILES = (
+    ('cpu.max', None),
+    ('cpu/cpu.cfs_quota_us', 'cpu/cpu.cfs_period_us'),
+    ('cpu,cpuacct/cpu.cfs_quota_us', 'cpu,cpuacct/cpu.cfs_period_us'),
+)
+CGROUP_CPUSET_FILES = (
+    'cpuset.cpus.effective',
+    'cpuset/cpuset.effective_cpus',
+    'cpuset/cpuset.cpus',
+)
+# Limit files of cgroup v2 then v1 memory controllers.
+CGROUP_MEMORY_FILES = ('memory.max', 'memory/memory.limit_in_bytes')
+# Memory left to everything but the workers: the rest of the system and the
+# services they depend on.  The larger of the two applies.
+MIN_MEMORY_RESERVE = 1024 ** 3
+MEMORY_RESERVE_FRACTION = 0.2
 
 
-def _calculate_workers():
+def _calculate_workers(default_multiplier=None, multiplier=None,
+                       service=None):
     '''
     Determine the number of worker processes based on the CPU
     count of the unit containing the application.
 
-    Workers will be limited to MAX_DEFAULT_WORKERS in
-    container environments where no worker-multipler configuration
-    option been set.
+    The CPU count is the number of CPUs the unit's cgroup may use (see
+    _num_cpus).  Without a cgroup CPU limit, workers will be limited to
+    MAX_DEFAULT_WORKERS in container environments where no
+    worker-multipler configuration option been set.
 
+    A charm may give its own default_multiplier for a service, in which
+    case the MAX_DEFAULT_WORKERS limit only applies in containers.  The
+    count chosen and why are logged; see _fit_workers_to_memory() to limit
+    the counts of several services to the memory of the unit.
+
+    @param default_multiplier: workers per CPU if worker-multiplier is unset
+    @param multiplier: workers per CPU, overriding worker-multiplier
+    @param service: name of the service the workers are for, for the log
     @returns int: number of worker processes to use
     '''
-    multiplier = config('worker-multiplier')
+    if multiplier is None:
+        multiplier = config('worker-multiplier')
+    configured = multiplier is not None
 
     # distinguish an empty config and an explicit config as 0.0
     if multiplier is None:
-        multiplier = DEFAULT_MULTIPLIER
+        multiplier = default_multiplier or DEFAULT_MULTIPLIER
 
-    count = int(_num_cpus() * multiplier)
+    cpu_limit = _cgroup_cpu_limit()
+    cpus = _num_cpus()
+    count = int(cpus * multiplier)
     if count <= 0:
         # assign at least one worker
         count = 1
+    reasons = ['{} CPUs{} x {}'.format(
+        cpus, ' (cgroup limit)' if cpu_limit is not None else '',
+        multiplier)]
+
+    # The CPUs granted by the cgroup are known so no default limit is needed
+    if not configured and cpu_limit is None:
+        if default_multiplier is None or is_container():
+            # NOTE(jamespage): Limit unconfigured worker-multiplier
+            #                  to MAX_DEFAULT_WORKERS to avoid insane
+            #                  worker configuration on large servers
+            # Reference: https://pad.lv/1665270
+            if count > MAX_DEFAULT_WORKERS:
+                count = MAX_DEFAULT_WORKERS
+                reasons.append('default limit of {}'.format(count))
+
+    log('{} workers for {}: {}'.format(count, service or 'service',
+                                       ', limited by '.join(reasons)),
+        level=INFO)
+    return count
+
+
+def _read_cgroup_file(name):
+    try:
+        with open(os.path.join(CGROUP_ROOT, name), 'r') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def _cgroup_memory_limit():
+    '''
+    Return the memory limit of the unit's cgroup.
+
+    @returns: int: memory in bytes, or None without a cgroup memory limit
+    '''
+    for limit_file in CGROUP_MEMORY_FILES:
+        limit = _read_cgroup_file(limit_file)
+        if limit is None:
+            continue
+        try:
+            limit = int(limit)
+        except ValueError:
+            # 'max'
+            return None
+        # cgroup v1 reports no limit as a huge number
+        if limit >= psutil.virtual_memory().total:
+            return None
+        return limit
+    return None
+
+
+def _memory_limit():
+    '''
+    Return the memory the workers of the unit may use together: the lower
+    of the host memory and the cgroup memory limit, less a reserve for the
+    rest of the system.
+
+    Unlike the free memory this doesn't depend on the workers already
+    running, so the worker counts derived from it don't change from one
+    hook to the next.
+
+    @returns: int: memory in bytes
+    '''
+    memory = psutil.virtual_memory().total
+    cgroup_limit = _cgroup_memory_limit()
+    if cgroup_limit is not None:
+        memory = min(memory, cgroup_limit)
+    reserve = max(MIN_MEMORY_RESERVE, int(memory * MEMORY_RESERVE_FRACTION))
+    return max(0, memory - reserve)
+
+
+def _fit_workers_to_memory(counts, worker_memory):
+    '''
+    Scale down the worker counts of several services so that together they
+    fit in _memory_limit().
 
-    if config('worker-multiplier') is None:
-        # NOTE(jamespage): Limit unconfigured worker-multiplier
-        #                  to MAX_DEFAULT_WORKERS to avoid insane
-        #                  worker configuration on large servers
-        # Reference: https://pad.lv/1665270
-        count = min(count, MAX_DEFAULT_WORKERS)
+    All the counts are scaled by the same factor, keeping at least one
+    worker per service.  Any limiting is logged.
 
+    @param counts: {service: number of workers}
+    @param worker_memory: {service: estimated memory of one worker, bytes}
+    @returns dict: {service: number of workers}
+    '''
+    needed = sum(n * worker_memory[svc] for svc, n in counts.items())
+    limit = _memory_limit()
+    if needed <= limit:
+        return counts
+    factor = float(limit) / needed
+    fitted = collections.OrderedDict(
+        (svc, max(1, int(n * factor))) for svc, n in counts.items())
+    log('Workers limited by {}MiB of memory ({}MiB needed): {}'.format(
+        limit // 2 ** 20, needed // 2 ** 20,
+        ', '.join('{} {} -> {}'.format(svc, counts[svc], n)
+                  for svc, n in fitted.items())),
+        level=INFO)
+    return fitted
+
+
+def _parse_cpu_list(cpu_list):
+    '''
+    Return the number of CPUs of a cpuset list such as 0-3,8.
+    '''
+    count = 0
+    for item in cpu_list.strip().split(','):
+        if not item:
+            continue
+        first, _, last = item.partition('-')
+        count += int(last or first) - int(first) + 1
     return count
 
 
+def _cgroup_cpu_limit():
+    '''
+    Return the number of CPUs the unit's cgroup is limited to, by its CPU
+    quota (cpu.max or cpu.cfs_quota_us, rounded up) or its cpuset.
+
+    @returns: int: number of CPUs, or None if not limited to fewer CPUs
+              than the host has
+    '''
+    limits = []
+    for quota_file, period_file in CGROUP_CPU_QUOTA_FILES:
+        quota = _read_cgroup_file(quota_file)
+        if quota is None:
+            continue
+        try:
+            if period_file is None:
+                quota, period = quota.split()[:2]
+            else:
+                period = _read_cgroup_file(period_file)
+            quota, period = int(quota), int(period)
+        except (ValueError, TypeError):
+            # 'max' or no period
+            break
+        if quota > 0 and period > 0:
+            limits.append(max(1, int(math.ceil(float(quota) / period))))
+        break
+    for cpuset_file in CGROUP_CPUSET_FILES:
+        cpuset = _read_cgroup_file(cpuset_file)
+        if cpuset and cpuset.strip():
+            try:
+                limits.append(_parse_cpu_list(cpuset))
+            except ValueError:
+                pass
+            break
+    try:
+        host_cpus = psutil.cpu_count()
+    except AttributeError:
+        host_cpus = psutil.NUM_CPUS
+    limits = [n for n in limits if n < host_cpus]
+    return min(limits) if limits else None
+
+
 def _num_cpus():
     '''
     Compatibility wrapper for calculating the number of CPU's
     a unit has.
 
+    This is the number of CPUs of the host, unless the unit's cgroup is
+    limited to fewer CPUs by a CPU quota or a cpuset.
+
     @returns: int: number of CPU cores detected
     '''
+    cpu_limit = _cgroup_cpu_limit()
+    if cpu_limit is not None:
+        return cpu_limit
     try:
         return psutil.cpu_count()
     except AttributeError:
@@ -12,10 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import inspect
 import os
+import tempfile
 
 from charmhelpers.fetch import apt_install, apt_update
 from charmhelpers.core.hookenv import (
+    data_generation,
     log,
     ERROR,
     INFO,
@@ -83,13 +86,36 @@ def get_loader(templates_dir, os_release):
     return ChoiceLoader(loaders)
 
 
+def context_key(context):
+    """
+    Return a key identifying a context generator by its class and the state
+    it was constructed with, so that equivalent generators registered against
+    several config files can be shared.
+
+    :param context: a context generator (OSContextGenerator or callable)
+    :returns: a hashable key, or None if the generator can't be keyed.
+    """
+    if inspect.isroutine(context):
+        return context
+    try:
+        state = sorted(vars(context).items())
+    except TypeError:
+        return None
+    return (type(context), repr(state))
+
+
 class OSConfigTemplate(object):
     """
     Associates a config file template with a list of context generators.
     Responsible for constructing a template context based on those generators.
+
+    If a context_cache dict is provided, generator results are stored in it
+    keyed by generator so that they are evaluated at most once while the
+    cache lives.
     """
 
-    def __init__(self, config_file, contexts, config_template=None):
+    def __init__(self, config_file, contexts, config_template=None,
+                 context_cache=None):
         self.config_file = config_file
 
         if hasattr(contexts, '__call__'):
@@ -100,11 +126,20 @@ class OSConfigTemplate(object):
         self._complete_contexts = []
 
         self.config_template = config_template
+        self._context_cache = context_cache
+
+    def _evaluate(self, context):
+        if self._context_cache is None:
+            return context()
+        key = id(context)
+        if key not in self._context_cache:
+            self._context_cache[key] = context()
+        return self._context_cache[key]
 
     def context(self):
         ctxt = {}
         for context in self.contexts:
-            _ctxt = context()
+            _ctxt = self._evaluate(context)
             if _ctxt:
                 ctxt.update(_ctxt)
                 # track interfaces for every complete context.
@@ -204,6 +239,12 @@ class OSConfigRenderer(object):
     of generators.  When a template is rendered and written, all context
     generates are called in a chain to generate the context dictionary
     passed to the jinja2 template. See context.py for more info.
+
+    Generators of the same class constructed with the same arguments are
+    shared between config files and each one is evaluated at most once until
+    the hook changes relation, leader or unit data (see
+    hookenv.data_changed()); reset_context_cache() drops the results
+    explicitly.
     """
     def __init__(self, templates_dir, openstack_release):
         if not os.path.isdir(templates_dir):
@@ -215,6 +256,10 @@ class OSConfigRenderer(object):
         self.openstack_release = openstack_release
         self.templates = {}
         self._tmpl_env = None
+        self._contexts = {}
+        self._context_cache = {}
+        self._context_generation = data_generation()
+        self._changed_files = []
 
         if None in [Environment, ChoiceLoader, FileSystemLoader]:
             # if this code is running, the object is created pre-install hook.
@@ -232,14 +277,45 @@ class OSConfigRenderer(object):
         :param contexts (list): a list of context dictionaries with kv pairs
         :param config_template (str): an optional template string to use
         """
-        self.templates[config_file] = OSConfigTemplate(
+        ostmpl = OSConfigTemplate(
             config_file=config_file,
             contexts=contexts,
-            config_template=config_template
+            config_template=config_template,
+            context_cache=self._context_cache,
         )
+        ostmpl.contexts = [self._shared_context(c) for c in ostmpl.contexts]
+        self.templates[config_file] = ostmpl
         log('Registered config file: {}'.format(config_file),
             level=INFO)
 
+    def _shared_context(self, context):
+        """
+        Return the registered generator equivalent to context, registering
+        context itself if none has been seen yet.
+        """
+        key = context_key(context)
+        if key is None:
+            return context
+        return self._contexts.setdefault(key, context)
+
+    def reset_context_cache(self):
+        """
+        Forget all evaluated contexts so that they are regenerated on the next
+        render.
+        """
+        self._context_cache.clear()
+        self._context_generation = data_generation()
+        for ostmpl in self.templates.values():
+            ostmpl._complete_contexts = []
+
+    def _refresh_context_cache(self):
+        """
+        Drop the evaluated contexts if data was changed since they were
+        evaluated.
+        """
+        if self._context_generation != data_generation():
+            self.reset_context_cache()
+
     def _get_tmpl_env(self):
         if not self._tmpl_env:
             loader = get_loader(self.templates_dir, self.openstack_release)
@@ -269,6 +345,7 @@ class OSConfigRenderer(object):
             log('Config not registered: {}'.format(config_file), level=ERROR)
             raise OSConfigException
 
+        self._refresh_context_cache()
         ostmpl = self.templates[config_file]
         ctxt = ostmpl.context()
 
@@ -305,6 +382,14 @@ class OSConfigRenderer(object):
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+
+        The file is only written if the rendered content differs from what is
+        already on disk, in which case it is replaced atomically by renaming a
+        temporary file over it so that readers never see a partial file.  The
+        ownership and permissions of an existing file are preserved.
+
+        :returns: True if the file was changed, False otherwise.
+        :rtype: bool
         """
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
@@ -312,17 +397,58 @@ class OSConfigRenderer(object):
 
         _out = self.render(config_file).encode('UTF-8')
 
-        with open(config_file, 'wb') as out:
-            out.write(_out)
-
+        try:
+            with open(config_file, 'rb') as existing:
+                if existing.read() == _out:
+                    log('Template %s unchanged.' % config_file, level=INFO)
+                    return False
+            stat = os.stat(config_file)
+        except (IOError, OSError):
+            stat = None
+
+        _dir = os.path.dirname(config_file)
+        fd, tmp = tempfile.mkstemp(dir=_dir or None,
+                                   prefix='.{}.'.format(
+                                       os.path.basename(config_file)))
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(_out)
+                if stat:
+                    os.fchown(out.fileno(), stat.st_uid, stat.st_gid)
+                    os.fchmod(out.fileno(), stat.st_mode & 0o7777)
+                else:
+                    umask = os.umask(0)
+                    os.umask(umask)
+                    os.fchmod(out.fileno(), 0o666 & ~umask)
+            os.rename(tmp, config_file)
+        except Exception:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+        self._changed_files.append(config_file)
         log('Wrote template %s.' % config_file, level=INFO)
+        return True
 
     def write_all(self):
         """
         Write out all registered config files.
+
+        :returns: list of config files that were changed.
+        :rtype: List[str]
+        """
+        return [k for k in list(self.templates.keys()) if self.write(k)]
+
+    def changed_files(self):
+        """
+        Return the config files changed by write() since the last call, e.g.
+        for use as the changed_files_f of core.host.restart_on_change.
+
+        :returns: list of config files
+        :rtype: List[str]
         """
-        for k in self.templates.keys():
-            self.write(k)
+        changed, self._changed_files = self._changed_files, []
+        return changed
 
     def set_release(self, openstack_release):
         """
@@ -331,12 +457,14 @@ class OSConfigRenderer(object):
         """
         self._tmpl_env = None
         self.openstack_release = openstack_release
+        self.reset_context_cache()
         self._get_tmpl_env()
 
     def complete_contexts(self):
         '''
         Returns a list of context interfaces that yield a complete context.
         '''
+        self._refresh_context_cache()
         interfaces = []
         for i in self.templates.values():
             interfaces.extend(i.complete_contexts())
@@ -23,6 +23,7 @@ import os
 import sys
 import re
 import itertools
+import sqlite3
 import functools
 
 import traceback
@@ -47,6 +48,7 @@ from charmhelpers.core.hookenv import (
     expected_related_units,
     log as juju_log,
     charm_dir,
+    DEBUG,
     INFO,
     ERROR,
     metadata,
@@ -79,19 +81,20 @@ from charmhelpers.contrib.storage.linux.lvm import (
 from charmhelpers.contrib.network.ip import (
     get_ipv6_addr,
     is_ipv6,
-    port_has_listener,
+    ports_have_listeners,
 )
 
 from charmhelpers.core.host import (
     lsb_release,
     mounts,
     umount,
-    service_running,
+    services_running as _services_running,
     service_pause,
     service_resume,
     service_stop,
     service_start,
     restart_on_change_helper,
+    run_service_actions,
 )
 
 from charmhelpers.fetch import (
@@ -597,11 +600,86 @@ def openstack_release():
 # Module local cache variable for the os_release.
 _os_rel = None
 
+# The dpkg database; any package install, upgrade or removal rewrites it.
+DPKG_STATUS = '/var/lib/dpkg/status'
+# unitdata key under which the package derived codename is persisted.
+OS_RELEASE_CACHE_KEY = 'os-release-cache'
+
+
+def dpkg_status_stamp():
+    """Return a stamp identifying the current state of the dpkg database.
+
+    :returns: [mtime_ns, size] of the dpkg status file or None if missing.
+    :rtype: Optional[List[int]]
+    """
+    try:
+        st = os.stat(DPKG_STATUS)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def get_cached_os_codename_package(package):
+    """Return the persisted codename for package if still valid.
+
+    The codename is stored in unitdata along with a stamp of the dpkg
+    database, so that steady-state hooks don't need to run apt/dpkg tooling
+    just to find out which release they are rendering for.  Any change to
+    the installed packages invalidates the entry.
+
+    :param package: the package the codename was derived from.
+    :type package: str
+    :returns: the OpenStack release codename or None
+    :rtype: Optional[str]
+    """
+    stamp = dpkg_status_stamp()
+    if stamp is None:
+        return None
+    try:
+        cached = unitdata.kv().get(OS_RELEASE_CACHE_KEY) or {}
+    except sqlite3.Error:
+        return None
+    if (cached.get('package') == package and
+            cached.get('dpkg-status') == stamp):
+        return cached.get('codename')
+    return None
+
+
+def set_cached_os_codename_package(package, codename):
+    """Persist the codename derived from package to unitdata.
+
+    :param package: the package the codename was derived from.
+    :type package: str
+    :param codename: the OpenStack release codename
+    :type codename: str
+    """
+    stamp = dpkg_status_stamp()
+    if stamp is None:
+        return
+    try:
+        db = unitdata.kv()
+        db.set(OS_RELEASE_CACHE_KEY, {
+            'package': package,
+            'codename': codename,
+            'dpkg-status': stamp,
+        })
+        db.flush()
+    except sqlite3.Error as e:
+        juju_log('Unable to persist OpenStack release: {}'.format(str(e)),
+                 level=DEBUG)
+
 
 def reset_os_release():
     '''Unset the cached os_release version'''
     global _os_rel
     _os_rel = None
+    try:
+        db = unitdata.kv()
+        db.unset(OS_RELEASE_CACHE_KEY)
+        db.flush()
+    except sqlite3.Error as e:
+        juju_log('Unable to reset the persisted OpenStack release: {}'
+                 .format(str(e)), level=DEBUG)
 
 
 def os_release(package, base=None, reset_cache=False, source_key=None):
@@ -634,8 +712,13 @@ def os_release(package, base=None, reset_cache=False, source_key=None):
         reset_os_release()
     if _os_rel:
         return _os_rel
+    codename = get_cached_os_codename_package(package)
+    if not codename:
+        codename = get_os_codename_package(package, fatal=False)
+        if codename:
+            set_cached_os_codename_package(package, codename)
     _os_rel = (
-        get_os_codename_package(package, fatal=False) or
+        codename or
         get_os_codename_install_source(config(source_key)) or
         base)
     return _os_rel
@@ -1305,8 +1388,8 @@ def _check_running_services(services):
     @returns [(service, boolean), ...], : results for checks
              [boolean]                  : just the result of the service checks
     """
-    services_running = [service_running(s) for s in services]
-    return list(zip(services, services_running)), services_running
+    running = _services_running(list(services))
+    return list(zip(services, running)), running
 
 
 def _check_listening_on_services_ports(services, test=False,
@@ -1326,8 +1409,7 @@ def _check_listening_on_services_ports(services, test=False,
     """
     test = not (not (test))  # ensure test is True or False
     all_ports = list(itertools.chain(*services.values()))
-    ports_states = [port_has_listener('0.0.0.0', p, ssl_check_info)
-                    for p in all_ports]
+    ports_states = ports_have_listeners(all_ports, ssl_check_info)
     map_ports = OrderedDict()
     matched_ports = [p for p, opened in zip(all_ports, ports_states)
                      if opened == test]  # essentially opened xor test
@@ -1349,8 +1431,7 @@ def _check_listening_on_ports_list(ports, ssl_check_info=None):
     @param ports: LIST of port numbers.
     @returns [(port_num, boolean), ...], [boolean]
     """
-    ports_open = [port_has_listener('0.0.0.0', p, ssl_check_info)
-                  for p in ports]
+    ports_open = ports_have_listeners(ports, ssl_check_info)
     return zip(ports, ports_open), ports_open
 
 
@@ -1616,7 +1697,8 @@ def is_hook_allowed(hookname, check_deferred_restarts=True):
     return permitted, " and ".join(reasons)
 
 
-def manage_payload_services(action, services=None, charm_func=None):
+def manage_payload_services(action, services=None, charm_func=None,
+                            dependencies=None, timeout=None):
     """Run an action against all services.
 
     An optional charm_func() can be called. It should raise an Exception to
@@ -1634,12 +1716,20 @@ def manage_payload_services(action, services=None, charm_func=None):
       - A dictionary (optionally OrderedDict) {service_name: {'service': ..}}
       - An array of [{'service': service_name, ...}, ...]
 
+    If dependencies are given, the services are acted on concurrently with
+    run_service_actions(): a service is started or resumed after the
+    services it depends on, and paused or stopped before them.
+
     :param action: Action to run: pause, resume, start or stop.
     :type action: str
     :param services: See above
     :type services: See above
     :param charm_func: function to run for custom charm pausing.
     :type charm_func: f()
+    :param dependencies: {service: [service it depends on, ...]}
+    :type dependencies: Optional[Dict[str, List[str]]]
+    :param timeout: seconds after which a concurrent action is given up
+    :type timeout: Optional[float]
     :returns: Status boolean and list of messages
     :rtype: (bool, [])
     :raises: RuntimeError
@@ -1657,7 +1747,18 @@ def manage_payload_services(action, services=None, charm_func=None):
     services = _extract_services_list_helper(services)
     messages = []
     success = True
-    if services:
+    if services and dependencies is not None:
+        results = run_service_actions(
+            actions[action], list(services.keys()),
+            dependencies=dependencies,
+            reverse=action in ('pause', 'stop'),
+            timeout=timeout)
+        for service in services.keys():
+            if not results[service][0]:
+                success = False
+                messages.append("{} didn't {} cleanly.".format(service,
+                                                               action))
+    elif services:
         for service in services.keys():
             rc = actions[action](service)
             if not rc:
@@ -1691,7 +1792,7 @@ def make_wait_for_ports_barrier(ports, retry_count=5):
 
 
 def pause_unit(assess_status_func, services=None, ports=None,
-               charm_func=None):
+               charm_func=None, dependencies=None):
     """Pause a unit by stopping the services and setting 'unit-paused'
     in the local kv() store.
 
@@ -1717,13 +1818,16 @@ def pause_unit(assess_status_func, services=None, ports=None,
     @param services: OPTIONAL see above
     @param ports: OPTIONAL list of port
     @param charm_func: function to run for custom charm pausing.
+    @param dependencies: OPTIONAL {service: [service it depends on, ...]}
+                         to pause the services concurrently in dependency order
     @returns None
     @raises Exception(message) on an error for action_fail().
     """
     _, messages = manage_payload_services(
         'pause',
         services=services,
-        charm_func=charm_func)
+        charm_func=charm_func,
+        dependencies=dependencies)
     set_unit_paused()
 
     if assess_status_func:
@@ -1735,7 +1839,7 @@ def pause_unit(assess_status_func, services=None, ports=None,
 
 
 def resume_unit(assess_status_func, services=None, ports=None,
-                charm_func=None):
+                charm_func=None, dependencies=None):
     """Resume a unit by starting the services and clearning 'unit-paused'
     in the local kv() store.
 
@@ -1760,13 +1864,16 @@ def resume_unit(assess_status_func, services=None, ports=None,
     @param services: OPTIONAL see above
     @param ports: OPTIONAL list of port
     @param charm_func: function to run for custom charm resuming.
+    @param dependencies: OPTIONAL {service: [service it depends on, ...]}
+                         to resume the services concurrently in dependency order
     @returns None
     @raises Exception(message) on an error for action_fail().
     """
     _, messages = manage_payload_services(
         'resume',
         services=services,
-        charm_func=charm_func)
+        charm_func=charm_func,
+        dependencies=dependencies)
     clear_unit_paused()
     if assess_status_func:
         message = assess_status_func()
@@ -61,7 +61,129 @@ class WORKLOAD_STATES(Enum):
     WAITING = 'waiting'
 
 
-cache = {}
+class HookCache(object):
+    """Store for the return values of functions decorated with cached().
+
+    Entries are indexed by the function they belong to and by every string
+    argument they were called with (relation ids, unit names, ...), so that
+    flush() can drop exactly the entries referring to a given value without
+    scanning the whole cache.  Hit and miss counters are kept per function
+    for debugging, see stats().
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._by_func = {}
+        self._by_token = {}
+        self._key_tokens = {}
+        self._stats = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _tokens(value):
+        if isinstance(value, str):
+            yield value
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            for v in value:
+                for token in HookCache._tokens(v):
+                    yield token
+        elif isinstance(value, dict):
+            for v in value.values():
+                for token in HookCache._tokens(v):
+                    yield token
+
+    @staticmethod
+    def make_key(func, args, kwargs):
+        """Return the cache key for a call of func with args and kwargs."""
+        key = (func, args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            key = (func, json.dumps((args, kwargs), sort_keys=True,
+                                    default=str))
+        return key
+
+    def _func_stats(self, func):
+        name = getattr(func, '__qualname__', str(func))
+        return self._stats.setdefault(name, {'hits': 0, 'misses': 0})
+
+    def get(self, func, args, kwargs):
+        """Return (hit, value) for a call of func with args and kwargs."""
+        key = self.make_key(func, args, kwargs)
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            self._func_stats(func)['misses'] += 1
+            return False, None
+        self.hits += 1
+        self._func_stats(func)['hits'] += 1
+        return True, value
+
+    def set(self, func, args, kwargs, value):
+        """Store the value returned by a call of func with args and kwargs."""
+        key = self.make_key(func, args, kwargs)
+        self._entries[key] = value
+        self._by_func.setdefault(func, set()).add(key)
+        tokens = set(self._tokens((args, kwargs)))
+        self._key_tokens[key] = tokens
+        for token in tokens:
+            self._by_token.setdefault(token, set()).add(key)
+
+    @staticmethod
+    def _unindex(index, name, key):
+        keys = index.get(name)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[name]
+
+    def _discard(self, keys):
+        for key in keys:
+            self._entries.pop(key, None)
+            self._unindex(self._by_func, key[0], key)
+            for token in self._key_tokens.pop(key, ()):
+                self._unindex(self._by_token, token, key)
+
+    def flush(self, token):
+        """Drop every entry for a call that had token as an argument."""
+        self._discard(self._by_token.pop(token, ()))
+
+    def flush_function(self, func):
+        """Drop every entry for calls of func (or the cached() wrapper)."""
+        func = getattr(func, '_wrapped', func)
+        self._discard(self._by_func.pop(func, ()))
+
+    def clear(self):
+        """Drop all entries; the hit/miss counters are kept."""
+        self._entries.clear()
+        self._by_func.clear()
+        self._by_token.clear()
+        self._key_tokens.clear()
+
+    def stats(self):
+        """Return the hit/miss counters, overall and per function.
+
+        :returns: {'hits': int, 'misses': int, 'entries': int,
+                   'functions': {name: {'hits': int, 'misses': int}}}
+        :rtype: Dict[str, Any]
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'functions': copy.deepcopy(self._stats),
+        }
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+cache = HookCache()
 
 
 def cached(func):
@@ -79,28 +201,44 @@ def cached(func):
     """
     @wraps(func)
     def wrapper(*args, **kwargs):
-        global cache
-        key = json.dumps((func, args, kwargs), sort_keys=True, default=str)
-        try:
-            return cache[key]
-        except KeyError:
-            pass  # Drop out of the exception handler scope.
+        hit, res = cache.get(func, args, kwargs)
+        if hit:
+            return res
         res = func(*args, **kwargs)
-        cache[key] = res
+        cache.set(func, args, kwargs, res)
         return res
     wrapper._wrapped = func
     return wrapper
 
 
 def flush(key):
-    """Flushes any entries from function cache where the
-    key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    """Flushes any entries from function cache that were called with key
+    as one of their arguments (e.g. a unit name or relation id)."""
+    cache.flush(key)
+
+
+def cache_stats():
+    """Return the hook cache hit/miss counters, see HookCache.stats()."""
+    return cache.stats()
+
+
+_data_generation = 0
+
+
+def data_changed():
+    """Record that relation, leader or unit data was changed by this hook.
+
+    Called by relation_set(), leader_set() and the unitdata Storage so that
+    caches of values derived from that data, such as the config contexts of
+    an OSConfigRenderer, know to recompute them.
+    """
+    global _data_generation
+    _data_generation += 1
+
+
+def data_generation():
+    """Return a counter incremented each time data_changed() is called."""
+    return _data_generation
 
 
 def log(message, level=None):
@@ -458,7 +596,48 @@ def config(scope=None):
 
 @cached
 def relation_get(attribute=None, unit=None, rid=None, app=None):
-    """Get relation information"""
+    """Get relation information
+
+    Lookups for a unit on a known relation are answered from a snapshot of
+    that unit's complete settings, fetched with a single relation-get and
+    cached for the rest of the hook (see relation_snapshot()).  The remote
+    unit of the hook is only assumed for lookups on the hook's relation.
+    """
+    if app is None:
+        _rid = rid or relation_id()
+        _unit = unit
+        if _unit is None and _rid == relation_id():
+            _unit = remote_unit()
+        if _rid and _unit:
+            settings = relation_snapshot(_rid, _unit)
+            if settings is None:
+                return None
+            if attribute:
+                return settings.get(attribute)
+            return settings.copy()
+    return _relation_get(attribute=attribute, unit=unit, rid=rid, app=app)
+
+
+@cached
+def relation_snapshot(rid, unit):
+    """Return all the relation settings of unit on relation rid.
+
+    Relation data seen by a hook is stable for the duration of the hook,
+    apart from the local unit's own settings which are flushed from the
+    cache by relation_set(), so the settings are fetched once and reused.
+
+    :param rid: the relation id
+    :type rid: str
+    :param unit: the unit name
+    :type unit: str
+    :returns: the unit's settings, or None if they can't be read.
+    :rtype: Optional[Dict[str, str]]
+    """
+    return _relation_get(unit=unit, rid=rid)
+
+
+def _relation_get(attribute=None, unit=None, rid=None, app=None):
+    """Run relation-get and return its (json decoded) output."""
     _args = ['relation-get', '--format=json']
     if app is not None:
         if unit is not None:
@@ -531,6 +710,7 @@ def relation_set(relation_id=None, relation_settings=None, app=False, **kwargs):
         subprocess.check_call(relation_cmd_line)
     # Flush cache of any relation-gets for local unit
     flush(local_unit())
+    data_changed()
 
 
 def relation_clear(r_id=None):
@@ -1242,6 +1422,7 @@ def leader_set(settings=None, **kwargs):
         else:
             cmd.append('{}={}'.format(k, v))
     subprocess.check_call(cmd)
+    data_changed()
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -19,6 +19,7 @@
 #  Nick Moffitt <nick.moffitt@canonical.com>
 #  Matthew Wedgwood <matthew.wedgwood@canonical.com>
 
+import concurrent.futures
 import errno
 import os
 import re
@@ -31,10 +32,11 @@ import subprocess
 import hashlib
 import functools
 import itertools
+import time
 
 from contextlib import contextmanager
 from collections import OrderedDict, defaultdict
-from .hookenv import log, INFO, DEBUG, local_unit, charm_name
+from .hookenv import log, INFO, DEBUG, WARNING, local_unit, charm_name
 from .fstab import Fstab
 from charmhelpers.osplatform import get_platform
 
@@ -344,6 +346,155 @@ def service_running(service_name, **kwargs):
 SYSTEMD_SYSTEM = '/run/systemd/system'
 
 
+# ActiveState values for which 'systemctl is-active' exits 0.
+_SYSTEMD_ACTIVE_STATES = ('active', 'reloading', 'refreshing')
+
+
+def services_state(service_names):
+    """Query the state of several systemd services with a single systemctl.
+
+    :param service_names: the names of the services
+    :type service_names: List[str]
+    :returns: OrderedDict of service: (ActiveState, SubState), or None if the
+              services can't be queried in one go (not systemd, or systemctl
+              failed)
+    :rtype: Optional[OrderedDict[str, Tuple[str, str]]]
+    """
+    service_names = list(service_names)
+    if not service_names:
+        return OrderedDict()
+    if not all(init_is_systemd(service_name=s) for s in service_names):
+        return None
+    cmd = ['systemctl', 'show', '--property=ActiveState,SubState']
+    try:
+        output = subprocess.check_output(
+            cmd + service_names).decode('UTF-8')
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    blocks = output.strip().split('\n\n')
+    if len(blocks) != len(service_names):
+        return None
+    states = OrderedDict()
+    for service_name, block in zip(service_names, blocks):
+        props = dict(line.split('=', 1) for line in block.splitlines()
+                     if '=' in line)
+        states[service_name] = (props.get('ActiveState', ''),
+                                props.get('SubState', ''))
+    return states
+
+
+def services_running(service_names):
+    """Determine whether several system services are running.
+
+    On systemd all the services are queried with a single 'systemctl show',
+    giving the same answer as running service_running() for each of them.
+
+    :param service_names: the names of the services
+    :type service_names: List[str]
+    :returns: a bool for each of the services, in order
+    :rtype: List[bool]
+    """
+    service_names = list(service_names)
+    states = services_state(service_names)
+    if states is None:
+        return [service_running(s) for s in service_names]
+    return [states[s][0] in _SYSTEMD_ACTIVE_STATES for s in service_names]
+
+
+def _timed_service_action(action_f, service_name):
+    start = time.time()
+    try:
+        result = action_f(service_name)
+    except Exception as e:
+        log('{} failed for {}: {}'.format(
+            getattr(action_f, '__name__', action_f), service_name, e),
+            level=WARNING)
+        result = False
+    return result, time.time() - start
+
+
+def run_service_actions(action_f, service_names, dependencies=None,
+                        reverse=False, max_workers=None, timeout=None):
+    """Run action_f on several services concurrently, honouring dependencies.
+
+    A service is only acted on once the action has completed (successfully
+    or not) for all the services it depends on, or with reverse=True, for
+    all the services depending on it: i.e. dependencies are started first
+    and stopped last.  Independent services are acted on in parallel.
+
+    :param action_f: the action, e.g. service_start; returns success
+    :type action_f: Callable[[str], bool]
+    :param service_names: the services to act on
+    :type service_names: List[str]
+    :param dependencies: {service: [service it depends on, ...]}; services
+                         not in service_names are ignored
+    :type dependencies: Optional[Dict[str, List[str]]]
+    :param reverse: act on dependent services first (e.g. to stop)
+    :type reverse: bool
+    :param max_workers: most actions run at once, default all of them
+    :type max_workers: Optional[int]
+    :param timeout: seconds after which a service's action is given up and
+                    considered failed.  This only stops waiting for it:
+                    threads can't be killed, so the action keeps running
+                    and the interpreter waits for it before exiting.  It
+                    doesn't bound the hook, unless action_f bounds itself.
+    :type timeout: Optional[float]
+    :returns: OrderedDict of service: (success, seconds), in completion order
+    :rtype: OrderedDict[str, Tuple[bool, float]]
+    :raises: ValueError if the dependencies are circular
+    """
+    service_names = list(OrderedDict.fromkeys(service_names))
+    dependencies = dependencies or {}
+    waits_for = {s: set(d for d in dependencies.get(s, [])
+                        if d in service_names and d != s)
+                 for s in service_names}
+    if reverse:
+        waits_for = {s: set(t for t in service_names if s in waits_for[t])
+                     for s in service_names}
+    results = OrderedDict()
+    pending = list(service_names)
+    running = {}
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers or max(len(service_names), 1))
+    try:
+        while pending or running:
+            for service_name in list(pending):
+                if waits_for[service_name].issubset(results):
+                    pending.remove(service_name)
+                    future = executor.submit(_timed_service_action,
+                                             action_f, service_name)
+                    running[future] = (service_name, time.time())
+            if not running:
+                raise ValueError('Circular service dependencies between {}'
+                                 .format(', '.join(pending)))
+            wait = None
+            if timeout is not None:
+                wait = max(min(t for _, t in running.values()) + timeout -
+                           time.time(), 0)
+            done, _ = concurrent.futures.wait(
+                running, timeout=wait,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                service_name, _ = running.pop(future)
+                results[service_name] = future.result()
+            if timeout is not None:
+                now = time.time()
+                for future, (service_name, started) in list(running.items()):
+                    if now - started >= timeout:
+                        log('{} of {} timed out after {}s, no longer '
+                            'waiting for it'.format(
+                                getattr(action_f, '__name__', action_f),
+                                service_name, timeout), level=WARNING)
+                        del running[future]
+                        results[service_name] = (False, now - started)
+    finally:
+        executor.shutdown(wait=False)
+    log('Service timings: {}'.format(', '.join(
+        '{}={:.1f}s'.format(s, t) for s, (_, t) in results.items())),
+        level=INFO)
+    return results
+
+
 def init_is_systemd(service_name=None):
     """
     Returns whether the host uses systemd for the specified service.
@@ -746,7 +897,8 @@ class restart_on_change(object):
 
     def __init__(self, restart_map, stopstart=False, restart_functions=None,
                  can_restart_now_f=None, post_svc_restart_f=None,
-                 pre_restarts_wait_f=None):
+                 pre_restarts_wait_f=None, changed_files_f=None,
+                 section_map=None):
         """
         :param restart_map: {file: [service, ...]}
         :type restart_map: Dict[str, List[str,]]
@@ -763,6 +915,13 @@ class restart_on_change(object):
         :type post_svc_restart_f: Callable[[str], None]
         :param pre_restarts_wait_f: A function called before any restarts.
         :type pre_restarts_wait_f: Callable[None, None]
+        :param changed_files_f: A function returning the files known to have
+                                changed; when given, files are not hashed.
+        :type changed_files_f: Callable[[], Iterable[str]]
+        :param section_map: {file: {section: [service, ...]}} for INI files
+                            whose services are only restarted when a section
+                            they use changed.
+        :type section_map: Dict[str, Dict[str, List[str]]]
         """
         self.restart_map = restart_map
         self.stopstart = stopstart
@@ -770,6 +929,8 @@ class restart_on_change(object):
         self.can_restart_now_f = can_restart_now_f
         self.post_svc_restart_f = post_svc_restart_f
         self.pre_restarts_wait_f = pre_restarts_wait_f
+        self.changed_files_f = changed_files_f
+        self.section_map = section_map
 
     def __call__(self, f):
         """Work like a decorator.
@@ -790,12 +951,16 @@ class restart_on_change(object):
                 restart_functions=self.restart_functions,
                 can_restart_now_f=self.can_restart_now_f,
                 post_svc_restart_f=self.post_svc_restart_f,
-                pre_restarts_wait_f=self.pre_restarts_wait_f)
+                pre_restarts_wait_f=self.pre_restarts_wait_f,
+                changed_files_f=self.changed_files_f,
+                section_map=self.section_map)
         return wrapped_f
 
     def __enter__(self):
         """Enter the runtime context related to this object. """
-        self.checksums = _pre_restart_on_change_helper(self.restart_map)
+        self.checksums = _pre_restart_on_change_helper(
+            self.restart_map, changed_files_f=self.changed_files_f,
+            section_map=self.section_map)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Exit the runtime context related to this object.
@@ -812,7 +977,9 @@ class restart_on_change(object):
                 restart_functions=self.restart_functions,
                 can_restart_now_f=self.can_restart_now_f,
                 post_svc_restart_f=self.post_svc_restart_f,
-                pre_restarts_wait_f=self.pre_restarts_wait_f)
+                pre_restarts_wait_f=self.pre_restarts_wait_f,
+                changed_files_f=self.changed_files_f,
+                section_map=self.section_map)
         # All is good, so return False; any exceptions will propagate.
         return False
 
@@ -821,7 +988,9 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
                              restart_functions=None,
                              can_restart_now_f=None,
                              post_svc_restart_f=None,
-                             pre_restarts_wait_f=None):
+                             pre_restarts_wait_f=None,
+                             changed_files_f=None,
+                             section_map=None):
     """Helper function to perform the restart_on_change function.
 
     This is provided for decorators to restart services if files described
@@ -847,6 +1016,17 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
     occur. The use case for this is an application which wants to try and
     stagger restarts between units.
 
+    `changed_files_f` is a function returning the paths that have been changed
+    since it was last called, e.g. as tracked by a config renderer that only
+    writes files whose content differs.  When it is provided, no checksums
+    are taken and the files in the restart map are not read at all.
+
+    `section_map` maps INI style files of the restart map to
+    {section: [service, ...]}.  The sections of those files are compared
+    before and after lambda_f() and only the services of the sections that
+    changed are restarted; a changed section that isn't in the map restarts
+    all the services the restart map has for the file.
+
     :param lambda_f: function to call.
     :type lambda_f: Callable[[], ANY]
     :param restart_map: {file: [service, ...]}
@@ -864,10 +1044,17 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
     :type post_svc_restart_f: Callable[[str], None]
     :param pre_restarts_wait_f: A function called before any restarts.
     :type pre_restarts_wait_f: Callable[None, None]
+    :param changed_files_f: A function returning the files known to have
+                            changed.
+    :type changed_files_f: Callable[[], Iterable[str]]
+    :param section_map: {file: {section: [service, ...]}}
+    :type section_map: Dict[str, Dict[str, List[str]]]
     :returns: result of lambda_f()
     :rtype: ANY
     """
-    checksums = _pre_restart_on_change_helper(restart_map)
+    checksums = _pre_restart_on_change_helper(restart_map,
+                                              changed_files_f=changed_files_f,
+                                              section_map=section_map)
     r = lambda_f()
     _post_restart_on_change_helper(checksums,
                                    restart_map,
@@ -875,19 +1062,92 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
                                    restart_functions,
                                    can_restart_now_f,
                                    post_svc_restart_f,
-                                   pre_restarts_wait_f)
+                                   pre_restarts_wait_f,
+                                   changed_files_f,
+                                   section_map)
     return r
 
 
-def _pre_restart_on_change_helper(restart_map):
+def _pre_restart_on_change_helper(restart_map, changed_files_f=None,
+                                  section_map=None):
     """Take a snapshot of file hashes.
 
+    If changed_files_f is provided it is called to discard any changes
+    recorded before this point and no hashes are taken.  The files in
+    section_map are snapshotted by their INI sections instead.
+
     :param restart_map: {file: [service, ...]}
     :type restart_map: Dict[str, List[str,]]
-    :returns: Dictionary of file paths and the files checksum.
-    :rtype: Dict[str, str]
+    :param changed_files_f: A function returning the files known to have
+                            changed.
+    :type changed_files_f: Callable[[], Iterable[str]]
+    :param section_map: {file: {section: [service, ...]}}
+    :type section_map: Dict[str, Dict[str, List[str]]]
+    :returns: Dictionary of file paths and the files checksum, or sections.
+    :rtype: Dict[str, Union[str, Dict[str, List[str]]]]
+    """
+    section_map = section_map or {}
+    if changed_files_f:
+        changed_files_f()
+        checksums = {}
+    else:
+        checksums = {path: path_hash(path) for path in restart_map
+                     if path not in section_map}
+    for path in section_map:
+        if path in restart_map:
+            checksums[path] = ini_sections(path)
+    return checksums
+
+
+def ini_sections(path):
+    """Return the settings of each section of the INI file path.
+
+    Blank lines and comments are ignored so that only changes to the
+    settings are seen.
+
+    :param path: the INI file
+    :type path: str
+    :returns: {section: [line, ...]}, empty if the file doesn't exist
+    :rtype: Dict[str, List[str]]
     """
-    return {path: path_hash(path) for path in restart_map}
+    sections = OrderedDict()
+    try:
+        with open(path, 'r') as f:
+            lines = f.readlines()
+    except (IOError, OSError):
+        return sections
+    current = sections.setdefault('DEFAULT', [])
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith(('#', ';')):
+            continue
+        if line.startswith('[') and line.endswith(']'):
+            current = sections.setdefault(line[1:-1].strip(), [])
+        else:
+            current.append(line)
+    return sections
+
+
+def _changed_section_services(path, old_sections, services, section_map):
+    """Return the services using the sections of path that changed.
+
+    :param path: the INI file
+    :type path: str
+    :param old_sections: the sections of path before the change
+    :type old_sections: Dict[str, List[str]]
+    :param services: all the services restarted for path
+    :type services: List[str]
+    :param section_map: {section: [service, ...]} for path
+    :type section_map: Dict[str, List[str]]
+    :returns: the services to restart, in the order of services
+    :rtype: List[str]
+    """
+    new_sections = ini_sections(path)
+    affected = set()
+    for section in set(old_sections).union(new_sections):
+        if old_sections.get(section) != new_sections.get(section):
+            affected.update(section_map.get(section, services))
+    return [svc for svc in services if svc in affected]
 
 
 def _post_restart_on_change_helper(checksums,
@@ -896,7 +1156,9 @@ def _post_restart_on_change_helper(checksums,
                                    restart_functions=None,
                                    can_restart_now_f=None,
                                    post_svc_restart_f=None,
-                                   pre_restarts_wait_f=None):
+                                   pre_restarts_wait_f=None,
+                                   changed_files_f=None,
+                                   section_map=None):
     """Check whether files have changed.
 
     :param checksums: Dictionary of file paths and the files checksum.
@@ -916,14 +1178,36 @@ def _post_restart_on_change_helper(checksums,
     :type post_svc_restart_f: Callable[[str], None]
     :param pre_restarts_wait_f: A function called before any restarts.
     :type pre_restarts_wait_f: Callable[None, None]
+    :param changed_files_f: A function returning the files known to have
+                            changed; used instead of the checksums.
+    :type changed_files_f: Callable[[], Iterable[str]]
+    :param section_map: {file: {section: [service, ...]}}
+    :type section_map: Dict[str, Dict[str, List[str]]]
     """
     if restart_functions is None:
         restart_functions = {}
+    section_map = section_map or {}
+    if changed_files_f:
+        changed_paths = set(changed_files_f())
+
+        def _changed(path):
+            return path in changed_paths
+    else:
+        def _changed(path):
+            if path in section_map:
+                return True
+            return path_hash(path) != checksums[path]
     changed_files = defaultdict(list)
     restarts = []
     # create a list of lists of the services to restart
     for path, services in restart_map.items():
-        if path_hash(path) != checksums[path]:
+        if _changed(path):
+            if path in section_map:
+                services = _changed_section_services(
+                    path, checksums.get(path, {}), services,
+                    section_map[path])
+                if not services:
+                    continue
             restarts.append(services)
             for svc in services:
                 changed_files[svc].append(path)
@@ -160,6 +160,11 @@ import sys
 __author__ = 'Kapil Thangavelu <kapil.foss@gmail.com>'
 
 
+def _data_changed():
+    from charmhelpers.core import hookenv
+    hookenv.data_changed()
+
+
 class Storage(object):
     """Simple key value database for local unit state within charms.
 
@@ -244,6 +249,8 @@ class Storage(object):
         Remove a key from the database entirely.
         """
         self.cursor.execute('delete from kv where key=?', [key])
+        if self.cursor.rowcount:
+            _data_changed()
         if self.keep_revisions and self.revision and self.cursor.rowcount:
             self.cursor.execute(
                 'insert into kv_revisions values (?, ?, ?)',
@@ -258,6 +265,7 @@ class Storage(object):
         :param str prefix: Optional prefix to apply to all keys in ``keys``
             before removing.
         """
+        _data_changed()
         if keys is not None:
             keys = ['%s%s' % (prefix, key) for key in keys]
             self.cursor.execute('delete from kv where key in (%s)' % ','.join(['?'] * len(keys)), keys)
@@ -290,6 +298,7 @@ class Storage(object):
             if exists[0] == serialized:
                 return value
 
+        _data_changed()
         if not exists:
             self.cursor.execute(
                 'insert into kv (key, data) values (?, ?)',
@@ -381,6 +390,7 @@ class Storage(object):
             return
         else:
             self.conn.rollback()
+            _data_changed()
 
     def _init(self):
         self.cursor.execute('''
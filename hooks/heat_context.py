@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import OrderedDict
+
 from charmhelpers.contrib.openstack import context
 from charmhelpers.core.hookenv import (
     config,
@@ -25,6 +27,7 @@ from charmhelpers.contrib.hahelpers.cluster import (
     determine_api_port,
     https,
 )
+from charmhelpers.core.unitdata import kv
 
 HEAT_PATH = '/var/lib/heat/'
 API_PORTS = {
@@ -32,6 +35,27 @@ API_PORTS = {
     'heat-api': 8004
 }
 
+# Option setting the workers per CPU of each heat service, and the default
+# used when neither it nor worker-multiplier is set: heat-engine does the
+# convergence work while the APIs mostly hand requests over to it.
+WORKER_MULTIPLIERS = OrderedDict([
+    ('heat-engine', ('engine-worker-multiplier', 1.0)),
+    ('heat-api', ('api-worker-multiplier', 0.25)),
+    ('heat-api-cfn', ('api-cfn-worker-multiplier', 0.125)),
+])
+# Threads of each mod_wsgi daemon process of the heat APIs: the APIs mostly
+# wait on rpc calls to heat-engine.
+WSGI_THREADS = 4
+# Estimated resident memory of a worker of each heat service (bytes).
+WORKER_MEMORY = {
+    'heat-engine': 400 * 1024 * 1024,
+    'heat-api': 200 * 1024 * 1024,
+    'heat-api-cfn': 150 * 1024 * 1024,
+}
+# unitdata key of the haproxy server of the canary, weighted down while it
+# alone runs the new release of a canary upgrade.
+UPGRADE_WEIGHTS_KEY = 'heat-upgrade-weights'
+
 
 def generate_ec2_tokens(protocol, host, port):
     ec2_tokens = '%s://%s:%s/v2.0/ec2tokens' % (protocol, host, port)
@@ -109,6 +133,9 @@ class HeatHAProxyContext(context.OSContextGenerator):
             'backend_options': backend_options,
             'https': https(),
         }
+        canary = kv().get(UPGRADE_WEIGHTS_KEY)
+        if canary:
+            ctxt['server_weights'] = {canary: config('canary-weight')}
         return ctxt
 
 
@@ -161,6 +188,152 @@ class InstanceUserContext(context.OSContextGenerator):
         return ctxt
 
 
+def heat_workers():
+    """Return the number of worker processes of each heat service.
+
+    Each count follows the CPUs of the unit; the counts are then scaled
+    down together to fit the memory of the unit.
+
+    :returns: {service: workers} for each of WORKER_MULTIPLIERS
+    :rtype: OrderedDict[str, int]
+    """
+    counts = OrderedDict()
+    for service, (option, default_multiplier) in WORKER_MULTIPLIERS.items():
+        counts[service] = context._calculate_workers(
+            default_multiplier=default_multiplier,
+            multiplier=config(option),
+            service=service)
+    return context._fit_workers_to_memory(counts, WORKER_MEMORY)
+
+
+def service_workers(service):
+    """Return the number of worker processes of a heat service.
+
+    :param service: one of WORKER_MULTIPLIERS
+    :type service: str
+    :returns: the number of workers
+    :rtype: int
+    """
+    return heat_workers()[service]
+
+
+class HeatWorkerConfigContext(context.WorkerConfigContext):
+    """Sizes the heat-engine, heat-api and heat-api-cfn workers separately.
+    """
+
+    def __call__(self):
+        ctxt = super(HeatWorkerConfigContext, self).__call__()
+        workers = heat_workers()
+        ctxt.update({
+            'engine_workers': workers['heat-engine'],
+            'api_workers': workers['heat-api'],
+            'api_cfn_workers': workers['heat-api-cfn'],
+        })
+        return ctxt
+
+
+class HeatWSGIWorkerConfigContext(context.WSGIWorkerConfigContext):
+    """mod_wsgi daemon processes serving a heat API on its usual port.
+
+    :param service: heat-api or heat-api-cfn
+    :type service: str
+    """
+
+    def __init__(self, service):
+        super(HeatWSGIWorkerConfigContext, self).__init__(
+            name=service, script='/usr/bin/heat-wsgi-{}'.format(
+                service.replace('heat-', '')),
+            user='heat', group='heat')
+
+    def __call__(self):
+        ctxt = super(HeatWSGIWorkerConfigContext, self).__call__()
+        ctxt.update({
+            'port': determine_api_port(API_PORTS[self.service_name],
+                                       singlenode_mode=True),
+            'processes': service_workers(self.service_name),
+            'threads': WSGI_THREADS,
+        })
+        return ctxt
+
+
+def unit_count():
+    """Return the number of units of heat, this one and its cluster peers."""
+    return 1 + sum(len(related_units(rid)) for rid in relation_ids('cluster'))
+
+
+def database_pool(api_threads=1):
+    """Split database-connection-budget between the heat processes.
+
+    Every heat-engine worker and API process of every unit gets an equal
+    share of the budget, the peers being assumed to run as many workers as
+    this unit.  Half of a share is kept in the pool of the process and the
+    rest may be opened on demand as overflow.  The pool of an API process
+    holds at least api_threads connections, the requests it serves
+    concurrently, so the connections used may exceed a budget too small for
+    the processes.
+
+    :param api_threads: requests served concurrently by an API process
+    :type api_threads: int
+    :returns: {'budget', 'units', 'processes', 'max_pool_size',
+               'max_overflow', 'api_max_pool_size', 'api_max_overflow',
+               'connections'}, or {} without a budget
+    :rtype: Dict[str, int]
+    """
+    budget = config('database-connection-budget')
+    if not budget:
+        return {}
+    units = unit_count()
+    workers = heat_workers()
+    engine_processes = workers['heat-engine']
+    api_processes = sum(workers.values()) - engine_processes
+    processes = engine_processes + api_processes
+    share = budget // (units * processes)
+    max_pool_size = max(1, share // 2)
+    max_overflow = max(0, share - max_pool_size)
+    api_max_pool_size = max(api_threads, max_pool_size)
+    api_max_overflow = max(0, share - api_max_pool_size)
+    return {
+        'budget': budget,
+        'units': units,
+        'processes': processes,
+        'max_pool_size': max_pool_size,
+        'max_overflow': max_overflow,
+        'api_max_pool_size': api_max_pool_size,
+        'api_max_overflow': api_max_overflow,
+        'connections': units * (
+            engine_processes * (max_pool_size + max_overflow) +
+            api_processes * (api_max_pool_size + api_max_overflow)),
+    }
+
+
+class HeatDatabasePoolContext(context.OSContextGenerator):
+    """oslo.db connection pool limits within database-connection-budget.
+
+    Without api_threads the limits are those of a heat-engine worker, or of
+    a standalone API process serving one request at a time.
+
+    :param api_threads: requests served concurrently by the API processes
+                        reading the rendered file
+    :type api_threads: Optional[int]
+    """
+
+    def __init__(self, api_threads=None):
+        self.api_threads = api_threads
+
+    def __call__(self):
+        pool = database_pool(self.api_threads or 1)
+        if not pool:
+            return {}
+        prefix = 'api_' if self.api_threads else ''
+        return {
+            'database_max_pool_size': pool[prefix + 'max_pool_size'],
+            'database_max_overflow': pool[prefix + 'max_overflow'],
+            'database_pool_timeout': config('database-pool-timeout'),
+            'database_connection_recycle_time':
+                config('database-connection-recycle-time'),
+        }
+
+
 class QuotaConfigurationContext(context.OSContextGenerator):
     def __call__(self):
         ctxt = {"max_stacks_per_tenant": config('max-stacks-per-tenant')}
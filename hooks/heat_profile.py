@@ -0,0 +1,292 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import functools
+import json
+import os
+import subprocess
+import time
+
+from collections import OrderedDict
+
+from charmhelpers.contrib.openstack import templating
+from charmhelpers.core import host
+
+from charmhelpers.core.hookenv import (
+    cache_stats,
+    charm_dir,
+    config,
+    log,
+    INFO,
+    WARNING,
+)
+
+# Setting this environment variable profiles hooks regardless of the
+# profile-hooks config option.
+PROFILE_ENV = 'HEAT_PROFILE_HOOKS'
+PROFILE_FILE = 'hook-profiles.json'
+MAX_PROFILES = 50
+
+# Commands that are always reported, even if they weren't run.
+TRACKED_COMMANDS = [
+    'relation-get',
+    'config-get',
+    'leader-get',
+    'systemctl',
+    'nc',
+    'apt-cache',
+    'dpkg-query',
+]
+
+
+def profiling_enabled():
+    """Whether hook profiling has been requested.
+
+    :returns: True if HEAT_PROFILE_HOOKS is set or profile-hooks is True
+    :rtype: bool
+    """
+    if os.environ.get(PROFILE_ENV, '').lower() in ('1', 'true', 'yes'):
+        return True
+    return bool(config('profile-hooks'))
+
+
+def profile_path():
+    return os.path.join(charm_dir(), PROFILE_FILE)
+
+
+def process_start_time(default=None):
+    """Return the wall clock time at which this process was started.
+
+    :param default: time to use if psutil isn't available, defaults to now
+    :type default: Optional[float]
+    """
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).create_time()
+    except Exception:
+        return default or time.time()
+
+
+def _command_name(args):
+    if isinstance(args, (list, tuple)):
+        cmd = args[0] if args else ''
+    else:
+        cmd = args.split()[0] if args.strip() else ''
+    return os.path.basename(str(cmd))
+
+
+class HookProfiler(object):
+    """Records where the time of a hook execution is spent.
+
+    Time is accounted to the innermost active phase only, so the phases of a
+    profile add up to the total: e.g. the context generation done while
+    rendering a template is reported under 'context' and not 'render'.
+    Every subprocess started while the profiler is installed is counted and
+    timed by command name.
+
+    :param hook_name: name of the hook being profiled
+    :type hook_name: str
+    :param start: wall clock time the hook process started
+    :type start: Optional[float]
+    """
+
+    def __init__(self, hook_name, start=None):
+        self.hook_name = hook_name
+        self.start = start or time.time()
+        self.phases = OrderedDict()
+        self.commands = OrderedDict((c, {'count': 0, 'time': 0.0})
+                                    for c in TRACKED_COMMANDS)
+        self._stack = []
+        self._patches = []
+
+    def _account(self, name, elapsed):
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager accounting the time spent inside to phase name."""
+        now = time.time()
+        if self._stack:
+            parent = self._stack[-1]
+            self._account(parent[0], now - parent[1])
+        self._stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.time()
+            _name, since = self._stack.pop()
+            self._account(_name, now - since)
+            if self._stack:
+                self._stack[-1][1] = now
+
+    def record_command(self, args, elapsed):
+        """Account one run of the command args that took elapsed seconds."""
+        stats = self.commands.setdefault(_command_name(args),
+                                         {'count': 0, 'time': 0.0})
+        stats['count'] += 1
+        stats['time'] += elapsed
+
+    def _wrap(self, owner, attr, phase):
+        orig = getattr(owner, attr)
+
+        @functools.wraps(orig)
+        def wrapper(*args, **kwargs):
+            with self.phase(phase):
+                return orig(*args, **kwargs)
+
+        setattr(owner, attr, wrapper)
+        self._patches.append((owner, attr, orig))
+
+    def _popen_class(self):
+        profiler = self
+
+        class ProfiledPopen(subprocess.Popen):
+
+            def __init__(self, args, *pargs, **kwargs):
+                self._profile_args = args
+                self._profile_start = time.time()
+                self._profile_done = False
+                super(ProfiledPopen, self).__init__(args, *pargs, **kwargs)
+
+            def wait(self, timeout=None):
+                rc = super(ProfiledPopen, self).wait(timeout=timeout)
+                if not self._profile_done:
+                    self._profile_done = True
+                    profiler.record_command(
+                        self._profile_args,
+                        time.time() - self._profile_start)
+                return rc
+
+        return ProfiledPopen
+
+    def install(self):
+        """Start accounting phases and subprocesses."""
+        self._wrap(templating.OSConfigTemplate, 'context', 'context')
+        self._wrap(templating.OSConfigRenderer, 'render', 'render')
+        self._wrap(templating.OSConfigRenderer, 'write', 'write')
+        self._wrap(host, '_post_restart_on_change_helper', 'restart')
+        self._patches.append((subprocess, 'Popen', subprocess.Popen))
+        subprocess.Popen = self._popen_class()
+
+    def uninstall(self):
+        """Restore everything patched by install()."""
+        while self._patches:
+            owner, attr, orig = self._patches.pop()
+            setattr(owner, attr, orig)
+
+    def summary(self):
+        """Return the profile as a dict suitable for json.
+
+        :returns: {'hook', 'timestamp', 'total', 'phases', 'commands',
+                   'cache'}
+        :rtype: Dict[str, Any]
+        """
+        return {
+            'hook': self.hook_name,
+            'timestamp': self.start,
+            'total': round(time.time() - self.start, 4),
+            'phases': OrderedDict((k, round(v, 4))
+                                  for k, v in self.phases.items()),
+            'commands': OrderedDict(
+                (k, {'count': v['count'], 'time': round(v['time'], 4)})
+                for k, v in self.commands.items()),
+            'cache': cache_stats(),
+        }
+
+    def report(self):
+        """Log a one line summary and append the profile to the profile file.
+        """
+        summary = self.summary()
+        phases = ', '.join('{}={:.3f}s'.format(k, v)
+                           for k, v in summary['phases'].items())
+        commands = ', '.join('{}={}/{:.3f}s'.format(k, v['count'], v['time'])
+                             for k, v in summary['commands'].items()
+                             if v['count'])
+        log('Hook profile for {}: total={:.3f}s; {}; subprocesses: {}'
+            .format(self.hook_name, summary['total'], phases,
+                    commands or 'none'), level=INFO)
+        save_profile(summary)
+        return summary
+
+
+@contextlib.contextmanager
+def profiled(hook_name, start=None):
+    """Profile the enclosed block if profiling is enabled.
+
+    The time between the start of the process and entering the block is
+    accounted as the 'import' phase.  On exit the profile is logged and
+    saved to the profile file.
+
+    :param hook_name: name of the hook being profiled
+    :type hook_name: str
+    :param start: time taken when the hook module was imported, used as the
+                  start of the process if psutil can't tell
+    :type start: Optional[float]
+    :returns: the HookProfiler, or None if profiling is disabled
+    :rtype: Optional[HookProfiler]
+    """
+    if not profiling_enabled():
+        yield None
+        return
+    profiler = HookProfiler(hook_name, start=process_start_time(start))
+    profiler._account('import', time.time() - profiler.start)
+    profiler.install()
+    try:
+        yield profiler
+    finally:
+        profiler.uninstall()
+        try:
+            profiler.report()
+        except Exception as e:
+            log('Unable to save hook profile: {}'.format(str(e)),
+                level=WARNING)
+
+
+def profile_phase(profiler, name):
+    """Return a context manager accounting to phase name of profiler.
+
+    :param profiler: the active profiler or None
+    :type profiler: Optional[HookProfiler]
+    :param name: the phase name
+    :type name: str
+    """
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.phase(name)
+
+
+def load_profiles(path=None):
+    """Return the saved hook profiles, oldest first."""
+    path = path or profile_path()
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return []
+
+
+def save_profile(summary, path=None):
+    """Append summary to the saved profiles, keeping the last MAX_PROFILES.
+    """
+    path = path or profile_path()
+    profiles = load_profiles(path)
+    profiles.append(summary)
+    with open(path, 'w') as f:
+        json.dump(profiles[-MAX_PROFILES:], f)
+
+
+def last_profiles(count):
+    """Return the count most recent hook profiles, newest first."""
+    return list(reversed(load_profiles()[-count:])) if count > 0 else []
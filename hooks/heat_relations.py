@@ -18,6 +18,11 @@ import os
 import shutil
 import subprocess
 import sys
+import time
+
+# Taken before the imports below, which are most of the start up time of a
+# hook; reported as the 'import' phase of hook profiles.
+HOOK_START = time.time()
 
 from charmhelpers.core.hookenv import (
     Hooks,
@@ -80,19 +85,37 @@ from charmhelpers.contrib.openstack.ip import (
 )
 
 from heat_utils import (
+    advance_upgrade,
+    apply_upgrade_weights,
+    configure_api_wsgi,
     do_openstack_upgrade,
     restart_map,
+    restart_functions,
+    can_restart_now,
+    flush_pending_restarts,
+    grant_restart_slots,
+    peers_at_expected_scale,
+    peer_scale_pending,
     determine_packages,
     migrate_database,
+    release_db_revision_hold,
     register_configs,
     CLUSTER_RES,
     HEAT_CONF,
+    RELEASE_SETTING,
+    RESTART_SECTION_MAP,
     setup_ipv6,
+    upgrade_slot_granted,
+    upgrade_waiting,
     pause_unit_helper,
     resume_unit_helper,
     assess_status,
     remove_old_packages,
     services,
+    hardening_required,
+    record_hardening,
+    LazyConfigs,
+    LazyRestartMap,
 )
 
 from heat_context import (
@@ -100,6 +123,11 @@ from heat_context import (
     HEAT_PATH,
 )
 
+from heat_profile import (
+    profiled,
+    profile_phase,
+)
+
 from charmhelpers.contrib.charmsupport import nrpe
 from charmhelpers.contrib.hardening.harden import harden
 from charmhelpers.contrib.openstack.context import ADDRESS_TYPES
@@ -113,7 +141,11 @@ from charmhelpers.contrib.openstack.cert_utils import (
 import charmhelpers.contrib.openstack.policyd as policyd
 
 hooks = Hooks()
-CONFIGS = register_configs()
+# NOTE: both the renderer and the restart map are resolved on first use so
+# that hooks which never render configuration don't pay for them.  The
+# factories are looked up at resolution time rather than bound here.
+CONFIGS = LazyConfigs(lambda: register_configs())
+RESTART_MAP = LazyRestartMap(lambda: restart_map())
 
 
 @hooks.hook('install.real')
@@ -152,11 +184,15 @@ def restart_heat_api():
 
 
 @hooks.hook('config-changed')
-@restart_on_change(restart_map())
+@restart_on_change(RESTART_MAP, changed_files_f=CONFIGS.changed_files,
+                   section_map=RESTART_SECTION_MAP,
+                   restart_functions=restart_functions(),
+                   can_restart_now_f=can_restart_now)
 @harden()
 def config_changed():
     if not config('action-managed-upgrade'):
-        if openstack_upgrade_available('heat-common'):
+        if (openstack_upgrade_available('heat-common') and
+                upgrade_slot_granted()):
             status_set('maintenance', 'Running openstack upgrade')
             do_openstack_upgrade(CONFIGS)
 
@@ -168,6 +204,7 @@ def config_changed():
                                           relation_prefix='heat')
 
     CONFIGS.write_all()
+    configure_api_wsgi()
     configure_https()
     update_nrpe_config()
 
@@ -234,7 +271,10 @@ def amqp_joined(relation_id=None):
 
 
 @hooks.hook('amqp-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(RESTART_MAP, changed_files_f=CONFIGS.changed_files,
+                   section_map=RESTART_SECTION_MAP,
+                   restart_functions=restart_functions(),
+                   can_restart_now_f=can_restart_now)
 def amqp_changed():
     if 'amqp' not in CONFIGS.complete_contexts():
         log('amqp relation incomplete. Peer not ready?')
@@ -264,7 +304,10 @@ def db_joined():
 
 
 @hooks.hook('shared-db-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(RESTART_MAP, changed_files_f=CONFIGS.changed_files,
+                   section_map=RESTART_SECTION_MAP,
+                   restart_functions=restart_functions(),
+                   can_restart_now_f=can_restart_now)
 def db_changed():
     if is_db_maintenance_mode():
         log('Database maintenance mode, aborting hook.')
@@ -337,7 +380,10 @@ def identity_joined(rid=None):
 
 
 @hooks.hook('identity-service-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(RESTART_MAP, changed_files_f=CONFIGS.changed_files,
+                   section_map=RESTART_SECTION_MAP,
+                   restart_functions=restart_functions(),
+                   can_restart_now_f=can_restart_now)
 def identity_changed():
     if 'identity-service' not in CONFIGS.complete_contexts():
         log('identity-service relation incomplete. Peer not ready?')
@@ -371,6 +417,14 @@ def leader_elected():
                     .format(str(e)), level=WARNING)
 
 
+@hooks.hook('leader-settings-changed')
+def leader_settings_changed():
+    release_db_revision_hold()
+    if upgrade_waiting():
+        config_changed()
+    apply_upgrade_weights(CONFIGS)
+
+
 @hooks.hook('cluster-relation-joined')
 def cluster_joined(relation_id=None):
     settings = {}
@@ -383,14 +437,25 @@ def cluster_joined(relation_id=None):
             settings['{}-address'.format(addr_type)] = address
 
     settings['private-address'] = get_relation_ip('cluster')
+    settings[RELEASE_SETTING] = os_release('heat-common')
 
     relation_set(relation_id=relation_id, relation_settings=settings)
 
 
 @hooks.hook('cluster-relation-changed',
             'cluster-relation-departed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(RESTART_MAP, stopstart=True,
+                   changed_files_f=CONFIGS.changed_files,
+                   section_map=RESTART_SECTION_MAP,
+                   restart_functions=restart_functions(),
+                   can_restart_now_f=can_restart_now)
 def cluster_changed():
+    grant_restart_slots()
+    advance_upgrade()
+    apply_upgrade_weights(CONFIGS, reload=False)
+    if not peers_at_expected_scale():
+        log('Deferring peer configuration until all peers have joined')
+        return
     CONFIGS.write_all()
 
 
@@ -414,15 +479,26 @@ def ha_changed():
 
 @hooks.hook('heat-plugin-subordinate-relation-joined',
             'heat-plugin-subordinate-relation-changed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(RESTART_MAP, stopstart=True,
+                   changed_files_f=CONFIGS.changed_files,
+                   section_map=RESTART_SECTION_MAP,
+                   restart_functions=restart_functions(),
+                   can_restart_now_f=can_restart_now)
 def heat_plugin_subordinate_relation_joined(relid=None):
     CONFIGS.write_all()
 
 
 @hooks.hook('update-status')
-@harden()
 def update_status():
     log('Updating status.')
+    if hardening_required():
+        harden()(record_hardening)()
+    if peer_scale_pending():
+        cluster_changed()
+    release_db_revision_hold()
+    grant_restart_slots()
+    advance_upgrade()
+    apply_upgrade_weights(CONFIGS)
 
 
 @hooks.hook('certificates-relation-joined')
@@ -433,7 +509,11 @@ def certs_joined(relation_id=None):
 
 
 @hooks.hook('certificates-relation-changed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(RESTART_MAP, stopstart=True,
+                   changed_files_f=CONFIGS.changed_files,
+                   section_map=RESTART_SECTION_MAP,
+                   restart_functions=restart_functions(),
+                   can_restart_now_f=can_restart_now)
 def certs_changed(relation_id=None, unit=None):
     process_certificates('heat', relation_id, unit)
     configure_https()
@@ -468,11 +548,17 @@ def update_nrpe_config():
 
 
 def main():
-    try:
-        hooks.execute(sys.argv)
-    except UnregisteredHookError as e:
-        log('Unknown hook {} - skipping.'.format(e))
-    assess_status(CONFIGS)
+    hook_name = os.path.basename(sys.argv[0])
+    with profiled(hook_name, start=HOOK_START) as profiler:
+        with profile_phase(profiler, 'hook'):
+            try:
+                hooks.execute(sys.argv)
+            except UnregisteredHookError as e:
+                log('Unknown hook {} - skipping.'.format(e))
+        with profile_phase(profiler, 'restart'):
+            flush_pending_restarts()
+        with profile_phase(profiler, 'assess_status'):
+            assess_status(CONFIGS, use_cache=(hook_name == 'update-status'))
 
 
 if __name__ == '__main__':
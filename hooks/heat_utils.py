@@ -12,13 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import datetime
+import hashlib
+import glob
+import json
 import os
+import re
+import socket
+import time
+import urllib.error
+import urllib.request
 
 from copy import deepcopy
 from collections import OrderedDict
-from subprocess import check_call
-
-from charmhelpers.contrib.openstack import context, templating
+from collections.abc import Mapping
+from subprocess import check_call, check_output, CalledProcessError
+
+from charmhelpers.contrib.openstack import context, policy_rcd, templating
+from charmhelpers.contrib.openstack.deferred_events import (
+    ServiceEvent,
+    clear_deferred_restarts,
+    get_service_start_time,
+)
 
 from charmhelpers.contrib.openstack.utils import (
     configure_installation_source,
@@ -31,11 +47,21 @@ from charmhelpers.contrib.openstack.utils import (
     make_assess_status_func,
     pause_unit,
     resume_unit,
+    reset_os_release,
+    dpkg_status_stamp,
+    is_unit_paused_set,
+    is_unit_upgrading_set,
 )
 
 from charmhelpers.contrib.hahelpers.cluster import (
+    determine_api_port,
     get_hacluster_config,
     get_managed_services_and_ports,
+    is_elected_leader,
+)
+from charmhelpers.contrib.network.ip import (
+    established_connections,
+    ports_have_listeners,
 )
 
 
@@ -52,24 +78,51 @@ from charmhelpers.fetch import (
 from charmhelpers.core.hookenv import (
     log,
     config,
+    expected_peer_units,
+    goal_state,
+    is_leader,
+    leader_get,
+    leader_set,
+    local_unit,
+    related_units,
+    relation_get,
     relation_ids,
+    relation_set,
+    status_get,
+    status_set,
+    DEBUG,
+    WARNING,
 )
 
 from charmhelpers.core.host import (
     lsb_release,
+    run_service_actions,
+    services_running,
+    service_pause,
+    service_reload,
+    service_restart,
+    service_resume,
     service_start,
     service_stop,
     CompareHostReleases,
 )
 
+from charmhelpers.core.unitdata import kv
+
 from heat_context import (
     API_PORTS,
+    UPGRADE_WEIGHTS_KEY,
+    WSGI_THREADS,
+    database_pool,
+    HeatDatabasePoolContext,
     HeatIdentityServiceContext,
     HeatSecurityContext,
     InstanceUserContext,
     HeatApacheSSLContext,
     HeatHAProxyContext,
     HeatPluginContext,
+    HeatWorkerConfigContext,
+    HeatWSGIWorkerConfigContext,
     QuotaConfigurationContext,
 )
 
@@ -127,8 +180,69 @@ HTTPS_APACHE_CONF = '/etc/apache2/sites-available/openstack_https_frontend'
 HTTPS_APACHE_24_CONF = os.path.join('/etc/apache2/sites-available',
                                     'openstack_https_frontend.conf')
 ADMIN_OPENRC = '/root/admin-openrc-v3'
+# The apache site serving each heat API through mod_wsgi when api-wsgi is
+# set, in place of its standalone service.
+WSGI_SITES = OrderedDict([
+    ('heat-api', '/etc/apache2/sites-available/wsgi-heat-api.conf'),
+    ('heat-api-cfn', '/etc/apache2/sites-available/wsgi-heat-api-cfn.conf'),
+])
+WSGI_PACKAGES = ['libapache2-mod-wsgi-py3']
+# Read by the mod_wsgi heat APIs after heat.conf (oslo.config looks for
+# <prog>.conf), holding the settings only the API processes need.
+WSGI_API_CONFS = OrderedDict([
+    ('heat-api', '/etc/heat/heat-api.conf'),
+    ('heat-api-cfn', '/etc/heat/heat-api-cfn.conf'),
+])
 MEMCACHED_CONF = '/etc/memcached.conf'
 
+# unitdata keys used to skip work in update-status when nothing changed.
+STATUS_CACHE_KEY = 'heat-status-cache'
+HARDENING_STATE_KEY = 'heat-hardening-state'
+# A full status assessment is done at least this often (seconds).
+STATUS_CACHE_MAX_AGE = 3600
+# unitdata key of the heat service restarts held back by
+# restart-coalesce-window.
+PENDING_RESTARTS_KEY = 'heat-pending-restarts'
+# unitdata key of the time peer re-rendering started waiting for the peers
+# goal-state expects, and how long to wait for them (seconds).
+PEER_SCALE_WAIT_KEY = 'heat-peer-scale-wait'
+PEER_SCALE_TIMEOUT = 900
+# Leader setting holding the schema revision of the heat database, and the
+# unitdata key of the revision a non-leader holds its heat services for.
+DB_REVISION_KEY = 'heat-db-revision'
+DB_REVISION_WAIT_KEY = 'heat-db-revision-wait'
+# Actions of the heat services denied to the package scripts during an
+# upgrade: they are restarted once the database is migrated.
+UPGRADE_BLOCKED_ACTIONS = ['start', 'stop', 'restart', 'try-restart']
+HEAT_PKG_DIR = '/usr/lib/python3/dist-packages/heat'
+# sqlalchemy-migrate scripts up to 2023.1, alembic revisions after.
+HEAT_MIGRATE_SCRIPTS = 'db/sqlalchemy/migrate_repo/versions/[0-9]*_*.py'
+HEAT_ALEMBIC_SCRIPTS = ['db/migrations/versions/*.py',
+                        'db/sqlalchemy/migrations/versions/*.py']
+# unitdata key of the openstack-origin whose packages prepare_upgrade()
+# downloaded.
+PREPARED_UPGRADE_KEY = 'heat-prepared-upgrade'
+# Leader settings of a canary upgrade in progress: the openstack-origin
+# upgraded to, the units allowed to upgrade and why the rollout is paused.
+UPGRADE_ORIGIN_KEY = 'heat-upgrade-origin'
+UPGRADE_UNITS_KEY = 'heat-upgrade-units'
+UPGRADE_PAUSED_KEY = 'heat-upgrade-paused'
+# unitdata key recording whether the heat APIs were last set up to run under
+# mod_wsgi.
+WSGI_MODE_KEY = 'heat-api-wsgi'
+# unitdata keys of the haproxy counters when the last batch was allowed to
+# upgrade and whether this unit waits for its turn to upgrade.
+UPGRADE_ERRORS_KEY = 'heat-upgrade-errors'
+UPGRADE_WAIT_KEY = 'heat-upgrade-wait'
+# Cluster relation setting with the OpenStack release of each unit.
+RELEASE_SETTING = 'heat-release'
+# Number of heat-api requests timed to check the latency of the canary.
+CANARY_PROBES = 5
+UPGRADE_DPKG_OPTS = [
+    '--option', 'Dpkg::Options::=--force-confnew',
+    '--option', 'Dpkg::Options::=--force-confdef',
+]
+
 CONFIG_FILES = OrderedDict([
     (HEAT_CONF, {
         'services': BASE_SERVICES,
@@ -145,7 +259,8 @@ CONFIG_FILES = OrderedDict([
                      QuotaConfigurationContext(),
                      context.SyslogContext(),
                      context.LogLevelContext(),
-                     context.WorkerConfigContext(),
+                     HeatWorkerConfigContext(),
+                     HeatDatabasePoolContext(),
                      context.BindHostContext(),
                      context.MemcacheContext(),
                      context.OSConfigFlagContext(),
@@ -188,6 +303,72 @@ CONFIG_FILES = OrderedDict([
     }),
 ])
 
+# Services using each section of heat.conf; a change to any other section
+# (DEFAULT, database, oslo_messaging_*, keystone_authtoken, ...) restarts all
+# of the heat services.  apache2 runs the APIs when api-wsgi is set; only the
+# services the restart map lists for heat.conf are restarted.
+HEAT_CONF_SECTIONS = OrderedDict([
+    ('heat_api', ['heat-api', 'apache2']),
+    ('heat_api_cfn', ['heat-api-cfn', 'apache2']),
+    ('ec2_authtoken', ['heat-api-cfn', 'apache2']),
+    ('paste_deploy', ['heat-api', 'heat-api-cfn', 'apache2']),
+    ('clients', ['heat-engine']),
+    ('clients_heat', ['heat-engine']),
+    ('clients_keystone', ['heat-engine']),
+])
+
+RESTART_SECTION_MAP = {HEAT_CONF: HEAT_CONF_SECTIONS}
+
+# While its file exists the healthcheck middleware of a heat API reports
+# the unit as unavailable so that haproxy stops sending it requests.  The
+# api-paste.ini of queens and later releases enable it.
+HEALTHCHECK_DISABLE_FILES = OrderedDict([
+    ('heat-api', '/var/lib/heat/healthcheck-disable-heat-api'),
+    ('heat-api-cfn', '/var/lib/heat/healthcheck-disable-heat-api-cfn'),
+])
+HAPROXY_ADMIN_SOCKET = '/var/run/haproxy/admin.sock'
+# The haproxy backend of each API service.
+HAPROXY_BACKENDS = OrderedDict([
+    ('heat-api', 'heat_api'),
+    ('heat-api-cfn', 'heat_cfn_api'),
+])
+# haproxy marks a server down after 3 failed checks 2s apart (its defaults),
+# which applies to the haproxy of every peer; allow for a check in flight.
+HAPROXY_CHECK_WINDOW = 8
+# Longest time to wait for the in-flight requests of a drained unit.
+DRAIN_TIMEOUT = 60
+# Cluster relation setting of a unit asking for a restart slot, the leader
+# setting of the units holding one and the leader's unitdata key of when
+# they gave it back.  A slot given back is handed out again once the APIs
+# of its unit are healthy, or after RESTART_HEALTH_TIMEOUT seconds.
+RESTART_REQUEST_SETTING = 'heat-restart-request'
+RESTART_SLOTS_KEY = 'heat-restart-slots'
+RESTART_RELEASED_KEY = 'heat-restart-released'
+RESTART_HEALTH_TIMEOUT = 300
+
+# The services each service depends on: the frontends proxy to the APIs
+# (apache2 to haproxy) and the APIs cache tokens in memcached.  Services are
+# started after, and stopped before, the services they depend on; the others
+# are stopped and started concurrently.
+SERVICE_DEPENDENCIES = {
+    'heat-api': ['memcached'],
+    'heat-api-cfn': ['memcached'],
+    'haproxy': ['heat-api', 'heat-api-cfn'],
+    'apache2': ['haproxy'],
+}
+# Seconds after which run_service_actions() stops waiting for a service to
+# stop or start and counts it as failed.  The hook still waits for
+# systemctl to return before it exits.
+SERVICE_ACTION_TIMEOUT = 180
+
+# Services that can load a new configuration without dropping connections,
+# and the command doing so.  haproxy >= 1.8 runs in master-worker mode and
+# hands its listening sockets over to the new workers (expose-fd listeners).
+GRACEFUL_RELOAD = OrderedDict([
+    ('apache2', ['apache2ctl', 'graceful']),
+    ('haproxy', ['systemctl', 'reload', 'haproxy']),
+])
+
 
 def resource_map(release=None):
     """
@@ -205,9 +386,88 @@ def resource_map(release=None):
     if not enable_memcache(release=_release):
         _resource_map.pop(MEMCACHED_CONF)
 
+    if wsgi_enabled(_release):
+        # apache2 runs the APIs in place of their standalone services
+        for cfg in _resource_map.values():
+            svcs = [s for s in cfg['services'] if s not in WSGI_SITES]
+            if len(svcs) < len(cfg['services']) and 'apache2' not in svcs:
+                svcs.append('apache2')
+            cfg['services'] = svcs
+        for svc, site in WSGI_SITES.items():
+            _resource_map[site] = {
+                'contexts': [HeatWSGIWorkerConfigContext(svc)],
+                'services': ['apache2'],
+            }
+            _resource_map[WSGI_API_CONFS[svc]] = {
+                'contexts': [
+                    HeatDatabasePoolContext(api_threads=WSGI_THREADS)],
+                'services': ['apache2'],
+            }
+
     return _resource_map
 
 
+def wsgi_enabled(release=None):
+    """Whether the heat APIs run under Apache mod_wsgi.
+
+    :param release: the OpenStack release, defaults to the installed one
+    :type release: Optional[str]
+    :returns: True if api-wsgi is set and the release ships python3 heat
+    :rtype: bool
+    """
+    if not config('api-wsgi'):
+        return False
+    release = release or os_release('heat-common', base='icehouse')
+    return CompareOpenStackReleases(release) >= 'rocky'
+
+
+def api_threads(release=None):
+    """Return the requests an API process serves concurrently."""
+    return WSGI_THREADS if wsgi_enabled(release) else 1
+
+
+def configure_api_wsgi():
+    """Switch the heat APIs between their standalone services and mod_wsgi.
+
+    Going to mod_wsgi, which config-changed may do on a deployed unit,
+    WSGI_PACKAGES are installed and the apache2 module and sites enabled
+    first.  Only then are heat-api and heat-api-cfn stopped and disabled,
+    right before apache2 takes over their ports.  Going back, apache2
+    releases the ports and the WSGI_API_CONFS are removed before the
+    services are enabled and started again, unless the unit is paused.
+    Nothing is done if the mode didn't change.
+    """
+    db = kv()
+    enabled = wsgi_enabled()
+    if bool(db.get(WSGI_MODE_KEY)) == enabled:
+        return
+    sites = [os.path.splitext(os.path.basename(site))[0]
+             for site in WSGI_SITES.values()]
+    if enabled:
+        log('Running {} under mod_wsgi'.format(', '.join(WSGI_SITES)))
+        apt_install(WSGI_PACKAGES, fatal=True)
+        check_call(['a2enmod', 'wsgi'])
+        for site in sites:
+            check_call(['a2ensite', site])
+        for svc in WSGI_SITES:
+            service_pause(svc)
+        service_reload('apache2', restart_on_failure=True)
+    else:
+        log('Running {} as standalone services'
+            .format(', '.join(WSGI_SITES)))
+        for site in sites:
+            check_call(['a2dissite', site])
+        service_reload('apache2', restart_on_failure=True)
+        for conf in WSGI_API_CONFS.values():
+            if os.path.exists(conf):
+                os.remove(conf)
+        if not is_unit_paused_set():
+            for svc in WSGI_SITES:
+                service_resume(svc)
+    db.set(WSGI_MODE_KEY, enabled)
+    db.flush()
+
+
 def register_configs(release=None):
     """Register config files with their respective contexts.
     Regstration of some configs may not be required depending on
@@ -221,6 +481,85 @@ def register_configs(release=None):
     return configs
 
 
+class LazyConfigs(object):
+    """Proxy for the charm's OSConfigRenderer that is built on first use.
+
+    Hooks such as update-status or leader-settings-changed never render any
+    configuration, so there is no point in resolving the OpenStack release
+    and registering every context generator when the hook module is
+    imported.  The renderer is created by calling `factory` the first time
+    any attribute is accessed and then reused for the rest of the process.
+
+    :param factory: callable returning an OSConfigRenderer
+    :type factory: Callable[[], templating.OSConfigRenderer]
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._configs = None
+
+    def resolve(self):
+        """Return the underlying renderer, building it if required."""
+        if self._configs is None:
+            self._configs = self._factory()
+        return self._configs
+
+    def reset(self):
+        """Drop the renderer so that it is rebuilt on next use."""
+        self._configs = None
+
+    def changed_files(self):
+        """Return the files changed by the renderer since the last call.
+
+        Suitable for use as `changed_files_f` with restart_on_change; if the
+        renderer was never built nothing can have been written by it.
+
+        :returns: list of config files
+        :rtype: List[str]
+        """
+        if self._configs is None:
+            return []
+        return self._configs.changed_files()
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+
+class LazyRestartMap(Mapping):
+    """Read-only restart map that is only computed when first iterated.
+
+    A single instance can be shared between all the `restart_on_change`
+    decorators of the hooks module so that resource_map() is evaluated at
+    most once per hook execution, and only by hooks that actually need it.
+
+    :param factory: callable returning {file: [service, ...]}
+    :type factory: Callable[[], Dict[str, List[str]]]
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._map = None
+
+    def resolve(self):
+        """Return the underlying restart map, computing it if required."""
+        if self._map is None:
+            self._map = self._factory()
+        return self._map
+
+    def reset(self):
+        """Drop the restart map so that it is recomputed on next use."""
+        self._map = None
+
+    def __getitem__(self, key):
+        return self.resolve()[key]
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __len__(self):
+        return len(self.resolve())
+
+
 def api_port(service):
     return API_PORTS[service]
 
@@ -236,6 +575,9 @@ def determine_packages():
         packages = [p for p in packages if not p.startswith('python-')]
         packages.extend(PY3_PACKAGES)
 
+    if wsgi_enabled():
+        packages.extend(WSGI_PACKAGES)
+
     return list(set(packages))
 
 
@@ -266,14 +608,105 @@ def remove_old_packages():
     return bool(installed_packages)
 
 
-def do_openstack_upgrade(configs):
+@contextlib.contextmanager
+def upgrade_phase(timings, name):
+    """Record in timings the seconds spent in the enclosed block as name.
+
+    :param timings: where to record the time, or None
+    :type timings: Optional[Dict[str, float]]
+    :param name: the upgrade phase
+    :type name: str
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[name] = round(time.time() - start, 3)
+
+
+@contextlib.contextmanager
+def heat_restarts_denied():
+    """Keep the package scripts from starting or stopping the heat services.
+
+    A policy-rc.d policy denies them UPGRADE_BLOCKED_ACTIONS in the
+    enclosed block, so that upgraded packages don't restart the services
+    before the database is migrated: migrate_database() and
+    hold_for_db_revision() restart them.  The restarts denied meanwhile
+    aren't kept as deferred events.
+    """
+    svcs = heat_services()
+    policy_rcd.install_policy_rcd()
+    for svc in svcs:
+        policy_rcd.add_policy_block(svc, UPGRADE_BLOCKED_ACTIONS)
+    try:
+        yield
+    finally:
+        policy_rcd.remove_policy_file()
+        clear_deferred_restarts(svcs)
+
+
+def pending_downloads(packages):
+    """Return the packages an upgrade would still have to download.
+
+    :param packages: the packages to install besides the dist-upgrade
+    :type packages: List[str]
+    :returns: the uris of the .debs not in the apt cache
+    :rtype: List[str]
+    """
+    uris = []
+    for action in (['dist-upgrade'], ['install'] + list(packages)):
+        out = check_output(['apt-get', '--assume-yes', '--print-uris',
+                            '-qq'] + UPGRADE_DPKG_OPTS + action,
+                           universal_newlines=True)
+        uris.extend(line.split()[0].strip("'")
+                    for line in out.splitlines() if line.startswith("'"))
+    return uris
+
+
+def prepare_upgrade(timings=None):
+    """Download the packages of an upgrade to openstack-origin.
+
+    The services keep running: the .debs are only fetched into the apt
+    cache and checked to be all there, so that do_openstack_upgrade() only
+    has to unpack and configure them.
+
+    :param timings: where to record the seconds spent in each phase
+    :type timings: Optional[Dict[str, float]]
+    :raises: Exception if some packages could not be downloaded
+    """
+    new_src = config('openstack-origin')
+    log('Downloading the packages of the upgrade to {}'.format(new_src))
+    with upgrade_phase(timings, 'update'):
+        configure_installation_source(new_src)
+        apt_update(fatal=True)
+    packages = determine_packages()
+    download_opts = UPGRADE_DPKG_OPTS + ['--download-only']
+    with upgrade_phase(timings, 'download'):
+        apt_upgrade(options=download_opts, fatal=True, dist=True)
+        apt_install(packages=packages, options=download_opts, fatal=True)
+    with upgrade_phase(timings, 'verify'):
+        missing = pending_downloads(packages)
+    if missing:
+        raise Exception('Packages missing from the apt cache: {}'
+                        .format(', '.join(missing)))
+    db = kv()
+    db.set(PREPARED_UPGRADE_KEY, new_src)
+    db.flush()
+
+
+def do_openstack_upgrade(configs, timings=None):
     """Perform an uprade of heat.
 
     Takes care of upgrading packages,
     rewriting configs and potentially any other post-upgrade
-    actions.
+    actions.  If prepare_upgrade() already downloaded the packages for
+    openstack-origin the apt indexes aren't updated again, so that the
+    downloaded packages are the ones installed.
 
     :param configs: The charms main OSConfigRenderer object.
+    :param timings: where to record the seconds spent in each phase
+    :type timings: Optional[Dict[str, float]]
 
     """
     new_src = config('openstack-origin')
@@ -281,22 +714,34 @@ def do_openstack_upgrade(configs):
 
     log('Performing OpenStack upgrade to %s.' % (new_os_rel))
 
-    configure_installation_source(new_src)
-    dpkg_opts = [
-        '--option', 'Dpkg::Options::=--force-confnew',
-        '--option', 'Dpkg::Options::=--force-confdef',
-    ]
-    apt_update()
-    apt_upgrade(options=dpkg_opts, fatal=True, dist=True)
-    apt_install(packages=determine_packages(), options=dpkg_opts, fatal=True)
-
-    remove_old_packages()
+    db = kv()
+    with upgrade_phase(timings, 'update'):
+        configure_installation_source(new_src)
+        if db.get(PREPARED_UPGRADE_KEY) == new_src:
+            log('Installing the packages downloaded by prepare-upgrade')
+        else:
+            apt_update()
+    with upgrade_phase(timings, 'install'), heat_restarts_denied():
+        apt_upgrade(options=UPGRADE_DPKG_OPTS, fatal=True, dist=True)
+        apt_install(packages=determine_packages(),
+                    options=UPGRADE_DPKG_OPTS, fatal=True)
+        db.unset(PREPARED_UPGRADE_KEY)
+        db.flush()
+
+        remove_old_packages()
+    # the installed packages changed so drop any cached release codename.
+    reset_os_release()
 
     # set CONFIGS to load templates from new release and regenerate config
-    configs.set_release(openstack_release=new_os_rel)
-    configs.write_all()
+    with upgrade_phase(timings, 'configure'):
+        configs.set_release(openstack_release=new_os_rel)
+        configs.write_all()
 
-    migrate_database()
+    with upgrade_phase(timings, 'migrate'):
+        if is_elected_leader(CLUSTER_RES):
+            migrate_database()
+        else:
+            hold_for_db_revision()
 
 
 def restart_map():
@@ -311,6 +756,729 @@ def restart_map():
                         if v['services']])
 
 
+def restart_functions():
+    """Determine the restart_functions to be passed to
+    charmhelpers.core.restart_on_change() so that the frontends are reloaded
+    gracefully rather than restarted.
+
+    :returns: dict: A dictionary mapping services to restart functions.
+    """
+    functions = {svc: graceful_restart for svc in GRACEFUL_RELOAD}
+    functions.update({svc: drained_restart for svc in HAPROXY_BACKENDS})
+    return functions
+
+
+def service_binary_replaced(pid):
+    """Whether the executable of process pid was replaced since it started,
+    as happens when its package is upgraded.
+
+    :param pid: the process id
+    :type pid: int
+    :rtype: bool
+    """
+    try:
+        exe = os.readlink('/proc/{}/exe'.format(pid))
+    except OSError:
+        return False
+    return exe.endswith(' (deleted)')
+
+
+def graceful_restart(service_name):
+    """Reload service_name without dropping its connections.
+
+    The service is fully restarted instead if it isn't running, if it was
+    upgraded since it started (a reload doesn't load the new binary) or if
+    the reload fails.
+
+    :param service_name: a service of GRACEFUL_RELOAD
+    :type service_name: str
+    """
+    pid = service_main_pids([service_name]).get(service_name)
+    if pid and not service_binary_replaced(pid):
+        try:
+            check_call(GRACEFUL_RELOAD[service_name])
+            return
+        except CalledProcessError:
+            log('Graceful reload of {} failed, restarting it'
+                .format(service_name))
+    service_restart(service_name)
+
+
+def haproxy_command(command, socket_path=HAPROXY_ADMIN_SOCKET):
+    """Run command on the admin socket of local haproxy.
+
+    :param command: the haproxy runtime API command
+    :type command: str
+    :param socket_path: the haproxy admin socket
+    :type socket_path: str
+    :returns: the output of the command
+    :rtype: str
+    :raises: socket.error, OSError if haproxy can't be queried
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(5)
+        sock.connect(socket_path)
+        sock.sendall('{}\n'.format(command).encode('UTF-8'))
+        data = b''
+        while True:
+            chunk = sock.recv(8192)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return data.decode('UTF-8')
+
+
+def haproxy_stats(socket_path=HAPROXY_ADMIN_SOCKET):
+    """Return the statistics of local haproxy.
+
+    :param socket_path: the haproxy admin socket
+    :type socket_path: str
+    :returns: a {column: value} dict for each proxy and server
+    :rtype: List[Dict[str, str]]
+    :raises: socket.error, OSError if haproxy can't be queried
+    """
+    lines = haproxy_command('show stat', socket_path).splitlines()
+    if not lines or not lines[0].startswith('# '):
+        return []
+    header = lines[0][2:].split(',')
+    return [dict(zip(header, line.split(','))) for line in lines[1:] if line]
+
+
+def haproxy_server_states(socket_path=HAPROXY_ADMIN_SOCKET):
+    """Return the state of the local unit in each backend of local haproxy.
+
+    :param socket_path: the haproxy admin socket
+    :type socket_path: str
+    :returns: {backend: (status, current sessions)}
+    :rtype: Dict[str, Tuple[str, int]]
+    :raises: socket.error, OSError if haproxy can't be queried
+    """
+    server = local_unit().replace('/', '-')
+    return {row['pxname']: (row.get('status', ''), int(row.get('scur') or 0))
+            for row in haproxy_stats(socket_path)
+            if row.get('svname') == server}
+
+
+def _drained(backends, ports):
+    """Whether the backends of this unit get no more requests."""
+    try:
+        states = haproxy_server_states()
+    except (socket.error, OSError):
+        states = {}
+    for backend, (status, sessions) in states.items():
+        if not backend.startswith(tuple(backends)):
+            continue
+        if not status.startswith(('DOWN', 'MAINT', 'NOLB')) or sessions:
+            return False
+    try:
+        return not established_connections(ports)
+    except (IOError, OSError):
+        return True
+
+
+def drain_unit(svcs):
+    """Stop haproxy sending requests to the API services of this unit.
+
+    The healthcheck middleware of the services is disabled with their
+    HEALTHCHECK_DISABLE_FILES, then this waits (at most DRAIN_TIMEOUT
+    seconds) until the haproxy of every peer has had time to mark the unit
+    down, the local haproxy reports it down with no active sessions, and no
+    connections to the API services are left.  Nothing is done without
+    peers to take over the requests, or before queens, whose healthcheck
+    can't be disabled.
+
+    :param svcs: the services about to be stopped
+    :type svcs: List[str]
+    :returns: True if the unit was drained
+    :rtype: bool
+    """
+    if 'apache2' in svcs and wsgi_enabled():
+        svcs = list(WSGI_SITES)
+    svcs = [s for s in svcs if s in HAPROXY_BACKENDS]
+    if not svcs or not any(related_units(rid)
+                           for rid in relation_ids('cluster')):
+        return False
+    release = os_release('heat-common', base='icehouse')
+    if CompareOpenStackReleases(release) < 'queens':
+        return False
+    for svc in svcs:
+        with open(HEALTHCHECK_DISABLE_FILES[svc], 'w'):
+            pass
+    backends = [HAPROXY_BACKENDS[s] for s in svcs]
+    ports = [determine_api_port(api_port(s), singlenode_mode=True)
+             for s in svcs]
+    log('Draining {}'.format(', '.join(svcs)))
+    start = time.time()
+    while True:
+        elapsed = time.time() - start
+        if elapsed >= HAPROXY_CHECK_WINDOW and _drained(backends, ports):
+            break
+        if elapsed >= DRAIN_TIMEOUT:
+            log('{} not drained within {}s'
+                .format(', '.join(svcs), DRAIN_TIMEOUT), level=WARNING)
+            break
+        time.sleep(1)
+    return True
+
+
+def undrain_unit(svcs=None):
+    """Let haproxy send requests to the API services of this unit again.
+
+    :param svcs: the services to undrain, all of them by default
+    :type svcs: Optional[List[str]]
+    """
+    for svc in svcs or HEALTHCHECK_DISABLE_FILES:
+        if os.path.exists(HEALTHCHECK_DISABLE_FILES[svc]):
+            os.remove(HEALTHCHECK_DISABLE_FILES[svc])
+
+
+def drained_restart(service_name):
+    """Restart an API service once its in-flight requests have completed.
+
+    :param service_name: a service of HAPROXY_BACKENDS
+    :type service_name: str
+    """
+    drain_unit([service_name])
+    try:
+        service_restart(service_name)
+    finally:
+        undrain_unit([service_name])
+
+
+def _unit_number(unit):
+    return int(unit.split('/')[-1])
+
+
+def peers_healthy(units):
+    """Whether local haproxy sees the API services of units as UP.
+
+    :param units: the unit names
+    :type units: List[str]
+    :returns: True if they are, or if haproxy can't be queried
+    :rtype: bool
+    """
+    servers = set(u.replace('/', '-') for u in units)
+    try:
+        stats = haproxy_stats()
+    except (socket.error, OSError):
+        return True
+    return all(row.get('status', '').startswith('UP')
+               for row in stats
+               if row.get('svname') in servers and
+               row.get('pxname', '').startswith(
+                   tuple(HAPROXY_BACKENDS.values())))
+
+
+def restart_slots_enabled():
+    """Whether the heat services restart only with a slot from the leader.
+
+    :returns: True if restart-batch-size is set and the unit has peers
+    :rtype: bool
+    """
+    return bool(config('restart-batch-size') and
+                any(related_units(rid) for rid in relation_ids('cluster')))
+
+
+def restart_slot_granted():
+    """Whether the leader gave this unit a restart slot."""
+    return local_unit() in (leader_get(RESTART_SLOTS_KEY) or '').split()
+
+
+def grant_restart_slots():
+    """Hand the restart slots out to the units asking for one.
+
+    Done by the leader: at most restart-batch-size units hold a slot at a
+    time, handed out in the order of their unit numbers.  A unit gives its
+    slot back by withdrawing its request once restarted.  The slot is then
+    handed out again when local haproxy sees the APIs of that unit UP, or
+    RESTART_HEALTH_TIMEOUT seconds later.
+
+    :returns: the units given a slot by this call
+    :rtype: List[str]
+    """
+    if not is_leader() or not restart_slots_enabled():
+        return []
+    rid = relation_ids('cluster')[0]
+    units = [local_unit()] + related_units(rid)
+    requests = [u for u in units
+                if relation_get(RESTART_REQUEST_SETTING, rid=rid, unit=u)]
+    slots = (leader_get(RESTART_SLOTS_KEY) or '').split()
+    db = kv()
+    released = db.get(RESTART_RELEASED_KEY, {})
+    now = time.time()
+    held = []
+    for unit in slots:
+        if unit not in units:
+            continue
+        if unit not in requests:
+            since = released.setdefault(unit, now)
+            if peers_healthy([unit]):
+                continue
+            if now - since >= RESTART_HEALTH_TIMEOUT:
+                log('{} not healthy {}s after restarting'
+                    .format(unit, RESTART_HEALTH_TIMEOUT), level=WARNING)
+                continue
+        held.append(unit)
+    db.set(RESTART_RELEASED_KEY,
+           {u: t for u, t in released.items()
+            if u in held and u not in requests})
+    db.flush()
+    waiting = sorted((u for u in requests if u not in held),
+                     key=_unit_number)
+    batch = waiting[:max(0, config('restart-batch-size') - len(held))]
+    if batch:
+        log('Allowing {} to restart'.format(', '.join(batch)))
+    if held + batch != slots:
+        leader_set({RESTART_SLOTS_KEY: ' '.join(held + batch) or None})
+    return batch
+
+
+def acquire_restart_slot():
+    """Ask the leader for a restart slot, unless already asked for.
+
+    :returns: whether this unit holds a slot
+    :rtype: bool
+    """
+    rid = relation_ids('cluster')[0]
+    if not relation_get(RESTART_REQUEST_SETTING, rid=rid, unit=local_unit()):
+        relation_set(relation_id=rid, relation_settings={
+            RESTART_REQUEST_SETTING: str(round(time.time()))})
+    grant_restart_slots()
+    if restart_slot_granted():
+        return True
+    log('Waiting for a restart slot from the leader', level=DEBUG)
+    return False
+
+
+def release_restart_slot():
+    """Give the restart slot of this unit back to the leader."""
+    for rid in relation_ids('cluster'):
+        relation_set(relation_id=rid,
+                     relation_settings={RESTART_REQUEST_SETTING: None})
+    grant_restart_slots()
+
+
+def coalesce_restart(service_name, changed_files):
+    """Hold back the restart of a heat service while restarts coalesce.
+
+    Used as the can_restart_now_f of restart_on_change.  When
+    restart-coalesce-window is set the restart of a heat service is recorded
+    in unitdata rather than done, and flush_pending_restarts() restarts it
+    once no restart was requested for that many seconds.
+
+    :param service_name: the service to restart
+    :type service_name: str
+    :param changed_files: the files whose change triggered the restart
+    :type changed_files: List[str]
+    :returns: whether the service should be restarted now
+    :rtype: bool
+    """
+    if service_name not in BASE_SERVICES:
+        return True
+    if not config('restart-coalesce-window'):
+        return True
+    _hold_restart(service_name, changed_files)
+    return False
+
+
+def _hold_restart(service_name, changed_files):
+    """Record a restart for flush_pending_restarts() to do."""
+    db = kv()
+    pending = db.get(PENDING_RESTARTS_KEY, {})
+    event = ServiceEvent(
+        timestamp=round(time.time()),
+        service=service_name,
+        reason='File(s) changed: {}'.format(
+            ', '.join(sorted(set(changed_files)))),
+        action='restart')
+    pending[service_name] = vars(event)
+    db.set(PENDING_RESTARTS_KEY, pending)
+    db.flush()
+    log('Holding back restart of {}: {}'.format(service_name, event.reason),
+        level=DEBUG)
+
+
+def can_restart_now(service_name, changed_files):
+    """Decide whether restart_on_change may restart a service now.
+
+    Used as its can_restart_now_f.  The heat services of a unit waiting for
+    the database migration (hold_for_db_revision()) aren't restarted: their
+    restart is done by release_db_revision_hold().  When restarts need a
+    slot from the leader (restart_slots_enabled()), those of the heat
+    services are left to flush_pending_restarts().  Other restarts go
+    through coalesce_restart().  The services in GRACEFUL_RELOAD are never
+    held back.
+
+    :param service_name: the service to restart
+    :type service_name: str
+    :param changed_files: the files whose change triggered the restart
+    :type changed_files: List[str]
+    :returns: whether the service should be restarted now
+    :rtype: bool
+    """
+    if service_name in BASE_SERVICES and db_revision_held():
+        log('Not restarting {} until the database is migrated to {}'
+            .format(service_name, db_revision_held()), level=DEBUG)
+        return False
+    if service_name in BASE_SERVICES and restart_slots_enabled():
+        _hold_restart(service_name, changed_files)
+        return False
+    return coalesce_restart(service_name, changed_files)
+
+
+def _restarted_since(service_name, timestamp):
+    try:
+        start_time = get_service_start_time(service_name)
+    except (CalledProcessError, OSError, ValueError):
+        return False
+    return bool(start_time and
+                start_time >= datetime.datetime.fromtimestamp(timestamp))
+
+
+def flush_pending_restarts(force=False):
+    """Do the restarts held back by can_restart_now().
+
+    The restarts are done once none was requested for
+    restart-coalesce-window seconds (immediately if it has since been unset
+    or force is True) and, with restart_slots_enabled(), once the leader
+    gave this unit a restart slot.  The slot is given back afterwards.
+    Services restarted in the meantime are skipped.  Nothing is done while
+    the unit is paused or waits for the database migration.
+
+    :param force: restart regardless of the coalescing window
+    :type force: bool
+    :returns: the services restarted
+    :rtype: List[str]
+    """
+    db = kv()
+    pending = db.get(PENDING_RESTARTS_KEY)
+    if not pending or is_unit_paused_set() or db_revision_held():
+        return []
+    window = config('restart-coalesce-window') or 0
+    latest = max(e['timestamp'] for e in pending.values())
+    if not force and window and time.time() - latest < window:
+        log('Restarts of {} held back until {}s without changes'
+            .format(', '.join(sorted(pending)), window), level=DEBUG)
+        return []
+    slot = restart_slots_enabled()
+    if slot and not acquire_restart_slot():
+        return []
+    restarted = []
+    for service_name in BASE_SERVICES:
+        event = pending.get(service_name)
+        if not event or _restarted_since(service_name, event['timestamp']):
+            continue
+        log('Restarting {} ({})'.format(service_name, event['reason']))
+        restart_functions().get(service_name, service_restart)(service_name)
+        restarted.append(service_name)
+    db.unset(PENDING_RESTARTS_KEY)
+    db.flush()
+    if slot:
+        release_restart_slot()
+    return restarted
+
+
+def peers_at_expected_scale():
+    """Check whether every peer juju expects has joined the cluster relation.
+
+    Used to render the peer dependent configuration (haproxy backends) once
+    for a scale-out rather than once per joining unit.  Peers being removed
+    aren't waited for, so a scale-in is rendered right away.  If the expected
+    peers haven't all joined PEER_SCALE_TIMEOUT seconds after the first
+    check that found them missing, the wait is given up.  Without a cluster
+    relation, or with a juju lacking goal-state, there is nothing to wait
+    for.
+
+    :returns: True if peer configuration should be rendered now
+    :rtype: bool
+    """
+    rids = relation_ids('cluster')
+    if not rids:
+        return True
+    try:
+        expected = expected_peers()
+    except NotImplementedError:
+        return True
+    missing = expected.difference(related_units(rids[0]))
+    db = kv()
+    if not missing:
+        if db.get(PEER_SCALE_WAIT_KEY) is not None:
+            db.unset(PEER_SCALE_WAIT_KEY)
+            db.flush()
+        return True
+    since = db.get(PEER_SCALE_WAIT_KEY)
+    if since is None:
+        db.set(PEER_SCALE_WAIT_KEY, time.time())
+        db.flush()
+    elif time.time() - since >= PEER_SCALE_TIMEOUT:
+        log('Peers {} did not join within {}s, not waiting any longer'
+            .format(', '.join(sorted(missing)), PEER_SCALE_TIMEOUT))
+        db.unset(PEER_SCALE_WAIT_KEY)
+        db.flush()
+        return True
+    log('Waiting for peers {} to join'.format(', '.join(sorted(missing))),
+        level=DEBUG)
+    return False
+
+
+def expected_peers():
+    """Return the peers goal-state expects to remain in the cluster.
+
+    goal-state keeps listing the units being removed, with the status
+    dying, until they are gone.
+
+    :returns: the expected peer units
+    :rtype: Set[str]
+    :raises: NotImplementedError with a juju lacking goal-state
+    """
+    expected = set(expected_peer_units())
+    units = goal_state()['units']
+    return {unit for unit in expected
+            if units.get(unit, {}).get('status') != 'dying'}
+
+
+def peer_scale_pending():
+    """Whether peer configuration was deferred by peers_at_expected_scale().
+
+    :rtype: bool
+    """
+    return kv().get(PEER_SCALE_WAIT_KEY) is not None
+
+
+def unit_releases():
+    """Return the OpenStack release of this unit and its peers.
+
+    :returns: {unit: release} for the units that published their release on
+              the cluster relation
+    :rtype: Dict[str, str]
+    """
+    releases = {local_unit(): os_release('heat-common')}
+    for rid in relation_ids('cluster'):
+        for unit in related_units(rid):
+            release = relation_get(RELEASE_SETTING, rid=rid, unit=unit)
+            if release:
+                releases[unit] = release
+    return releases
+
+
+def upgrade_slot_granted():
+    """Whether this unit may upgrade to openstack-origin now.
+
+    With canary-upgrade set, the leader starts a rollout when
+    openstack-origin changes and upgrades first, as the canary, while the
+    other units wait until advance_upgrade() lets them upgrade.
+
+    :returns: True if the unit may upgrade
+    :rtype: bool
+    """
+    db = kv()
+    if not config('canary-upgrade'):
+        db.unset(UPGRADE_WAIT_KEY)
+        return True
+    origin = config('openstack-origin')
+    if is_leader() and leader_get(UPGRADE_ORIGIN_KEY) != origin:
+        log('Starting canary upgrade to {}'.format(origin))
+        leader_set({UPGRADE_ORIGIN_KEY: origin,
+                    UPGRADE_UNITS_KEY: local_unit(),
+                    UPGRADE_PAUSED_KEY: None})
+        db.set(UPGRADE_ERRORS_KEY, api_request_counts())
+    granted = (leader_get(UPGRADE_ORIGIN_KEY) == origin and
+               local_unit() in (leader_get(UPGRADE_UNITS_KEY) or '').split())
+    if granted:
+        db.unset(UPGRADE_WAIT_KEY)
+    else:
+        log('Waiting for the leader to schedule the upgrade to {}'
+            .format(origin))
+        db.set(UPGRADE_WAIT_KEY, origin)
+    db.flush()
+    return granted
+
+
+def upgrade_waiting():
+    """Whether this unit waits for its turn to upgrade."""
+    return bool(kv().get(UPGRADE_WAIT_KEY))
+
+
+def api_request_counts():
+    """Return the requests and 5xx responses of the heat APIs so far.
+
+    :returns: (requests, 5xx responses) counted by the local haproxy, or
+              None if it can't be queried
+    :rtype: Optional[Tuple[int, int]]
+    """
+    try:
+        stats = haproxy_stats()
+    except (socket.error, OSError):
+        return None
+    rows = [r for r in stats
+            if r.get('svname') == 'BACKEND' and
+            r.get('pxname', '').startswith(tuple(HAPROXY_BACKENDS.values()))]
+    return (sum(int(r.get('req_tot') or 0) for r in rows),
+            sum(int(r.get('hrsp_5xx') or 0) for r in rows))
+
+
+def upgrade_error_rate():
+    """Return the share of heat API requests that failed since the last
+    batch of units was allowed to upgrade."""
+    baseline = kv().get(UPGRADE_ERRORS_KEY)
+    counts = api_request_counts()
+    if not baseline or not counts:
+        return 0.0
+    requests = counts[0] - baseline[0]
+    # haproxy counters restart from 0 when it restarts
+    if requests <= 0 or counts[1] < baseline[1]:
+        return 0.0
+    return (counts[1] - baseline[1]) / requests
+
+
+def canary_healthy():
+    """Check the heat-api latency and heat-engine liveness of this unit.
+
+    :returns: (healthy, reason it isn't)
+    :rtype: Tuple[bool, str]
+    """
+    if not all(services_running(['heat-engine'])):
+        return False, 'heat-engine is not running'
+    url = 'http://127.0.0.1:{}/'.format(
+        determine_api_port(api_port('heat-api'), singlenode_mode=True))
+    latencies = []
+    for _ in range(CANARY_PROBES):
+        start = time.time()
+        try:
+            urllib.request.urlopen(url, timeout=10).close()
+        except urllib.error.HTTPError as e:
+            # the version discovery document comes with 300 Multiple Choices
+            if e.code >= 500:
+                return False, 'heat-api answered {}'.format(e.code)
+        except (urllib.error.URLError, socket.error) as e:
+            return False, 'heat-api unreachable: {}'.format(e)
+        latencies.append((time.time() - start) * 1000)
+    latency = sorted(latencies)[len(latencies) // 2]
+    max_latency = config('canary-max-latency')
+    if max_latency and latency > max_latency:
+        return False, 'heat-api latency {:.0f}ms above {}ms'.format(
+            latency, max_latency)
+    return True, ''
+
+
+def pause_upgrade(reason):
+    """Stop letting units upgrade until the resume-upgrade action is run."""
+    log('Pausing the upgrade: {}'.format(reason), level=WARNING)
+    leader_set({UPGRADE_PAUSED_KEY: reason})
+    kv().unset(STATUS_CACHE_KEY)
+    kv().flush()
+
+
+def resume_upgrade():
+    """Resume a rollout paused by advance_upgrade()."""
+    leader_set({UPGRADE_PAUSED_KEY: None})
+    kv().set(UPGRADE_ERRORS_KEY, api_request_counts())
+    kv().flush()
+    advance_upgrade()
+
+
+def advance_upgrade():
+    """Let the next batch of units upgrade if the upgraded ones are healthy.
+
+    Done by the leader once all the units allowed to upgrade run the new
+    release and local haproxy sees their APIs UP.  When only the canary has
+    upgraded, its heat-api latency and heat-engine are checked as well.
+    The next upgrade-batch-size units are then allowed to upgrade, in the
+    order of their unit numbers.  The rollout is paused if more than
+    upgrade-max-error-rate of the API requests failed since the last batch.
+
+    :returns: the units allowed to upgrade by this call
+    :rtype: List[str]
+    """
+    if not config('canary-upgrade') or not is_leader():
+        return []
+    origin = leader_get(UPGRADE_ORIGIN_KEY)
+    if not origin or leader_get(UPGRADE_PAUSED_KEY):
+        return []
+    max_error_rate = config('upgrade-max-error-rate')
+    error_rate = upgrade_error_rate()
+    if max_error_rate and error_rate > max_error_rate:
+        pause_upgrade('heat API error rate {:.1%} above {:.1%}'.format(
+            error_rate, max_error_rate))
+        return []
+    target = get_os_codename_install_source(origin)
+    granted = (leader_get(UPGRADE_UNITS_KEY) or '').split()
+    releases = unit_releases()
+    if (any(releases.get(u) != target for u in granted) or
+            not peers_healthy(granted)):
+        return []
+    if granted == [local_unit()]:
+        healthy, reason = canary_healthy()
+        if not healthy:
+            pause_upgrade('canary {}: {}'.format(local_unit(), reason))
+            return []
+    units = [local_unit()]
+    for rid in relation_ids('cluster'):
+        units.extend(related_units(rid))
+    remaining = sorted((u for u in units if u not in granted),
+                       key=_unit_number)
+    db = kv()
+    if not remaining:
+        log('Canary upgrade to {} complete'.format(origin))
+        leader_set({UPGRADE_ORIGIN_KEY: None, UPGRADE_UNITS_KEY: None,
+                    UPGRADE_PAUSED_KEY: None})
+        db.unset(UPGRADE_ERRORS_KEY)
+        db.flush()
+        return []
+    batch = remaining[:config('upgrade-batch-size') or 1]
+    log('Allowing {} to upgrade to {}'.format(', '.join(batch), origin))
+    leader_set({UPGRADE_UNITS_KEY: ' '.join(granted + batch)})
+    db.set(UPGRADE_ERRORS_KEY, api_request_counts())
+    db.flush()
+    return batch
+
+
+def apply_upgrade_weights(configs, reload=True):
+    """Weight the canary down in local haproxy while it is verified.
+
+    While the canary is the only upgraded unit its servers get
+    canary-weight percent of the haproxy weight of the others, so it only
+    takes a share of the requests.  The weights are rendered into
+    haproxy.cfg by HeatHAProxyContext, so haproxy is only reloaded when the
+    canary changes and the weights outlive later reloads.
+
+    :param configs: the charm's OSConfigRenderer
+    :type configs: templating.OSConfigRenderer
+    :param reload: reload haproxy if haproxy.cfg changed; hooks decorated
+                   with restart_on_change leave the reload to the decorator
+    :type reload: bool
+    :returns: whether haproxy.cfg changed
+    :rtype: bool
+    """
+    db = kv()
+    if not config('canary-upgrade') and not db.get(UPGRADE_WEIGHTS_KEY):
+        return False
+    origin = leader_get(UPGRADE_ORIGIN_KEY)
+    granted = (leader_get(UPGRADE_UNITS_KEY) or '').split()
+    canary = granted[0] if origin and len(granted) == 1 else None
+    if canary and (unit_releases().get(canary) !=
+                   get_os_codename_install_source(origin)):
+        canary = None
+    weighted = canary.replace('/', '-') if canary else None
+    if weighted == db.get(UPGRADE_WEIGHTS_KEY):
+        return False
+    if weighted:
+        db.set(UPGRADE_WEIGHTS_KEY, weighted)
+    else:
+        db.unset(UPGRADE_WEIGHTS_KEY)
+    db.flush()
+    # HeatHAProxyContext may have been evaluated earlier in this hook
+    configs.reset_context_cache()
+    if not configs.write(HAPROXY_CONF):
+        return False
+    if reload:
+        graceful_restart('haproxy')
+    return True
+
+
 def services():
     """Returns a list of services associate with this charm"""
     _services = []
@@ -319,12 +1487,155 @@ def services():
     return list(set(_services))
 
 
+def heat_services():
+    """Return the heat services of this unit, i.e. those using the database.
+
+    This includes apache2 when it runs the heat APIs.
+    """
+    svcs = [s for s in services() if s in BASE_SERVICES]
+    if wsgi_enabled():
+        svcs.append('apache2')
+    return svcs
+
+
+def current_db_revision():
+    """Return the schema revision of the heat database.
+
+    :returns: the revision reported by heat-manage db_version, or None
+    :rtype: Optional[str]
+    """
+    try:
+        out = check_output(['heat-manage', 'db_version'],
+                           universal_newlines=True)
+    except (CalledProcessError, OSError) as e:
+        log('Unable to get the heat database revision: {}'.format(str(e)),
+            level=WARNING)
+        return None
+    lines = out.strip().splitlines()
+    return lines[-1].split()[0] if lines else None
+
+
+def expected_db_revision(pkg_dir=HEAT_PKG_DIR):
+    """Return the schema revision the installed heat packages migrate to.
+
+    This is the highest numbered sqlalchemy-migrate script or, for releases
+    using alembic, the revision no other revision is based on.
+
+    :param pkg_dir: directory of the installed heat python package
+    :type pkg_dir: str
+    :returns: the revision, or None if it can't be determined
+    :rtype: Optional[str]
+    """
+    scripts = glob.glob(os.path.join(pkg_dir, HEAT_MIGRATE_SCRIPTS))
+    if scripts:
+        return str(max(int(os.path.basename(s).split('_')[0])
+                       for s in scripts))
+    revisions, parents = set(), set()
+    for pattern in HEAT_ALEMBIC_SCRIPTS:
+        for script in glob.glob(os.path.join(pkg_dir, pattern)):
+            with open(script, 'r') as f:
+                text = f.read()
+            revision = re.search(r"^revision\s*=\s*['\"](\w+)['\"]", text,
+                                 re.M)
+            if revision:
+                revisions.add(revision.group(1))
+            parents.update(re.findall(
+                r"['\"](\w+)['\"]",
+                ''.join(re.findall(r"^down_revision\s*=\s*(.*)$", text,
+                                   re.M))))
+    heads = revisions - parents
+    if len(heads) != 1:
+        log('Unable to determine the heat database revision expected by '
+            'the installed packages', level=WARNING)
+        return None
+    return heads.pop()
+
+
 def migrate_database():
-    """Runs heat-manage to initialize a new database or migrate existing"""
+    """Runs heat-manage to initialize a new database or migrate existing.
+
+    Only the heat services of this unit are stopped: haproxy keeps
+    forwarding requests to the peers meanwhile.  The resulting schema
+    revision is published in leader settings, so that the peers holding
+    their heat services for it can start them.
+    """
     log('Migrating the heat database.')
-    [service_stop(s) for s in services()]
+    run_service_actions(service_stop, heat_services(), SERVICE_DEPENDENCIES,
+                        reverse=True, timeout=SERVICE_ACTION_TIMEOUT)
     check_call(['heat-manage', 'db_sync'])
-    [service_start(s) for s in services()]
+    revision = current_db_revision()
+    if revision and is_leader():
+        log('Publishing heat database revision {}'.format(revision))
+        leader_set({DB_REVISION_KEY: revision})
+    kv().unset(DB_REVISION_WAIT_KEY)
+    kv().flush()
+    run_service_actions(service_start, heat_services(), SERVICE_DEPENDENCIES,
+                        timeout=SERVICE_ACTION_TIMEOUT)
+
+
+def db_revision_current():
+    """Whether the leader published the revision the packages expect.
+
+    :returns: True if they match or the expected revision is unknown
+    :rtype: bool
+    """
+    expected = expected_db_revision()
+    return expected is None or leader_get(DB_REVISION_KEY) == expected
+
+
+def db_revision_held():
+    """Return the database revision the heat services of this unit wait
+    for, if hold_for_db_revision() holds back their restart."""
+    return kv().get(DB_REVISION_WAIT_KEY)
+
+
+def hold_for_db_revision():
+    """Restart the heat services of a non-leader for the upgraded packages.
+
+    If the leader hasn't yet migrated the database to the revision the
+    upgraded packages expect, the running heat services keep serving the
+    old code (heat_restarts_denied() kept the packages from restarting
+    them) and their restart is left to release_db_revision_hold(), once it
+    has.
+
+    :returns: whether the heat services were restarted
+    :rtype: bool
+    """
+    if db_revision_current():
+        run_service_actions(service_restart, heat_services(),
+                            SERVICE_DEPENDENCIES,
+                            timeout=SERVICE_ACTION_TIMEOUT)
+        return True
+    expected = expected_db_revision()
+    log('Restarting heat services once the leader migrates the database to '
+        'revision {}'.format(expected))
+    db = kv()
+    db.set(DB_REVISION_WAIT_KEY, expected)
+    db.flush()
+    return False
+
+
+def release_db_revision_hold():
+    """Restart the heat services held by hold_for_db_revision() if the
+    leader has published the expected database revision.
+
+    :returns: whether the heat services were restarted
+    :rtype: bool
+    """
+    expected = db_revision_held()
+    if not expected or not db_revision_current():
+        return False
+    log('Heat database at revision {}, restarting heat services'
+        .format(expected))
+    db = kv()
+    db.unset(DB_REVISION_WAIT_KEY)
+    db.flush()
+    if is_unit_paused_set():
+        return False
+    run_service_actions(service_restart, heat_services(),
+                        SERVICE_DEPENDENCIES,
+                        timeout=SERVICE_ACTION_TIMEOUT)
+    return True
 
 
 def setup_ipv6():
@@ -361,6 +1672,17 @@ def check_optional_relations(configs):
             return ('blocked',
                     'hacluster missing configuration: '
                     'vip, vip_iface, vip_cidr')
+    pool = database_pool(api_threads())
+    if pool and pool['connections'] > pool['budget']:
+        return ('blocked',
+                'database-connection-budget {budget} too small for '
+                '{processes} heat processes on {units} units'.format(**pool))
+    if upgrade_waiting():
+        return ('waiting', 'Waiting for the leader to schedule the upgrade')
+    if (config('canary-upgrade') and is_leader() and
+            leader_get(UPGRADE_PAUSED_KEY)):
+        return ('blocked', 'Upgrade paused: {}; run resume-upgrade'
+                .format(leader_get(UPGRADE_PAUSED_KEY)))
     # return 'unknown' as the lowest priority to not clobber an existing
     # status.
     return "unknown", ""
@@ -379,18 +1701,146 @@ def get_optional_interfaces():
     return optional_interfaces
 
 
-def assess_status(configs):
+def assess_status(configs, use_cache=False):
     """Assess status of current unit
     Decides what the state of the unit should be based on the current
     configuration.
     SIDE EFFECT: calls set_os_workload_status(...) which sets the workload
     status of the unit.
     Also calls status_set(...) directly if paused state isn't complete.
+
+    If use_cache is True and neither the charm config, the installed
+    packages nor the main processes of the services have changed since the
+    last full assessment done with use_cache, the workload status already
+    set is left as is.  This keeps update-status cheap.
     @param configs: a templating.OSConfigRenderer() object
+    @param use_cache: whether a cached assessment may be reused
     @returns None - this function is executed for its side-effect
     """
+    if use_cache and status_unchanged():
+        log('Nothing changed since last status assessment, skipping.',
+            level=DEBUG)
+        return
     assess_status_func(configs)()
+    report_database_budget()
     os_application_version_set(VERSION_PACKAGE)
+    if use_cache:
+        record_status()
+
+
+def report_database_budget():
+    """Add the database connections used by heat to an active status."""
+    pool = database_pool(api_threads())
+    if not pool:
+        return
+    state, message = status_get()
+    if state == 'active':
+        status_set(state, '{}, database connections {}/{}'.format(
+            message, pool['connections'], pool['budget']))
+
+
+def _status_fingerprint():
+    """Return a digest of the inputs to the workload status that don't
+    trigger a hook of their own when they change."""
+    state = [dict(config()), dpkg_status_stamp(), is_unit_paused_set(),
+             is_unit_upgrading_set()]
+    return hashlib.md5(json.dumps(state, sort_keys=True, default=str)
+                       .encode('UTF-8')).hexdigest()
+
+
+def service_main_pids(svcs):
+    """Return the main PID of each service using a single systemctl call.
+
+    :param svcs: service names
+    :type svcs: List[str]
+    :returns: {service: pid}, pid is 0 if the service isn't running.
+    :rtype: Dict[str, int]
+    """
+    if not svcs:
+        return {}
+    try:
+        out = check_output(['systemctl', 'show', '--property=MainPID',
+                            '--value'] + list(svcs)).decode('UTF-8')
+    except (CalledProcessError, OSError):
+        return {s: 0 for s in svcs}
+    pids = out.split()
+    if len(pids) != len(svcs):
+        return {s: 0 for s in svcs}
+    return {s: int(p) if p.isdigit() else 0 for s, p in zip(svcs, pids)}
+
+
+def status_ports():
+    """Return the ports haproxy and the heat APIs of this unit listen on."""
+    ports = set()
+    for svc in API_PORTS:
+        ports.add(api_port(svc))
+        ports.add(determine_api_port(api_port(svc), singlenode_mode=True))
+    return sorted(ports)
+
+
+def record_status():
+    """Remember the state the last full status assessment was made in.
+
+    Nothing is recorded unless all services have a main process and all
+    the API ports are listened on, so a unit with a stopped service or a
+    closed port is always fully assessed.
+    """
+    _services, _ = get_managed_services_and_ports(services(), [])
+    pids = service_main_pids(sorted(_services))
+    ports = status_ports()
+    db = kv()
+    if pids and all(pids.values()) and all(ports_have_listeners(ports)):
+        db.set(STATUS_CACHE_KEY, {
+            'fingerprint': _status_fingerprint(),
+            'pids': pids,
+            'ports': ports,
+            'timestamp': time.time(),
+        })
+    else:
+        db.unset(STATUS_CACHE_KEY)
+    db.flush()
+
+
+def status_unchanged():
+    """Check whether the last recorded status assessment is still valid.
+
+    :returns: True if config, packages and service processes are unchanged
+              and the API ports are still listened on.
+    :rtype: bool
+    """
+    cached = kv().get(STATUS_CACHE_KEY)
+    if not cached:
+        return False
+    if time.time() - cached['timestamp'] > STATUS_CACHE_MAX_AGE:
+        return False
+    if cached['fingerprint'] != _status_fingerprint():
+        return False
+    if not all(os.path.exists('/proc/{}'.format(pid))
+               for pid in cached['pids'].values()):
+        return False
+    return all(ports_have_listeners(cached.get('ports', [])))
+
+
+def hardening_required():
+    """Check whether hardening needs to be re-applied in update-status.
+
+    Hardening is re-run only if the harden config option or the installed
+    packages changed since hardening was last applied by update-status.
+
+    :returns: True if hardening should run
+    :rtype: bool
+    """
+    if not config('harden'):
+        return False
+    return kv().get(HARDENING_STATE_KEY) != [config('harden'),
+                                             dpkg_status_stamp()]
+
+
+def record_hardening():
+    """Remember the state hardening was last applied in."""
+    db = kv()
+    db.set(HARDENING_STATE_KEY, [config('harden'), dpkg_status_stamp()])
+    db.flush()
 
 
 def assess_status_func(configs):
@@ -427,6 +1877,7 @@ def pause_unit_helper(configs):
     @param configs: a templating.OSConfigRenderer() object
     @returns None - this function is executed for its side-effect
     """
+    drain_unit(services())
     _pause_resume_helper(pause_unit, configs)
 
 
@@ -437,6 +1888,7 @@ def resume_unit_helper(configs):
     @param configs: a templating.OSConfigRenderer() object
     @returns None - this function is executed for its side-effect
     """
+    undrain_unit()
     _pause_resume_helper(resume_unit, configs)
 
 
@@ -452,4 +1904,5 @@ def _pause_resume_helper(f, configs):
     _services, _ = get_managed_services_and_ports(services(), [])
     f(assess_status_func(configs),
       services=_services,
-      ports=None)
+      ports=None,
+      dependencies=SERVICE_DEPENDENCIES)
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
 
 from unittest import mock
@@ -46,6 +47,76 @@ class ResumeTestCase(CharmTestCase):
         self.resume_unit_helper.assert_called_once_with('test-config')
 
 
+class HookProfilesTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(HookProfilesTestCase, self).setUp(
+            actions, ["action_get", "action_set", "last_profiles"])
+
+    def test_hook_profiles(self):
+        self.action_get.return_value = 2
+        self.last_profiles.return_value = [{'hook': 'update-status'}]
+        actions.hook_profiles([])
+        self.last_profiles.assert_called_once_with(2)
+        self.action_set.assert_called_once_with(
+            {'profiles': json.dumps([{'hook': 'update-status'}], indent=2)})
+
+
+class PrepareUpgradeTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(PrepareUpgradeTestCase, self).setUp(
+            actions, ["action_set", "openstack_upgrade_available",
+                      "prepare_upgrade"])
+
+    def test_prepare_upgrade(self):
+        self.openstack_upgrade_available.return_value = True
+
+        def _prepare(timings):
+            timings['update'] = 1.5
+            timings['download'] = 42.0
+
+        self.prepare_upgrade.side_effect = _prepare
+        actions.prepare_upgrade_action([])
+        self.action_set.assert_has_calls([
+            mock.call({'outcome': 'packages downloaded'}),
+            mock.call({'timings.update': 1.5, 'timings.download': 42.0})])
+
+    def test_prepare_upgrade_unavailable(self):
+        self.openstack_upgrade_available.return_value = False
+        actions.prepare_upgrade_action([])
+        self.prepare_upgrade.assert_not_called()
+        self.action_set.assert_called_once_with(
+            {'outcome': 'no upgrade available'})
+
+
+class ResumeUpgradeTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(ResumeUpgradeTestCase, self).setUp(
+            actions, ["action_set", "is_leader", "leader_get",
+                      "resume_upgrade"])
+        self.is_leader.return_value = True
+
+    def test_resume_upgrade(self):
+        self.leader_get.side_effect = {
+            'heat-upgrade-paused': 'heat API error rate 9.0% above 5.0%',
+            'heat-upgrade-origin': 'cloud:focal-yoga'}.get
+        actions.resume_upgrade_action([])
+        self.resume_upgrade.assert_called_once_with()
+        self.action_set.assert_called_once_with(
+            {'outcome': 'resumed upgrade to cloud:focal-yoga'})
+
+    def test_resume_upgrade_not_paused(self):
+        self.leader_get.return_value = None
+        actions.resume_upgrade_action([])
+        self.resume_upgrade.assert_not_called()
+
+    def test_resume_upgrade_not_leader(self):
+        self.is_leader.return_value = False
+        self.assertRaises(Exception, actions.resume_upgrade_action, [])
+
+
 class MainTestCase(CharmTestCase):
 
     def setUp(self):
@@ -37,6 +37,7 @@ from test_utils import (
 )
 
 TO_PATCH = [
+    'action_set',
     'config_changed',
     'do_openstack_upgrade',
 ]
@@ -61,6 +62,8 @@ class TestHeatUpgradeActions(CharmTestCase):
 
         self.assertTrue(self.do_openstack_upgrade.called)
         self.assertTrue(self.config_changed.called)
+        self.assertIn('timings.config-changed',
+                      self.action_set.call_args[0][0])
 
     @patch('charmhelpers.contrib.openstack.utils.juju_log')
     @patch('charmhelpers.contrib.openstack.utils.config')
@@ -0,0 +1,131 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+
+from unittest.mock import patch
+
+from charmhelpers.contrib.hardening.host.checks import suid_sgid
+from charmhelpers.core import unitdata
+from test_utils import CharmTestCase
+
+
+class SUIDSGIDScanTests(CharmTestCase):
+
+    def setUp(self):
+        super(SUIDSGIDScanTests, self).setUp(suid_sgid, ['log'])
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def make_file(self, path, mode=0o755):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w'):
+            pass
+        os.chmod(path, mode)
+        return path
+
+    def test_find_paths_with_suid_sgid(self):
+        suid = self.make_file('usr/bin/suid', 0o4755)
+        sgid = self.make_file('usr/lib/deep/sgid', 0o2755)
+        self.make_file('usr/bin/plain')
+        os.symlink(suid, os.path.join(self.root, 'usr/link'))
+        os.makedirs(os.path.join(self.root, 'tmp'))
+        os.chmod(os.path.join(self.root, 'tmp'), 0o1777 | stat.S_ISGID)
+        self.assertEqual(suid_sgid.find_paths_with_suid_sgid(self.root),
+                         {suid, sgid})
+
+    def test_mode_change_found(self):
+        path = self.make_file('run/user/helper')
+        self.assertEqual(suid_sgid.find_paths_with_suid_sgid(self.root),
+                         set())
+        os.chmod(path, 0o4755)
+        self.assertEqual(suid_sgid.find_paths_with_suid_sgid(self.root),
+                         {path})
+        os.chmod(path, 0o755)
+        self.assertEqual(suid_sgid.find_paths_with_suid_sgid(self.root),
+                         set())
+
+    def test_pruned_paths(self):
+        proc = os.path.join(self.root, 'proc')
+        self.make_file('proc/1/exe', 0o4755)
+        dev_shm = self.make_file('dev/shm/dropped', 0o4755)
+        with patch.object(suid_sgid, 'PRUNE_PATHS', [proc]):
+            self.assertEqual(suid_sgid.find_paths_with_suid_sgid(self.root),
+                             {dev_shm})
+
+    def test_pseudo_filesystems_pruned(self):
+        sysfs = os.path.join(self.root, 'sys')
+        cgroup = os.path.join(self.root, 'sys fs', 'cgroup')
+        self.make_file('sys/kernel/suid', 0o4755)
+        self.make_file('sys fs/cgroup/sgid', 0o2755)
+        data = self.make_file('srv/data/suid', 0o4755)
+        mounts = os.path.join(self.root, 'mounts')
+        with open(mounts, 'w') as f:
+            f.write('overlay {} overlay rw 0 0\n'.format(self.root))
+            f.write('sysfs {} sysfs rw 0 0\n'.format(sysfs))
+            f.write('cgroup2 {} cgroup2 rw 0 0\n'.format(
+                cgroup.replace(' ', '\\040')))
+            f.write('/dev/sdb1 {} ext4 rw 0 0\n'.format(
+                os.path.dirname(data)))
+        with patch.object(suid_sgid, 'PROC_MOUNTS', mounts):
+            self.assertEqual(suid_sgid._pruned_paths(self.root),
+                             {'/proc', sysfs, cgroup})
+            self.assertEqual(suid_sgid.find_paths_with_suid_sgid(self.root),
+                             {data})
+
+    @patch.object(suid_sgid, '_find', wraps=suid_sgid._find)
+    def test_unchanged_package_trees_skipped(self, _find):
+        status = self.make_file('var/lib/dpkg/status', 0o644)
+        usr_bin = os.path.join(self.root, 'usr', 'bin')
+        suid = self.make_file('usr/bin/suid', 0o4755)
+        self.make_file('usr/lib/deep/plain')
+        with patch.object(suid_sgid, 'DPKG_STAMPS', [status]):
+            self.assertEqual(suid_sgid.find_paths_with_suid_sgid(self.root),
+                             {suid})
+            self.assertNotIn(usr_bin, _find.call_args[0][1])
+
+            # unchanged trees aren't descended into, their files are
+            # re-checked
+            sgid = self.make_file('usr/lib/deep/sgid', 0o2755)
+            self.assertEqual(suid_sgid.find_paths_with_suid_sgid(self.root),
+                             {suid})
+            self.assertIn(usr_bin, _find.call_args[0][1])
+            os.chmod(suid, 0o755)
+            self.assertEqual(suid_sgid.find_paths_with_suid_sgid(self.root),
+                             set())
+
+            # a package change rescans them
+            os.chmod(suid, 0o4755)
+            st = os.stat(status)
+            os.utime(status, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+            self.assertEqual(suid_sgid.find_paths_with_suid_sgid(self.root),
+                             {suid, sgid})
+
+            # and so does the periodic full scan
+            os.chmod(sgid, 0o755)
+            os.chmod(os.path.join(self.root, 'usr/lib/deep/plain'), 0o4755)
+            state = unitdata.kv().get(suid_sgid.SCAN_STATE_KEY)
+            state['full'] -= suid_sgid.FULL_SCAN_INTERVAL + 1
+            unitdata.kv().set(suid_sgid.SCAN_STATE_KEY, state)
+            self.assertEqual(suid_sgid.find_paths_with_suid_sgid(self.root),
+                             {suid, os.path.join(self.root,
+                                                 'usr/lib/deep/plain')})
+
+    def test_unreadable_root(self):
+        self.assertEqual(suid_sgid.find_paths_with_suid_sgid(
+            os.path.join(self.root, 'missing')), set())
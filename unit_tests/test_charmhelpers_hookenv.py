@@ -0,0 +1,186 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+from unittest.mock import patch
+
+from charmhelpers.core import hookenv
+from test_utils import CharmTestCase
+
+RELATION_DATA = {
+    ('amqp:1', 'rabbitmq/0'): {'hostname': '10.0.0.1', 'password': 'pw'},
+    ('amqp:1', 'rabbitmq/1'): {'hostname': '10.0.0.2'},
+    ('shared-db:2', 'mysql/0'): {'db_host': '10.0.0.3'},
+}
+
+
+class RelationGetTests(CharmTestCase):
+
+    def setUp(self):
+        super(RelationGetTests, self).setUp(hookenv, ['_relation_get'])
+        _cache = patch.object(hookenv, 'cache', hookenv.HookCache())
+        _cache.start()
+        self.addCleanup(_cache.stop)
+        _environ = patch.dict(os.environ, {'JUJU_RELATION_ID': 'amqp:1',
+                                           'JUJU_REMOTE_UNIT': 'rabbitmq/0'})
+        _environ.start()
+        self.addCleanup(_environ.stop)
+
+        def _relation_get(attribute=None, unit=None, rid=None, app=None):
+            settings = RELATION_DATA.get((rid, unit))
+            if attribute and settings is not None:
+                return settings.get(attribute)
+            return settings
+
+        self._relation_get.side_effect = _relation_get
+
+    def test_snapshot_of_remote_unit(self):
+        self.assertEqual(hookenv.relation_get('hostname'), '10.0.0.1')
+        self.assertEqual(hookenv.relation_get('password'), 'pw')
+        self.assertEqual(hookenv.relation_get(),
+                         {'hostname': '10.0.0.1', 'password': 'pw'})
+        self.assertEqual(hookenv.relation_get('hostname', rid='amqp:1'),
+                         '10.0.0.1')
+        self._relation_get.assert_called_once_with(unit='rabbitmq/0',
+                                                   rid='amqp:1')
+
+    def test_snapshot_of_given_unit(self):
+        self.assertEqual(
+            hookenv.relation_get('hostname', 'rabbitmq/1', 'amqp:1'),
+            '10.0.0.2')
+        self.assertIsNone(
+            hookenv.relation_get('password', 'rabbitmq/1', 'amqp:1'))
+        self.assertEqual(
+            hookenv.relation_get('db_host', 'mysql/0', 'shared-db:2'),
+            '10.0.0.3')
+        self.assertEqual(self._relation_get.call_count, 2)
+
+    def test_other_relation_without_unit(self):
+        # The remote unit of the hook isn't a unit of shared-db:2
+        hookenv.relation_get('db_host', rid='shared-db:2')
+        self._relation_get.assert_called_once_with(
+            attribute='db_host', unit=None, rid='shared-db:2', app=None)
+
+    def test_outside_relation_hook(self):
+        del os.environ['JUJU_RELATION_ID']
+        del os.environ['JUJU_REMOTE_UNIT']
+        hookenv.relation_get('hostname')
+        self._relation_get.assert_called_once_with(
+            attribute='hostname', unit=None, rid=None, app=None)
+
+    def test_app_data(self):
+        hookenv.relation_get('hostname', rid='amqp:1', app='rabbitmq')
+        self._relation_get.assert_called_once_with(
+            attribute='hostname', unit=None, rid='amqp:1', app='rabbitmq')
+
+    def test_missing_settings(self):
+        self.assertIsNone(
+            hookenv.relation_get('hostname', 'rabbitmq/9', 'amqp:1'))
+        self.assertIsNone(hookenv.relation_get(None, 'rabbitmq/9', 'amqp:1'))
+
+
+class HookCacheTests(CharmTestCase):
+
+    def setUp(self):
+        super(HookCacheTests, self).setUp(hookenv, [])
+        self.cache = hookenv.HookCache()
+        _cache = patch.object(hookenv, 'cache', self.cache)
+        _cache.start()
+        self.addCleanup(_cache.stop)
+        self.calls = []
+
+        @hookenv.cached
+        def lookup(rid, unit=None):
+            self.calls.append((rid, unit))
+            return [rid, unit]
+
+        @hookenv.cached
+        def settings(options):
+            self.calls.append(options)
+            return dict(options)
+
+        self.lookup = lookup
+        self.settings = settings
+
+    def test_cached(self):
+        self.assertEqual(self.lookup('amqp:1', unit='rabbitmq/0'),
+                         ['amqp:1', 'rabbitmq/0'])
+        self.lookup('amqp:1', unit='rabbitmq/0')
+        self.lookup('amqp:1', unit='rabbitmq/1')
+        # unhashable arguments are keyed on their json representation
+        self.settings({'vip': '10.0.0.10'})
+        self.settings({'vip': '10.0.0.10'})
+        self.assertEqual(self.calls, [('amqp:1', 'rabbitmq/0'),
+                                      ('amqp:1', 'rabbitmq/1'),
+                                      {'vip': '10.0.0.10'}])
+        self.assertEqual(len(self.cache), 3)
+
+    def test_flush_token(self):
+        self.lookup('amqp:1', unit='rabbitmq/0')
+        self.lookup('amqp:1', unit='rabbitmq/1')
+        self.lookup('amqp:2', unit='rabbitmq/1')
+        self.settings({'unit': 'rabbitmq/1'})
+        hookenv.flush('rabbitmq/1')
+        self.assertEqual(len(self.cache), 1)
+        self.lookup('amqp:1', unit='rabbitmq/0')
+        self.assertEqual(len(self.calls), 4)
+        self.lookup('amqp:2', unit='rabbitmq/1')
+        self.settings({'unit': 'rabbitmq/1'})
+        self.assertEqual(len(self.calls), 6)
+
+    def test_flush_prunes_indexes(self):
+        self.lookup('amqp:1', unit='rabbitmq/0')
+        self.lookup('amqp:2', unit='rabbitmq/1')
+        self.cache.flush('rabbitmq/0')
+        self.assertEqual(set(self.cache._by_token), {'amqp:2', 'rabbitmq/1'})
+        self.assertEqual(len(self.cache._by_func[self.lookup._wrapped]), 1)
+
+        self.cache.flush_function(self.lookup)
+        self.assertEqual(self.cache._by_token, {})
+        self.assertEqual(self.cache._by_func, {})
+        self.assertEqual(self.cache._key_tokens, {})
+        self.assertEqual(len(self.cache), 0)
+
+    def test_flush_function(self):
+        self.lookup('amqp:1')
+        self.settings({'unit': 'amqp:1'})
+        self.cache.flush_function(self.lookup)
+        self.lookup('amqp:1')
+        self.settings({'unit': 'amqp:1'})
+        self.assertEqual(len(self.calls), 3)
+
+    def test_cache_stats(self):
+        self.lookup('amqp:1')
+        self.lookup('amqp:1')
+        self.lookup('amqp:1')
+        self.settings({})
+        stats = hookenv.cache_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(
+            stats['functions'],
+            {self.lookup.__qualname__: {'hits': 2, 'misses': 1},
+             self.settings.__qualname__: {'hits': 0, 'misses': 1}})
+
+        self.cache.clear()
+        stats = hookenv.cache_stats()
+        self.assertEqual(stats['entries'], 0)
+        self.assertEqual(stats['hits'], 2)
+        # the counters returned are a copy
+        stats['functions'][self.lookup.__qualname__]['hits'] = 10
+        self.assertEqual(
+            hookenv.cache_stats()['functions'][self.lookup.__qualname__],
+            {'hits': 2, 'misses': 1})
@@ -0,0 +1,198 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from unittest.mock import patch, call
+
+from charmhelpers.core import host
+from test_utils import CharmTestCase
+
+SYSTEMCTL_SHOW = (
+    'ActiveState=active\nSubState=running\n\n'
+    'SubState=dead\nActiveState=inactive\n\n'
+    'ActiveState=reloading\nSubState=reload\n\n'
+    'ActiveState=failed\nSubState=failed\n')
+
+
+class ServicesRunningTests(CharmTestCase):
+
+    def setUp(self):
+        super(ServicesRunningTests, self).setUp(host, ['init_is_systemd'])
+        self.init_is_systemd.return_value = True
+
+    @patch.object(host.subprocess, 'call')
+    @patch.object(host.subprocess, 'check_output')
+    def test_services_running(self, check_output, _call):
+        check_output.return_value = SYSTEMCTL_SHOW.encode('UTF-8')
+        services = ['heat-api', 'heat-engine', 'haproxy', 'memcached']
+        self.assertEqual(host.services_running(services),
+                         [True, False, True, False])
+        check_output.assert_called_once_with(
+            ['systemctl', 'show', '--property=ActiveState,SubState'] +
+            services)
+        _call.assert_not_called()
+
+        # The same answers as systemctl is-active
+        _call.side_effect = [0, 3, 0, 3]
+        self.assertEqual([host.service_running(s) for s in services],
+                         [True, False, True, False])
+
+    @patch.object(host.subprocess, 'call')
+    @patch.object(host.subprocess, 'check_output')
+    def test_services_running_falls_back(self, check_output, _call):
+        check_output.side_effect = OSError
+        _call.side_effect = [0, 3]
+        self.assertEqual(host.services_running(['heat-api', 'haproxy']),
+                         [True, False])
+        _call.assert_has_calls([call(['systemctl', 'is-active', 'heat-api']),
+                                call(['systemctl', 'is-active', 'haproxy'])])
+
+
+SERVICES = ['heat-api', 'heat-api-cfn', 'heat-engine']
+# The services using each section, any other section restarts all of them.
+SECTIONS = {
+    'heat_api': ['heat-api', 'apache2'],
+    'heat_api_cfn': ['heat-api-cfn', 'apache2'],
+    'ec2_authtoken': ['heat-api-cfn', 'apache2'],
+    'paste_deploy': ['heat-api', 'heat-api-cfn', 'apache2'],
+    'clients': ['heat-engine'],
+    'clients_heat': ['heat-engine'],
+    'clients_keystone': ['heat-engine'],
+}
+
+HEAT_CONF_CONTENT = """[DEFAULT]
+debug = False
+
+[database]
+connection = mysql://heat@10.0.0.1/heat
+
+[keystone_authtoken]
+auth_type = password
+
+[ec2_authtoken]
+auth_uri = http://10.0.0.2:5000/v3
+
+[paste_deploy]
+api_paste_config = /etc/heat/api-paste.ini
+
+[heat_api]
+bind_port = 8004
+workers = 4
+
+[heat_api_cfn]
+bind_port = 8000
+workers = 4
+
+[clients]
+endpoint_type = internalURL
+
+[clients_heat]
+endpoint_type = publicURL
+
+[clients_keystone]
+auth_uri = http://10.0.0.2:5000
+"""
+
+
+class SectionRestartTests(CharmTestCase):
+
+    def setUp(self):
+        super(SectionRestartTests, self).setUp(host, [])
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.conf = os.path.join(self.tmpdir, 'heat.conf')
+        with open(self.conf, 'w') as f:
+            f.write(HEAT_CONF_CONTENT)
+
+    def _restarted(self, old, new, changed_files_f=None):
+        def _write():
+            with open(self.conf, 'w') as f:
+                f.write(HEAT_CONF_CONTENT.replace(old, new))
+
+        with patch.object(host, 'service') as service:
+            host.restart_on_change_helper(
+                _write, {self.conf: SERVICES},
+                changed_files_f=changed_files_f,
+                section_map={self.conf: SECTIONS})
+        return [c[0][1] for c in service.call_args_list]
+
+    def test_ini_sections(self):
+        sections = host.ini_sections(self.conf)
+        self.assertEqual(sections['heat_api'],
+                         ['bind_port = 8004', 'workers = 4'])
+        self.assertEqual(host.ini_sections(os.path.join(self.tmpdir, 'x')),
+                         {})
+
+    def test_section_restarts(self):
+        for section, old, new, expected in [
+                ('heat_api', 'bind_port = 8004\nworkers = 4',
+                 'bind_port = 8004\nworkers = 8',
+                 ['heat-api']),
+                ('heat_api_cfn', 'bind_port = 8000\nworkers = 4',
+                 'bind_port = 8000\nworkers = 8',
+                 ['heat-api-cfn']),
+                ('ec2_authtoken', 'http://10.0.0.2:5000/v3',
+                 'http://10.0.0.3:5000/v3',
+                 ['heat-api-cfn']),
+                ('paste_deploy', 'api-paste.ini', 'api-paste2.ini',
+                 ['heat-api', 'heat-api-cfn']),
+                ('clients', 'internalURL', 'adminURL', ['heat-engine']),
+                ('clients_heat', 'publicURL', 'adminURL', ['heat-engine']),
+                ('clients_keystone', 'http://10.0.0.2:5000\n',
+                 'http://10.0.0.3:5000\n', ['heat-engine']),
+                ('DEFAULT', 'debug = False', 'debug = True',
+                 SERVICES),
+                ('database', '10.0.0.1', '10.0.0.4', SERVICES),
+                ('keystone_authtoken', 'password', 'v3password',
+                 SERVICES),
+                ('oslo_messaging_rabbit', '[clients]\n',
+                 '[oslo_messaging_rabbit]\nssl = True\n\n[clients]\n',
+                 SERVICES)]:
+            with open(self.conf, 'w') as f:
+                f.write(HEAT_CONF_CONTENT)
+            self.assertEqual(self._restarted(old, new), expected, section)
+
+    def test_section_restarts_ignore_comments(self):
+        self.assertEqual(
+            self._restarted('[heat_api]\n', '[heat_api]\n# comment\n'), [])
+
+    def test_section_restarts_changed_files(self):
+        self.assertEqual(
+            self._restarted('internalURL', 'adminURL',
+                            changed_files_f=lambda: [self.conf]),
+            ['heat-engine'])
+        self.assertEqual(
+            self._restarted('internalURL', 'adminURL',
+                            changed_files_f=lambda: []),
+            [])
+
+    def test_section_restarts_wsgi(self):
+        def _write():
+            with open(self.conf, 'w') as f:
+                f.write(HEAT_CONF_CONTENT.replace('workers = 4',
+                                                  'workers = 8'))
+
+        with patch.object(host, 'service') as service:
+            host.restart_on_change_helper(
+                _write, {self.conf: ['heat-engine', 'apache2']},
+                section_map={self.conf: SECTIONS})
+        self.assertEqual([c[0][1] for c in service.call_args_list],
+                         ['apache2'])
+
+    def test_section_restarts_new_file(self):
+        os.unlink(self.conf)
+        self.assertEqual(self._restarted('', ''), SERVICES)
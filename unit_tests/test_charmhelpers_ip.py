@@ -0,0 +1,97 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from unittest.mock import patch, MagicMock
+
+from charmhelpers.contrib.network import ip
+from test_utils import CharmTestCase
+
+PROC_NET_HEADER = (
+    '  sl  local_address rem_address   st tx_queue rx_queue tr tm->when '
+    'retrnsmt   uid  timeout inode\n')
+PROC_NET_TCP = PROC_NET_HEADER + (
+    # 0.0.0.0:8004 listening
+    '   0: 00000000:1F44 00000000:0000 0A 00000000:00000000 00:00000000 '
+    '00000000     0        0 101 1 0000000000000000 100 0 0 10 0\n'
+    # 127.0.0.1:11211 listening
+    '   1: 0100007F:2BCB 00000000:0000 0A 00000000:00000000 00:00000000 '
+    '00000000   112        0 102 1 0000000000000000 100 0 0 10 0\n'
+    # 10.0.0.10:8005 listening, not reachable through 0.0.0.0
+    '   2: 0A00000A:1F45 00000000:0000 0A 00000000:00000000 00:00000000 '
+    '00000000     0        0 103 1 0000000000000000 100 0 0 10 0\n'
+    # 127.0.0.1:8000 established
+    '   3: 0100007F:1F40 0100007F:D3C2 01 00000000:00000000 00:00000000 '
+    '00000000     0        0 104 1 0000000000000000 20 4 30 10 -1\n')
+PROC_NET_TCP6 = PROC_NET_HEADER + (
+    # :::8006 listening
+    '   0: 00000000000000000000000000000000:1F46 '
+    '00000000000000000000000000000000:0000 0A 00000000:00000000 '
+    '00:00000000 00000000     0        0 105 1 0000000000000000 100 0 0 10 0\n'
+    # ::ffff:127.0.0.1:8007 listening
+    '   1: 0000000000000000FFFF00000100007F:1F47 '
+    '00000000000000000000000000000000:0000 0A 00000000:00000000 '
+    '00:00000000 00000000     0        0 106 1 0000000000000000 100 0 0 10 0\n'
+    # ::1:8008 listening, not reachable through 0.0.0.0
+    '   2: 00000000000000000000000001000000:1F48 '
+    '00000000000000000000000000000000:0000 0A 00000000:00000000 '
+    '00:00000000 00000000     0        0 107 1 0000000000000000 100 0 0 10 0'
+    '\n')
+
+
+class ListeningPortsTests(CharmTestCase):
+
+    def setUp(self):
+        super(ListeningPortsTests, self).setUp(ip, [])
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        proc_files = []
+        for name, content in (('tcp', PROC_NET_TCP),
+                              ('tcp6', PROC_NET_TCP6)):
+            path = os.path.join(self.tmpdir, name)
+            with open(path, 'w') as f:
+                f.write(content)
+            proc_files.append(path)
+        patcher = patch.object(ip, 'PROC_NET_TCP', tuple(proc_files))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_listening_ports(self):
+        self.assertEqual(ip.listening_ports(), {8004, 11211, 8006, 8007})
+
+    def test_established_connections(self):
+        self.assertEqual(ip.established_connections([8000, 8004]), 1)
+        self.assertEqual(ip.established_connections([8004]), 0)
+
+    def test_listening_ports_unreadable(self):
+        self.assertRaises(IOError, ip.listening_ports,
+                          (os.path.join(self.tmpdir, 'missing'),))
+
+    @patch.object(ip, 'port_has_listener')
+    def test_check_listening_ssl_falls_back(self, port_has_listener):
+        port_has_listener.return_value = True
+        sslinfo = MagicMock()
+        self.assertEqual(ip.ports_have_listeners([8005], sslinfo), [True])
+        port_has_listener.assert_called_once_with('0.0.0.0', 8005, sslinfo)
+
+    @patch.object(ip, 'port_has_listener')
+    def test_check_listening_no_proc_falls_back(self, port_has_listener):
+        port_has_listener.return_value = False
+        with patch.object(ip, 'PROC_NET_TCP',
+                          (os.path.join(self.tmpdir, 'missing'),)):
+            self.assertEqual(ip.ports_have_listeners([8004]), [False])
+        port_has_listener.assert_called_once_with('0.0.0.0', 8004, None)
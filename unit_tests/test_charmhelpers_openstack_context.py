@@ -0,0 +1,133 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from collections import OrderedDict
+from unittest.mock import patch
+
+from charmhelpers.contrib.openstack import context as os_context
+from test_utils import CharmTestCase
+
+
+class WorkerSizingTests(CharmTestCase):
+
+    def setUp(self):
+        super(WorkerSizingTests, self).setUp(os_context, ['psutil'])
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        patcher = patch.object(os_context, 'CGROUP_ROOT', self.tmpdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.psutil.virtual_memory.return_value.total = 256 * 2 ** 30
+        self.psutil.virtual_memory.return_value.available = 100 * 2 ** 30
+        self.psutil.cpu_count.return_value = 64
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def test_memory_limit_no_cgroup_limit(self):
+        # the reserve is 20% of the memory
+        self.assertEqual(os_context._memory_limit(),
+                         256 * 2 ** 30 - int(256 * 2 ** 30 * 0.2))
+        self._write('memory.max', 'max\n')
+        self.assertEqual(os_context._memory_limit(),
+                         256 * 2 ** 30 - int(256 * 2 ** 30 * 0.2))
+
+    def test_memory_limit_ignores_usage(self):
+        self.psutil.virtual_memory.return_value.available = 2 ** 30
+        self.assertEqual(os_context._memory_limit(),
+                         256 * 2 ** 30 - int(256 * 2 ** 30 * 0.2))
+
+    def test_memory_limit_cgroup_v2(self):
+        self._write('memory.max', '{}\n'.format(16 * 2 ** 30))
+        self._write('memory.current', '{}\n'.format(10 * 2 ** 30))
+        self.assertEqual(os_context._memory_limit(),
+                         16 * 2 ** 30 - int(16 * 2 ** 30 * 0.2))
+
+    def test_memory_limit_cgroup_v1(self):
+        self._write('memory/memory.limit_in_bytes', '9223372036854771712\n')
+        self.assertIsNone(os_context._cgroup_memory_limit())
+        self._write('memory/memory.limit_in_bytes',
+                    '{}\n'.format(4 * 2 ** 30))
+        # at least 1GiB is reserved
+        self.assertEqual(os_context._memory_limit(), 3 * 2 ** 30)
+
+    @patch.object(os_context, 'log')
+    @patch.object(os_context, '_memory_limit')
+    def test_fit_workers_to_memory(self, _memory_limit, log):
+        worker_memory = {'engine': 400 * 2 ** 20, 'api': 200 * 2 ** 20}
+        counts = OrderedDict([('engine', 16), ('api', 4)])
+        _memory_limit.return_value = 8 * 2 ** 30
+        self.assertEqual(
+            os_context._fit_workers_to_memory(counts, worker_memory),
+            counts)
+        log.assert_not_called()
+
+        # both services are scaled down by the same factor
+        _memory_limit.return_value = 3600 * 2 ** 20
+        self.assertEqual(
+            os_context._fit_workers_to_memory(counts, worker_memory),
+            OrderedDict([('engine', 8), ('api', 2)]))
+        log.assert_called_once_with(
+            'Workers limited by 3600MiB of memory (7200MiB needed): '
+            'engine 16 -> 8, api 4 -> 2', level='INFO')
+
+        _memory_limit.return_value = 0
+        self.assertEqual(
+            os_context._fit_workers_to_memory(counts, worker_memory),
+            OrderedDict([('engine', 1), ('api', 1)]))
+
+    def test_cgroup_cpu_limit_v2(self):
+        self.assertIsNone(os_context._cgroup_cpu_limit())
+        self._write('cpu.max', 'max 100000\n')
+        self.assertIsNone(os_context._cgroup_cpu_limit())
+        self._write('cpu.max', '250000 100000\n')
+        self.assertEqual(os_context._cgroup_cpu_limit(), 3)
+        self.assertEqual(os_context._num_cpus(), 3)
+        self._write('cpuset.cpus.effective', '0-1\n')
+        self.assertEqual(os_context._cgroup_cpu_limit(), 2)
+
+    def test_cgroup_cpu_limit_v1(self):
+        self._write('cpu/cpu.cfs_quota_us', '-1\n')
+        self._write('cpu/cpu.cfs_period_us', '100000\n')
+        self._write('cpuset/cpuset.cpus', '0-63\n')
+        self.assertIsNone(os_context._cgroup_cpu_limit())
+        self.assertEqual(os_context._num_cpus(), 64)
+        self._write('cpuset/cpuset.cpus', '0-7,16,18-19\n')
+        self.assertEqual(os_context._cgroup_cpu_limit(), 11)
+
+    @patch.object(os_context, 'log')
+    @patch.object(os_context, 'is_container')
+    @patch.object(os_context, 'config')
+    def test_calculate_workers_cpu_limit(self, config, is_container, log):
+        config.return_value = None
+        is_container.return_value = True
+        self.assertEqual(os_context._calculate_workers(), 4)
+        self.assertEqual(
+            os_context._calculate_workers(default_multiplier=1.0), 4)
+        # a container granted 16 CPUs isn't limited to 4 workers
+        self._write('cpu.max', '1600000 100000\n')
+        self.assertEqual(os_context._calculate_workers(), 32)
+        self.assertEqual(
+            os_context._calculate_workers(default_multiplier=1.0), 16)
+        log.assert_called_with(
+            '16 workers for service: 16 CPUs (cgroup limit) x 1.0',
+            level='INFO')
@@ -0,0 +1,163 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from collections import OrderedDict
+from unittest.mock import patch
+
+from charmhelpers.contrib.network import ip
+from charmhelpers.contrib.openstack import utils as os_utils
+from charmhelpers.core import host, unitdata
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'config',
+    'get_os_codename_package',
+    'get_os_codename_install_source',
+    'juju_log',
+]
+
+SYSTEMCTL_SHOW = (
+    'ActiveState=active\nSubState=running\n\n'
+    'SubState=dead\nActiveState=inactive\n\n'
+    'ActiveState=reloading\nSubState=reload\n\n'
+    'ActiveState=failed\nSubState=failed\n')
+
+
+class OSReleaseCacheTests(CharmTestCase):
+
+    def setUp(self):
+        super(OSReleaseCacheTests, self).setUp(os_utils, TO_PATCH)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.dpkg_status = os.path.join(self.tmpdir, 'status')
+        with open(self.dpkg_status, 'w') as f:
+            f.write('Package: heat-common\n')
+        _status = patch.object(os_utils, 'DPKG_STATUS', self.dpkg_status)
+        _status.start()
+        self.addCleanup(_status.stop)
+        self.addCleanup(setattr, os_utils, '_os_rel', None)
+        os_utils._os_rel = None
+        self.get_os_codename_package.return_value = 'yoga'
+
+    def new_hook(self):
+        # The process local cache doesn't outlive a hook.
+        os_utils._os_rel = None
+
+    def test_cache_hit(self):
+        self.assertEqual(os_utils.os_release('heat-common'), 'yoga')
+        self.new_hook()
+        self.assertEqual(os_utils.os_release('heat-common'), 'yoga')
+        self.get_os_codename_package.assert_called_once_with(
+            'heat-common', fatal=False)
+        self.assertEqual(
+            unitdata.kv().get(os_utils.OS_RELEASE_CACHE_KEY)['codename'],
+            'yoga')
+
+    def test_cache_invalidated_by_dpkg(self):
+        self.assertEqual(os_utils.os_release('heat-common'), 'yoga')
+        with open(self.dpkg_status, 'a') as f:
+            f.write('Version: 1:20.0.0\n')
+        self.get_os_codename_package.return_value = 'zed'
+        self.new_hook()
+        self.assertEqual(os_utils.os_release('heat-common'), 'zed')
+        self.assertEqual(self.get_os_codename_package.call_count, 2)
+
+    def test_cache_per_package(self):
+        os_utils.os_release('heat-common')
+        self.new_hook()
+        os_utils.os_release('heat-engine')
+        self.get_os_codename_package.assert_called_with(
+            'heat-engine', fatal=False)
+        self.assertEqual(self.get_os_codename_package.call_count, 2)
+
+    def test_no_dpkg_status(self):
+        os.unlink(self.dpkg_status)
+        os_utils.os_release('heat-common')
+        self.new_hook()
+        os_utils.os_release('heat-common')
+        self.assertEqual(self.get_os_codename_package.call_count, 2)
+        self.assertIsNone(unitdata.kv().get(os_utils.OS_RELEASE_CACHE_KEY))
+
+    def test_reset_os_release(self):
+        os_utils.os_release('heat-common')
+        os_utils.reset_os_release()
+        self.assertIsNone(os_utils._os_rel)
+        self.assertIsNone(unitdata.kv().get(os_utils.OS_RELEASE_CACHE_KEY))
+        os_utils.os_release('heat-common')
+        self.assertEqual(self.get_os_codename_package.call_count, 2)
+
+    @patch.object(os_utils.unitdata, 'kv')
+    def test_unusable_kv(self, kv):
+        kv.side_effect = sqlite3.OperationalError('database is locked')
+        self.assertEqual(os_utils.os_release('heat-common'), 'yoga')
+        os_utils.reset_os_release()
+        self.assertIsNone(os_utils._os_rel)
+        self.assertEqual(self.juju_log.call_count, 2)
+
+        kv.side_effect = KeyError('unexpected')
+        self.assertRaises(KeyError, os_utils.reset_os_release)
+
+
+class StatusCheckTests(CharmTestCase):
+
+    def setUp(self):
+        super(StatusCheckTests, self).setUp(os_utils, [])
+
+    @patch.object(ip, 'port_has_listener')
+    @patch.object(ip, 'listening_ports')
+    def test_check_listening_on_services_ports(self, listening_ports,
+                                               port_has_listener):
+        listening_ports.return_value = {8004, 11211, 8006, 8007}
+        services = OrderedDict([('heat-api', [8004, 8005]),
+                                ('memcached', [11211]),
+                                ('haproxy', [8006, 8007, 8008])])
+        self.assertEqual(
+            os_utils._check_listening_on_services_ports(services),
+            (OrderedDict([('heat-api', {8005}), ('haproxy', {8008})]),
+             [True, False, True, True, True, False]))
+        opened, _ = os_utils._check_listening_on_services_ports(services,
+                                                                test=True)
+        self.assertEqual(
+            opened,
+            OrderedDict([('heat-api', {8004}), ('memcached', {11211}),
+                         ('haproxy', {8006, 8007})]))
+        ports, states = os_utils._check_listening_on_ports_list([8004, 8005])
+        self.assertEqual(list(ports), [(8004, True), (8005, False)])
+        port_has_listener.assert_not_called()
+
+    @patch.object(host, 'init_is_systemd')
+    @patch.object(host.subprocess, 'call')
+    @patch.object(host.subprocess, 'check_output')
+    def test_check_running_services(self, check_output, _call,
+                                    init_is_systemd):
+        init_is_systemd.return_value = True
+        check_output.return_value = SYSTEMCTL_SHOW.encode('UTF-8')
+        services = OrderedDict([('heat-api', [8004]),
+                                ('heat-engine', []),
+                                ('haproxy', [8004]),
+                                ('memcached', [11211])])
+        self.assertEqual(
+            os_utils._check_running_services(services),
+            ([('heat-api', True), ('heat-engine', False),
+              ('haproxy', True), ('memcached', False)],
+             [True, False, True, False]))
+        check_output.assert_called_once_with(
+            ['systemctl', 'show', '--property=ActiveState,SubState',
+             'heat-api', 'heat-engine', 'haproxy', 'memcached'])
+        _call.assert_not_called()
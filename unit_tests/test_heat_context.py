@@ -78,6 +78,113 @@ class TestHeatContext(CharmTestCase):
         self.test_config.set('max-stacks-per-tenant', '999')
         self.assertEqual(heat_context.QuotaConfigurationContext()(), expected)
 
+    @patch.object(heat_context.context, '_cgroup_cpu_limit')
+    @patch.object(heat_context.context, 'log')
+    @patch.object(heat_context.context, 'is_container')
+    @patch.object(heat_context.context, '_memory_limit')
+    @patch.object(heat_context.context, '_num_cpus')
+    @patch.object(heat_context.context, 'config')
+    def test_worker_configuration_context(self, ch_config, _num_cpus,
+                                          _memory_limit, is_container,
+                                          log, _cgroup_cpu_limit):
+        _cgroup_cpu_limit.return_value = None
+        self.config.side_effect = self.test_config.get
+        ch_config.side_effect = self.test_config.get
+        _num_cpus.return_value = 64
+        _memory_limit.return_value = 64 * 1024 ** 3
+        is_container.return_value = False
+        self.assertEqual(heat_context.HeatWorkerConfigContext()(),
+                         {'workers': 4, 'engine_workers': 64,
+                          'api_workers': 16, 'api_cfn_workers': 8})
+        self.assertEqual(heat_context.service_workers('heat-api'), 16)
+
+        # the services share the memory of the unit
+        _memory_limit.return_value = 8 * 1024 ** 3
+        self.assertEqual(heat_context.HeatWorkerConfigContext()(),
+                         {'workers': 4, 'engine_workers': 17,
+                          'api_workers': 4, 'api_cfn_workers': 2})
+        log.assert_called_with(
+            'Workers limited by 8192MiB of memory (30000MiB needed): '
+            'heat-engine 64 -> 17, heat-api 16 -> 4, heat-api-cfn 8 -> 2',
+            level='INFO')
+
+        # limited in containers
+        is_container.return_value = True
+        ctxt = heat_context.HeatWorkerConfigContext()()
+        self.assertEqual(ctxt['engine_workers'], 4)
+        self.assertEqual(ctxt['api_cfn_workers'], 4)
+
+        # worker-multiplier applies to all, unless overridden
+        _memory_limit.return_value = 64 * 1024 ** 3
+        self.test_config.set('worker-multiplier', 0.5)
+        self.test_config.set('api-worker-multiplier', 0.1)
+        self.assertEqual(heat_context.HeatWorkerConfigContext()(),
+                         {'workers': 32, 'engine_workers': 32,
+                          'api_workers': 6, 'api_cfn_workers': 32})
+
+    @patch.object(heat_context, 'service_workers')
+    @patch.object(heat_context, 'determine_api_port')
+    @patch.object(heat_context.context, '_calculate_workers')
+    @patch.object(heat_context.context, 'config')
+    def test_wsgi_worker_configuration_context(self, ch_config,
+                                               _calculate_workers,
+                                               determine_api_port,
+                                               service_workers):
+        ch_config.return_value = None
+        _calculate_workers.return_value = 4
+        determine_api_port.side_effect = lambda port, **kwargs: port - 10
+        service_workers.return_value = 3
+        ctxt = heat_context.HeatWSGIWorkerConfigContext('heat-api-cfn')()
+        self.assertEqual(ctxt['service_name'], 'heat-api-cfn')
+        self.assertEqual(ctxt['script'], '/usr/bin/heat-wsgi-api-cfn')
+        self.assertEqual(ctxt['user'], 'heat')
+        self.assertEqual(ctxt['port'], 7990)
+        self.assertEqual(ctxt['processes'], 3)
+        self.assertEqual(ctxt['threads'], heat_context.WSGI_THREADS)
+        service_workers.assert_called_once_with('heat-api-cfn')
+        determine_api_port.assert_called_once_with(8000,
+                                                   singlenode_mode=True)
+
+    @patch.object(heat_context, 'heat_workers')
+    def test_database_pool_context(self, heat_workers):
+        self.config.side_effect = self.test_config.get
+        self.relation_ids.return_value = ['cluster:1']
+        self.related_units.return_value = ['heat/1', 'heat/2']
+        heat_workers.return_value = {
+            'heat-engine': 8, 'heat-api': 2, 'heat-api-cfn': 1}
+        self.assertEqual(heat_context.HeatDatabasePoolContext()(), {})
+
+        self.test_config.set('database-connection-budget', 700)
+        self.assertEqual(heat_context.database_pool(), {
+            'budget': 700, 'units': 3, 'processes': 11,
+            'max_pool_size': 10, 'max_overflow': 11,
+            'api_max_pool_size': 10, 'api_max_overflow': 11,
+            'connections': 693})
+        self.assertEqual(heat_context.HeatDatabasePoolContext()(), {
+            'database_max_pool_size': 10,
+            'database_max_overflow': 11,
+            'database_pool_timeout': 30,
+            'database_connection_recycle_time': 3600})
+
+        # wsgi API processes need a connection per thread, heat-engine
+        # workers don't
+        self.test_config.set('database-connection-budget', 150)
+        self.assertEqual(heat_context.database_pool(api_threads=4), {
+            'budget': 150, 'units': 3, 'processes': 11,
+            'max_pool_size': 2, 'max_overflow': 2,
+            'api_max_pool_size': 4, 'api_max_overflow': 0,
+            'connections': 132})
+        ctxt = heat_context.HeatDatabasePoolContext()()
+        self.assertEqual(ctxt['database_max_pool_size'], 2)
+        self.assertEqual(ctxt['database_max_overflow'], 2)
+        ctxt = heat_context.HeatDatabasePoolContext(api_threads=4)()
+        self.assertEqual(ctxt['database_max_pool_size'], 4)
+        self.assertEqual(ctxt['database_max_overflow'], 0)
+
+        # each process keeps a connection in its pool
+        self.test_config.set('database-connection-budget', 20)
+        self.assertEqual(heat_context.database_pool()['connections'], 33)
+
     @patch('charmhelpers.contrib.hahelpers.cluster.https')
     @patch('heat_context.https')
     def test_haproxy_context(self, mock_https, mock_ch_https):
@@ -110,6 +217,13 @@ class TestHeatContext(CharmTestCase):
             }
             self.assertEqual(expected, haproxy_context())
 
+        # the canary of an upgrade is weighted down
+        self.config.side_effect = self.test_config.get
+        self.test_config.set('canary-weight', 25)
+        heat_context.kv().set(heat_context.UPGRADE_WEIGHTS_KEY, 'heat-1')
+        self.assertEqual(heat_context.HeatHAProxyContext()()['server_weights'],
+                         {'heat-1': 25})
+
 
 class HeatPluginContextTest(CharmTestCase):
 
@@ -0,0 +1,120 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from unittest.mock import patch
+from test_utils import CharmTestCase
+
+import heat_profile as profile
+
+TO_PATCH = [
+    'charm_dir',
+    'config',
+    'log',
+    'time',
+]
+
+
+class HeatProfileTests(CharmTestCase):
+
+    def setUp(self):
+        super(HeatProfileTests, self).setUp(profile, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.charm_dir.return_value = self.tmpdir
+        self.now = 100.0
+        self.time.time.side_effect = lambda: self.now
+
+    def test_profiling_enabled(self):
+        self.assertFalse(profile.profiling_enabled())
+        self.test_config.set('profile-hooks', True)
+        self.assertTrue(profile.profiling_enabled())
+
+    @patch.dict(os.environ, {'HEAT_PROFILE_HOOKS': '1'})
+    def test_profiling_enabled_env(self):
+        self.assertTrue(profile.profiling_enabled())
+        self.config.assert_not_called()
+
+    def test_phases_are_exclusive(self):
+        profiler = profile.HookProfiler('config-changed', start=90.0)
+        with profiler.phase('hook'):
+            self.now += 1
+            with profiler.phase('write'):
+                self.now += 2
+                with profiler.phase('context'):
+                    self.now += 4
+                self.now += 2
+            self.now += 1
+        self.assertEqual({'hook': 2.0, 'write': 4.0, 'context': 4.0},
+                         dict(profiler.phases))
+        self.assertEqual(20.0, profiler.summary()['total'])
+
+    def test_install_counts_subprocesses(self):
+        self.time.time.side_effect = None
+        self.time.time.return_value = 100.0
+        profiler = profile.HookProfiler('update-status')
+        orig_popen = subprocess.Popen
+        profiler.install()
+        try:
+            subprocess.check_call(['true'])
+            subprocess.check_output(['true'])
+        finally:
+            profiler.uninstall()
+        subprocess.check_call(['true'])
+        self.assertIs(orig_popen, subprocess.Popen)
+        self.assertEqual(2, profiler.commands['true']['count'])
+        self.assertEqual(0, profiler.commands['relation-get']['count'])
+
+    def test_profiled_disabled(self):
+        with profile.profiled('update-status') as profiler:
+            self.assertIsNone(profiler)
+        self.assertEqual([], profile.load_profiles())
+
+    @patch.object(profile, 'process_start_time')
+    def test_profiled_saves_profile(self, process_start_time):
+        process_start_time.return_value = 99.5
+        self.test_config.set('profile-hooks', True)
+        for hook in ('install', 'config-changed', 'update-status'):
+            self.now = 100.0
+            with profile.profiled(hook) as profiler:
+                with profile.profile_phase(profiler, 'hook'):
+                    self.now += 1
+        self.assertTrue(self.log.called)
+        profiles = profile.last_profiles(2)
+        self.assertEqual(['update-status', 'config-changed'],
+                         [p['hook'] for p in profiles])
+        self.assertEqual({'import': 0.5, 'hook': 1.0},
+                         profiles[-1]['phases'])
+
+    @patch.dict(sys.modules, {'psutil': None})
+    def test_profiled_import_start_without_psutil(self):
+        self.test_config.set('profile-hooks', True)
+        self.assertEqual(profile.process_start_time(), 100.0)
+        with profile.profiled('install', start=97.5):
+            pass
+        self.assertEqual({'import': 2.5},
+                         profile.last_profiles(1)[0]['phases'])
+
+    def test_save_profile_caps_history(self):
+        for i in range(profile.MAX_PROFILES + 5):
+            profile.save_profile({'hook': str(i)})
+        profiles = profile.load_profiles()
+        self.assertEqual(profile.MAX_PROFILES, len(profiles))
+        self.assertEqual(str(profile.MAX_PROFILES + 4), profiles[-1]['hook'])
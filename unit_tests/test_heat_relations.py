@@ -67,6 +67,12 @@ TO_PATCH = [
     'generate_ha_relation_data',
     # charmhelpers.contrib.hahelpers.cluster_utils
     # heat_utils
+    'advance_upgrade',
+    'apply_upgrade_weights',
+    'configure_api_wsgi',
+    'grant_restart_slots',
+    'upgrade_slot_granted',
+    'upgrade_waiting',
     'restart_map',
     'register_configs',
     'do_openstack_upgrade',
@@ -91,6 +97,11 @@ class HeatRelationTests(CharmTestCase):
         super(HeatRelationTests, self).setUp(relations, TO_PATCH)
         self.config.side_effect = self.test_config.get
         self.charm_dir.return_value = '/var/lib/juju/charms/heat/charm'
+        self.restart_map.return_value = {}
+        self.upgrade_slot_granted.return_value = True
+        self.upgrade_waiting.return_value = False
+        relations.RESTART_MAP.reset()
+        self.addCleanup(relations.RESTART_MAP.reset)
 
     @patch.object(relations.policyd, 'maybe_do_policyd_overrides')
     def test_install_hook(self, mock_maybe_do_policyd_overrides):
@@ -135,6 +146,16 @@ class HeatRelationTests(CharmTestCase):
         relations.config_changed()
         self.assertTrue(self.do_openstack_upgrade.called)
 
+    @patch.object(relations, 'configure_https')
+    @patch.object(relations.policyd,
+                  'maybe_do_policyd_overrides_on_config_changed')
+    @patch.object(relations, 'update_nrpe_config')
+    def test_config_changed_upgrade_not_scheduled(self, *args):
+        self.openstack_upgrade_available.return_value = True
+        self.upgrade_slot_granted.return_value = False
+        relations.config_changed()
+        self.assertFalse(self.do_openstack_upgrade.called)
+
     @patch.object(relations, 'configure_https')
     @patch.object(relations.policyd,
                   'maybe_do_policyd_overrides_on_config_changed')
@@ -248,6 +269,14 @@ class HeatRelationTests(CharmTestCase):
         self.assertEqual([call('/etc/heat/heat.conf')],
                          configs.write.call_args_list)
 
+    @patch.object(relations, 'CONFIGS')
+    def test_amqp_changed_restart_map_resolved_once(self, configs):
+        self.restart_map.assert_not_called()
+        configs.complete_contexts.return_value = ['amqp']
+        relations.amqp_changed()
+        relations.amqp_changed()
+        self.restart_map.assert_called_once_with()
+
     @patch.object(relations, 'CONFIGS')
     def test_amqp_changed_missing_relation_data(self, configs):
         configs.complete_contexts = MagicMock()
@@ -366,6 +395,60 @@ class HeatRelationTests(CharmTestCase):
         self.relation_set.assert_called_once_with(
             relation_id='rid:23', rel_data='data')
 
+    @patch.object(relations, 'peers_at_expected_scale')
+    @patch.object(relations, 'CONFIGS')
+    def test_cluster_changed(self, configs, peers_at_expected_scale):
+        peers_at_expected_scale.return_value = False
+        relations.cluster_changed()
+        configs.write_all.assert_not_called()
+        peers_at_expected_scale.return_value = True
+        relations.cluster_changed()
+        configs.write_all.assert_called_once_with()
+        self.assertEqual(self.grant_restart_slots.call_count, 2)
+        # restart_on_change reloads haproxy if the weights changed
+        self.apply_upgrade_weights.assert_called_with(configs, reload=False)
+
+    @patch.object(relations, 'peer_scale_pending')
+    @patch.object(relations, 'cluster_changed')
+    @patch.object(relations, 'hardening_required')
+    def test_update_status_peer_scale(self, hardening_required,
+                                      cluster_changed, peer_scale_pending):
+        hardening_required.return_value = False
+        peer_scale_pending.return_value = False
+        relations.update_status()
+        cluster_changed.assert_not_called()
+        peer_scale_pending.return_value = True
+        relations.update_status()
+        cluster_changed.assert_called_once_with()
+
+    @patch.object(relations, 'config_changed')
+    @patch.object(relations, 'release_db_revision_hold')
+    def test_leader_settings_changed(self, release_db_revision_hold,
+                                     config_changed):
+        relations.leader_settings_changed()
+        release_db_revision_hold.assert_called_once_with()
+        config_changed.assert_not_called()
+        self.apply_upgrade_weights.assert_called_once_with(
+            relations.CONFIGS)
+        self.upgrade_waiting.return_value = True
+        relations.leader_settings_changed()
+        config_changed.assert_called_once_with()
+
+    @patch.object(relations, 'record_hardening')
+    @patch.object(relations, 'hardening_required')
+    @patch.object(relations, 'harden')
+    def test_update_status(self, harden, hardening_required,
+                           record_hardening):
+        hardening_required.return_value = False
+        relations.update_status()
+        harden.assert_not_called()
+
+        hardening_required.return_value = True
+        relations.update_status()
+        harden.assert_called_once_with()
+        harden.return_value.assert_called_once_with(record_hardening)
+        harden.return_value.return_value.assert_called_once_with()
+
     @patch.object(relations, "apt_install")
     @patch.object(relations.nrpe, "get_nagios_hostname")
     @patch.object(relations.nrpe, "get_nagios_unit_name")
@@ -12,16 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+
 from copy import deepcopy
 from collections import OrderedDict
 from unittest.mock import patch, MagicMock, call
 from test_utils import CharmTestCase
 
 from charmhelpers.core import hookenv
+from charmhelpers.contrib.openstack.context import OSContextGenerator
 
 _conf = hookenv.config
 hookenv.config = MagicMock()
 
+import heat_context
 import heat_utils as utils
 
 hookenv.config = _conf
@@ -30,16 +38,24 @@ TO_PATCH = [
     'config',
     'log',
     'os_release',
+    'reset_os_release',
     'get_os_codename_install_source',
     'configure_installation_source',
     'apt_install',
     'apt_update',
     'apt_upgrade',
     'check_call',
+    'database_pool',
     'service_start',
     'service_stop',
     'token_cache_pkgs',
     'enable_memcache',
+    'is_elected_leader',
+    'is_leader',
+    'leader_get',
+    'leader_set',
+    'policy_rcd',
+    'clear_deferred_restarts',
     'os'
 ]
 
@@ -64,6 +80,7 @@ class HeatUtilsTests(CharmTestCase):
     def setUp(self):
         super(HeatUtilsTests, self).setUp(utils, TO_PATCH)
         self.config.side_effect = self.test_config.get
+        self.database_pool.return_value = {}
 
     @patch('charmhelpers.contrib.openstack.context.SubordinateConfigContext')
     def test_determine_packages(self, subcontext):
@@ -91,6 +108,94 @@ class HeatUtilsTests(CharmTestCase):
             ['memcached'] + utils.BASE_SERVICES + utils.PY3_PACKAGES))
         self.assertEqual(sorted(ex), sorted(pkgs))
 
+    @patch('charmhelpers.contrib.openstack.context.SubordinateConfigContext')
+    def test_determine_packages_wsgi(self, subcontext):
+        self.os_release.return_value = 'yoga'
+        self.token_cache_pkgs.return_value = []
+        self.test_config.set('api-wsgi', True)
+        self.assertIn('libapache2-mod-wsgi-py3', utils.determine_packages())
+        # not available before rocky
+        self.os_release.return_value = 'queens'
+        self.assertNotIn('libapache2-mod-wsgi-py3',
+                         utils.determine_packages())
+
+    def test_restart_map_wsgi(self):
+        self.os_release.return_value = 'yoga'
+        self.enable_memcache.return_value = True
+        self.os.path.exists.return_value = True
+        self.test_config.set('api-wsgi', True)
+        _restart_map = utils.restart_map()
+        self.assertEqual(_restart_map['/etc/heat/heat.conf'],
+                         ['heat-engine', 'apache2'])
+        self.assertEqual(_restart_map['/etc/heat/api-paste.ini'],
+                         ['apache2'])
+        self.assertEqual(_restart_map['/etc/heat/api_audit_map.conf'],
+                         ['apache2'])
+        for site in utils.WSGI_SITES.values():
+            self.assertEqual(_restart_map[site], ['apache2'])
+        for conf in utils.WSGI_API_CONFS.values():
+            self.assertEqual(_restart_map[conf], ['apache2'])
+        self.assertNotIn('heat-api', utils.services())
+        self.assertNotIn('heat-api-cfn', utils.services())
+        self.assertEqual(utils.heat_services(), ['heat-engine', 'apache2'])
+
+        def api_threads(resources, conf):
+            return [c.api_threads for c in resources[conf]['contexts']
+                    if isinstance(c, utils.HeatDatabasePoolContext)]
+
+        resources = utils.resource_map()
+        self.assertEqual(api_threads(resources, '/etc/heat/heat.conf'),
+                         [None])
+        self.assertEqual(api_threads(resources, '/etc/heat/heat-api.conf'),
+                         [utils.WSGI_THREADS])
+
+        self.test_config.set('api-wsgi', False)
+        self.assertNotIn('/etc/heat/heat-api.conf', utils.resource_map())
+
+    @patch.object(utils, 'is_unit_paused_set')
+    @patch.object(utils, 'service_reload')
+    @patch.object(utils, 'service_resume')
+    @patch.object(utils, 'service_pause')
+    def test_configure_api_wsgi(self, service_pause, service_resume,
+                                service_reload, is_unit_paused_set):
+        self.os_release.return_value = 'yoga'
+        self.os.path.splitext.side_effect = os.path.splitext
+        self.os.path.basename.side_effect = os.path.basename
+        is_unit_paused_set.return_value = False
+        utils.configure_api_wsgi()
+        self.check_call.assert_not_called()
+
+        self.test_config.set('api-wsgi', True)
+        steps = MagicMock()
+        steps.attach_mock(self.apt_install, 'apt_install')
+        steps.attach_mock(self.check_call, 'check_call')
+        steps.attach_mock(service_pause, 'service_pause')
+        steps.attach_mock(service_reload, 'service_reload')
+        utils.configure_api_wsgi()
+        # the APIs keep serving until apache2 is ready to take over
+        self.assertEqual(steps.mock_calls, [
+            call.apt_install(['libapache2-mod-wsgi-py3'], fatal=True),
+            call.check_call(['a2enmod', 'wsgi']),
+            call.check_call(['a2ensite', 'wsgi-heat-api']),
+            call.check_call(['a2ensite', 'wsgi-heat-api-cfn']),
+            call.service_pause('heat-api'),
+            call.service_pause('heat-api-cfn'),
+            call.service_reload('apache2', restart_on_failure=True)])
+        # nothing to do until the mode changes again
+        self.check_call.reset_mock()
+        utils.configure_api_wsgi()
+        self.check_call.assert_not_called()
+
+        self.test_config.set('api-wsgi', False)
+        utils.configure_api_wsgi()
+        self.check_call.assert_has_calls([
+            call(['a2dissite', 'wsgi-heat-api']),
+            call(['a2dissite', 'wsgi-heat-api-cfn'])])
+        self.os.remove.assert_has_calls([call('/etc/heat/heat-api.conf'),
+                                         call('/etc/heat/heat-api-cfn.conf')])
+        service_resume.assert_has_calls([call('heat-api'),
+                                         call('heat-api-cfn')])
+
     def test_determine_purge_packages(self):
         'Ensure no packages are identified for purge prior to rocky'
         self.os_release.return_value = 'queens'
@@ -134,20 +239,1205 @@ class HeatUtilsTests(CharmTestCase):
         self.assertTrue(self.apt_update.called)
         self.assertTrue(self.apt_upgrade.called)
         self.assertTrue(self.apt_install.called)
+        self.reset_os_release.assert_called_once_with()
         configs.set_release.assert_called_with(openstack_release='havana')
         self.assertTrue(configs.write_all.called)
 
+    @patch.object(utils, 'migrate_database')
+    def test_openstack_upgrade_prepared(self, migrate_database):
+        self.test_config.set('openstack-origin', 'cloud:focal-yoga')
+        self.get_os_codename_install_source.return_value = 'yoga'
+        self.os_release.return_value = 'xena'
+        utils.kv().set(utils.PREPARED_UPGRADE_KEY, 'cloud:focal-yoga')
+        timings = {}
+        utils.do_openstack_upgrade(MagicMock(), timings=timings)
+        self.apt_update.assert_not_called()
+        self.assertTrue(self.apt_upgrade.called)
+        self.assertIsNone(utils.kv().get(utils.PREPARED_UPGRADE_KEY))
+        self.assertEqual(list(timings),
+                         ['update', 'install', 'configure', 'migrate'])
+
+    @patch.object(utils, 'pending_downloads')
+    def test_prepare_upgrade(self, pending_downloads):
+        self.test_config.set('openstack-origin', 'cloud:focal-yoga')
+        self.os_release.return_value = 'xena'
+        pending_downloads.return_value = []
+        timings = {}
+        utils.prepare_upgrade(timings)
+        self.configure_installation_source.assert_called_once_with(
+            'cloud:focal-yoga')
+        self.apt_update.assert_called_once_with(fatal=True)
+        download_opts = utils.UPGRADE_DPKG_OPTS + ['--download-only']
+        self.apt_upgrade.assert_called_once_with(
+            options=download_opts, fatal=True, dist=True)
+        self.assertEqual(self.apt_install.call_args[1]['options'],
+                         download_opts)
+        self.assertEqual(list(timings), ['update', 'download', 'verify'])
+        self.assertEqual(utils.kv().get(utils.PREPARED_UPGRADE_KEY),
+                         'cloud:focal-yoga')
+
+        utils.kv().unset(utils.PREPARED_UPGRADE_KEY)
+        pending_downloads.return_value = ['http://archive/heat-common.deb']
+        self.assertRaises(Exception, utils.prepare_upgrade)
+        self.assertIsNone(utils.kv().get(utils.PREPARED_UPGRADE_KEY))
+
+    @patch.object(utils, 'check_output')
+    def test_pending_downloads(self, check_output):
+        check_output.side_effect = [
+            '',
+            "'http://archive/pool/heat-common_20.0.0_all.deb' "
+            "heat-common_20.0.0_all.deb 1234 SHA256:abcd\n"]
+        self.assertEqual(utils.pending_downloads(['heat-common']),
+                         ['http://archive/pool/heat-common_20.0.0_all.deb'])
+        self.assertEqual(check_output.call_args[0][0][-2:],
+                         ['install', 'heat-common'])
+
+    @patch.object(utils, 'hold_for_db_revision')
+    @patch.object(utils, 'migrate_database')
+    def test_openstack_upgrade_non_leader(self, migrate_database,
+                                          hold_for_db_revision):
+        self.get_os_codename_install_source.return_value = 'havana'
+        self.os_release.return_value = 'icehouse'
+        self.is_elected_leader.return_value = False
+        utils.do_openstack_upgrade(MagicMock())
+        migrate_database.assert_not_called()
+        hold_for_db_revision.assert_called_once_with()
+
+    @patch.object(utils, 'is_unit_paused_set')
+    @patch.object(utils, 'service_restart')
+    @patch.object(utils, 'heat_services')
+    @patch.object(utils, 'expected_db_revision')
+    def test_openstack_upgrade_holds_heat_services(self, expected_db_revision,
+                                                   heat_services,
+                                                   service_restart,
+                                                   is_unit_paused_set):
+        self.get_os_codename_install_source.return_value = 'yoga'
+        self.os_release.return_value = 'xena'
+        self.is_elected_leader.return_value = False
+        is_unit_paused_set.return_value = False
+        heat_services.return_value = ['heat-api', 'heat-engine']
+        expected_db_revision.return_value = '86'
+        self.leader_get.return_value = '73'
+        steps = MagicMock()
+        steps.attach_mock(self.policy_rcd.add_policy_block,
+                          'add_policy_block')
+        steps.attach_mock(self.apt_upgrade, 'apt_upgrade')
+        steps.attach_mock(self.policy_rcd.remove_policy_file,
+                          'remove_policy_file')
+        utils.do_openstack_upgrade(MagicMock())
+        # the package scripts may not restart the heat services
+        self.assertEqual(
+            [name for name, _, _ in steps.mock_calls],
+            ['add_policy_block', 'add_policy_block', 'apt_upgrade',
+             'remove_policy_file'])
+        self.policy_rcd.add_policy_block.assert_called_with(
+            'heat-engine', utils.UPGRADE_BLOCKED_ACTIONS)
+        self.clear_deferred_restarts.assert_called_once_with(
+            ['heat-api', 'heat-engine'])
+        # nor does the charm before the leader migrated the database
+        service_restart.assert_not_called()
+        self.service_start.assert_not_called()
+        self.service_stop.assert_not_called()
+        self.assertFalse(utils.release_db_revision_hold())
+        service_restart.assert_not_called()
+
+        self.leader_get.return_value = '86'
+        self.assertTrue(utils.release_db_revision_hold())
+        service_restart.assert_has_calls(
+            [call('heat-api'), call('heat-engine')], any_order=True)
+
     def test_api_ports(self):
         cfn = utils.api_port('heat-api-cfn')
         self.assertEqual(cfn, 8000)
         cfn = utils.api_port('heat-api')
         self.assertEqual(cfn, 8004)
 
-    def test_migrate_database(self):
+    @patch.object(utils, 'current_db_revision')
+    def test_migrate_database(self, current_db_revision):
+        current_db_revision.return_value = '86'
+        self.is_leader.return_value = True
         utils.migrate_database()
         self.assertTrue(self.log.called)
         self.check_call.assert_called_with(['heat-manage', 'db_sync'])
         expected = [call('heat-api'), call('heat-api-cfn'),
-                    call('heat-engine'), call('apache2')]
+                    call('heat-engine')]
         self.service_stop.assert_has_calls(expected, any_order=True)
         self.service_start.assert_has_calls(expected, any_order=True)
+        self.assertEqual(self.service_stop.call_count, 3)
+        self.leader_set.assert_called_once_with({'heat-db-revision': '86'})
+
+    @patch.object(utils, 'current_db_revision')
+    @patch.object(utils, 'services')
+    def test_migrate_database_order(self, services, current_db_revision):
+        services.return_value = ['apache2', 'heat-engine', 'haproxy',
+                                 'heat-api', 'memcached', 'heat-api-cfn']
+        calls = []
+        lock = threading.Lock()
+
+        def _record(action):
+            def _f(svc):
+                with lock:
+                    calls.append((action, svc))
+                return True
+            return _f
+
+        self.service_stop.side_effect = _record('stop')
+        self.service_start.side_effect = _record('start')
+        self.check_call.side_effect = lambda cmd: calls.append(('sync', None))
+        utils.migrate_database()
+
+        # haproxy, apache2 and memcached keep serving during the sync
+        self.assertEqual(calls[3], ('sync', None))
+        self.assertEqual(
+            sorted(calls[:3]),
+            [('stop', 'heat-api'), ('stop', 'heat-api-cfn'),
+             ('stop', 'heat-engine')])
+        self.assertEqual(
+            sorted(calls[4:]),
+            [('start', 'heat-api'), ('start', 'heat-api-cfn'),
+             ('start', 'heat-engine')])
+
+    def test_current_db_revision(self):
+        with patch.object(utils, 'check_output') as check_output:
+            check_output.return_value = '86\n'
+            self.assertEqual(utils.current_db_revision(), '86')
+            check_output.return_value = 'INFO [alembic] ...\nc6214ca60943\n'
+            self.assertEqual(utils.current_db_revision(), 'c6214ca60943')
+            check_output.side_effect = utils.CalledProcessError(1, 'x')
+            self.assertIsNone(utils.current_db_revision())
+
+    def test_expected_db_revision(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.os.path.join.side_effect = os.path.join
+        self.os.path.basename.side_effect = os.path.basename
+        self.assertIsNone(utils.expected_db_revision(tmpdir))
+
+        versions = os.path.join(tmpdir, 'db', 'migrations', 'versions')
+        os.makedirs(versions)
+        for name, body in [
+                ('c6214ca60943_initial.py',
+                 "revision = 'c6214ca60943'\ndown_revision = None\n"),
+                ('e4a2c9f3d1b0_stack_tags.py',
+                 "revision = 'e4a2c9f3d1b0'\n"
+                 "down_revision = 'c6214ca60943'\n")]:
+            with open(os.path.join(versions, name), 'w') as f:
+                f.write(body)
+        self.assertEqual(utils.expected_db_revision(tmpdir), 'e4a2c9f3d1b0')
+
+        migrate = os.path.join(tmpdir, 'db', 'sqlalchemy', 'migrate_repo',
+                               'versions')
+        os.makedirs(migrate)
+        for name in ('071_mitaka.py', '086_queens.py', '__init__.py'):
+            open(os.path.join(migrate, name), 'w').close()
+        self.assertEqual(utils.expected_db_revision(tmpdir), '86')
+
+    @patch.object(utils, 'expected_db_revision')
+    @patch.object(utils, 'run_service_actions')
+    def test_hold_for_db_revision(self, run_service_actions,
+                                  expected_db_revision):
+        expected_db_revision.return_value = '86'
+        self.leader_get.return_value = '86'
+        self.assertTrue(utils.hold_for_db_revision())
+        self.assertEqual(run_service_actions.call_args[0][0],
+                         utils.service_restart)
+        self.assertIsNone(utils.kv().get(utils.DB_REVISION_WAIT_KEY))
+
+        # the running services keep serving until the leader migrated
+        run_service_actions.reset_mock()
+        self.leader_get.return_value = '73'
+        self.assertFalse(utils.hold_for_db_revision())
+        run_service_actions.assert_not_called()
+        self.service_stop.assert_not_called()
+        self.assertEqual(utils.db_revision_held(), '86')
+        # held heat services aren't restarted on config changes meanwhile
+        self.assertFalse(utils.can_restart_now('heat-engine', []))
+        self.assertTrue(utils.can_restart_now('haproxy', []))
+        self.assertTrue(utils.coalesce_restart('heat-engine', []))
+
+    @patch.object(utils, 'is_unit_paused_set')
+    @patch.object(utils, 'expected_db_revision')
+    @patch.object(utils, 'run_service_actions')
+    def test_release_db_revision_hold(self, run_service_actions,
+                                      expected_db_revision,
+                                      is_unit_paused_set):
+        is_unit_paused_set.return_value = False
+        expected_db_revision.return_value = '86'
+        self.leader_get.return_value = '86'
+        self.assertFalse(utils.release_db_revision_hold())
+
+        utils.kv().set(utils.DB_REVISION_WAIT_KEY, '86')
+        self.leader_get.return_value = '73'
+        self.assertFalse(utils.release_db_revision_hold())
+        run_service_actions.assert_not_called()
+
+        self.leader_get.return_value = '86'
+        self.assertTrue(utils.release_db_revision_hold())
+        self.assertEqual(run_service_actions.call_args[0][0],
+                         utils.service_restart)
+        self.assertIsNone(utils.db_revision_held())
+        self.assertTrue(utils.can_restart_now('heat-engine', []))
+
+    def test_run_service_actions_concurrent(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def _action(svc):
+            barrier.wait()
+            return svc != 'heat-api'
+
+        results = utils.run_service_actions(
+            _action, ['heat-api', 'heat-engine', 'memcached'])
+        self.assertEqual(
+            {s: r[0] for s, r in results.items()},
+            {'heat-api': False, 'heat-engine': True, 'memcached': True})
+
+    def test_run_service_actions_timeout(self):
+        never = threading.Event()
+        self.addCleanup(never.set)
+
+        def _action(svc):
+            if svc == 'heat-api':
+                never.wait(5)
+            return True
+
+        results = utils.run_service_actions(
+            _action, ['heat-api', 'haproxy', 'heat-engine'],
+            dependencies={'haproxy': ['heat-api']}, timeout=0.2)
+        self.assertEqual(list(results),
+                         ['heat-engine', 'heat-api', 'haproxy'])
+        self.assertEqual([r[0] for r in results.values()],
+                         [True, False, True])
+
+    def test_run_service_actions_circular(self):
+        self.assertRaises(ValueError, utils.run_service_actions,
+                          MagicMock(), ['a', 'b'],
+                          dependencies={'a': ['b'], 'b': ['a']})
+
+    def test_lazy_configs(self):
+        factory = MagicMock()
+        configs = utils.LazyConfigs(factory)
+        factory.assert_not_called()
+        configs.write_all()
+        configs.complete_contexts()
+        factory.assert_called_once_with()
+        factory.return_value.write_all.assert_called_once_with()
+        factory.return_value.complete_contexts.assert_called_once_with()
+
+    def test_lazy_restart_map(self):
+        factory = MagicMock()
+        factory.return_value = RESTART_MAP
+        _restart_map = utils.LazyRestartMap(factory)
+        factory.assert_not_called()
+        self.assertEqual(RESTART_MAP, dict(_restart_map.items()))
+        self.assertEqual(['haproxy'], _restart_map['/etc/haproxy/haproxy.cfg'])
+        self.assertEqual(len(RESTART_MAP), len(_restart_map))
+        factory.assert_called_once_with()
+
+    @patch.object(utils, 'resource_map')
+    def test_register_configs_contexts_evaluated_once(self, resource_map):
+        calls = []
+
+        class CountingContext(OSContextGenerator):
+            interfaces = ['counting']
+
+            def __init__(self, name):
+                self.name = name
+
+            def __call__(self):
+                calls.append(self.name)
+                return {self.name: True}
+
+        resource_map.return_value = OrderedDict([
+            (utils.HEAT_CONF, {
+                'contexts': [CountingContext('a'), CountingContext('b'),
+                             CountingContext('a')],
+                'services': []}),
+            (utils.HEAT_API_PASTE, {
+                'contexts': [CountingContext('a')],
+                'services': []}),
+        ])
+        configs = utils.register_configs(release='yoga')
+        configs.render(utils.HEAT_CONF)
+        configs.render(utils.HEAT_API_PASTE)
+        self.assertEqual(['counting'], configs.complete_contexts()[:1])
+        configs.render(utils.HEAT_CONF)
+        self.assertEqual(['a', 'b'], calls)
+
+        configs.reset_context_cache()
+        configs.render(utils.HEAT_API_PASTE)
+        self.assertEqual(['a', 'b', 'a'], calls)
+
+    @patch.object(hookenv.subprocess, 'check_call')
+    def test_register_configs_write_after_data_change(self, check_call):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with open(os.path.join(tmpdir, 'weights.conf'), 'w') as f:
+            f.write('{{ weight }}')
+        target = os.path.join(tmpdir, 'etc', 'weights.conf')
+        os.mkdir(os.path.dirname(target))
+
+        class KVContext(OSContextGenerator):
+            def __call__(self):
+                return {'weight': utils.kv().get('weight', 100)}
+
+        configs = utils.templating.OSConfigRenderer(
+            templates_dir=tmpdir, openstack_release='yoga')
+        configs.register(target, [KVContext()])
+        self.assertTrue(configs.write(target))
+        # data changed since the contexts were evaluated in this hook
+        utils.kv().set('weight', 25)
+        self.assertTrue(configs.write(target))
+        with open(target) as f:
+            self.assertEqual(f.read(), '25')
+        self.assertFalse(configs.write(target))
+
+        utils.kv().unset('weight')
+        self.assertTrue(configs.write(target))
+        with open(target) as f:
+            self.assertEqual(f.read(), '100')
+
+        generation = hookenv.data_generation()
+        hookenv.leader_set({'heat-upgrade-origin': None})
+        self.assertEqual(hookenv.data_generation(), generation + 1)
+
+    @patch.object(utils, 'resource_map')
+    def test_register_configs_write_only_on_change(self, resource_map):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        target = os.path.join(tmpdir, 'api_audit_map.conf')
+        resource_map.return_value = OrderedDict([
+            (target, {'contexts': [], 'services': ['heat-api']}),
+        ])
+        configs = utils.register_configs(release='yoga')
+        self.assertEqual([], configs.changed_files())
+
+        self.assertTrue(configs.write(target))
+        self.assertEqual([target], configs.changed_files())
+        self.assertEqual([], configs.changed_files())
+        os.chmod(target, 0o640)
+        inode = os.stat(target).st_ino
+
+        self.assertFalse(configs.write(target))
+        self.assertEqual([], configs.write_all())
+        self.assertEqual([], configs.changed_files())
+        self.assertEqual(inode, os.stat(target).st_ino)
+
+        with open(target, 'a') as f:
+            f.write('# local change\n')
+        self.assertEqual([target], configs.write_all())
+        self.assertEqual([target], configs.changed_files())
+        self.assertEqual(0o640, os.stat(target).st_mode & 0o7777)
+        self.assertEqual([], [f for f in os.listdir(tmpdir)
+                              if f.startswith('.')])
+
+    def test_lazy_configs_changed_files(self):
+        factory = MagicMock()
+        configs = utils.LazyConfigs(factory)
+        self.assertEqual([], configs.changed_files())
+        factory.assert_not_called()
+        factory.return_value.changed_files.return_value = ['/etc/heat/x']
+        configs.resolve()
+        self.assertEqual(['/etc/heat/x'], configs.changed_files())
+
+    @patch.object(utils, 'record_status')
+    @patch.object(utils, 'status_unchanged')
+    @patch.object(utils, 'os_application_version_set')
+    @patch.object(utils, 'assess_status_func')
+    def test_assess_status(self, assess_status_func,
+                           os_application_version_set, status_unchanged,
+                           record_status):
+        utils.assess_status('configs')
+        assess_status_func.return_value.assert_called_once_with()
+        os_application_version_set.assert_called_once_with('heat-common')
+        status_unchanged.assert_not_called()
+        record_status.assert_not_called()
+
+    @patch.object(utils, 'record_status')
+    @patch.object(utils, 'status_unchanged')
+    @patch.object(utils, 'os_application_version_set')
+    @patch.object(utils, 'assess_status_func')
+    def test_assess_status_use_cache(self, assess_status_func,
+                                     os_application_version_set,
+                                     status_unchanged, record_status):
+        status_unchanged.return_value = True
+        utils.assess_status('configs', use_cache=True)
+        assess_status_func.assert_not_called()
+        os_application_version_set.assert_not_called()
+        record_status.assert_not_called()
+
+        status_unchanged.return_value = False
+        utils.assess_status('configs', use_cache=True)
+        assess_status_func.return_value.assert_called_once_with()
+        record_status.assert_called_once_with()
+
+    @patch.object(utils, 'status_set')
+    @patch.object(utils, 'status_get')
+    def test_report_database_budget(self, status_get, status_set):
+        utils.report_database_budget()
+        status_get.assert_not_called()
+
+        self.database_pool.return_value = {
+            'budget': 500, 'units': 3, 'processes': 10,
+            'max_pool_size': 8, 'max_overflow': 8, 'connections': 480}
+        status_get.return_value = ('blocked', 'Missing relations: amqp')
+        utils.report_database_budget()
+        status_set.assert_not_called()
+
+        status_get.return_value = ('active', 'Unit is ready')
+        utils.report_database_budget()
+        status_set.assert_called_once_with(
+            'active', 'Unit is ready, database connections 480/500')
+
+    @patch.object(utils, 'upgrade_waiting')
+    @patch.object(utils, 'relation_ids')
+    def test_check_optional_relations_database_budget(self, relation_ids,
+                                                      upgrade_waiting):
+        relation_ids.return_value = []
+        upgrade_waiting.return_value = False
+        self.database_pool.return_value = {
+            'budget': 20, 'units': 3, 'processes': 10,
+            'max_pool_size': 1, 'max_overflow': 0, 'connections': 30}
+        self.assertEqual(
+            utils.check_optional_relations('configs'),
+            ('blocked', 'database-connection-budget 20 too small for 10 '
+                        'heat processes on 3 units'))
+        self.database_pool.assert_called_once_with(1)
+
+        self.database_pool.return_value['budget'] = 30
+        self.assertEqual(utils.check_optional_relations('configs'),
+                         ('unknown', ''))
+
+    @patch.object(utils, 'check_output')
+    def test_service_main_pids(self, check_output):
+        check_output.return_value = b'1234\n0\n'
+        self.assertEqual({'heat-api': 1234, 'haproxy': 0},
+                         utils.service_main_pids(['heat-api', 'haproxy']))
+        check_output.assert_called_once_with(
+            ['systemctl', 'show', '--property=MainPID', '--value',
+             'heat-api', 'haproxy'])
+        check_output.return_value = b'1234\n'
+        self.assertEqual({'heat-api': 0, 'haproxy': 0},
+                         utils.service_main_pids(['heat-api', 'haproxy']))
+
+    def test_restart_section_map(self):
+        self.assertEqual(utils.RESTART_SECTION_MAP,
+                         {'/etc/heat/heat.conf': utils.HEAT_CONF_SECTIONS})
+        self.assertEqual(dict(utils.HEAT_CONF_SECTIONS), {
+            'heat_api': ['heat-api', 'apache2'],
+            'heat_api_cfn': ['heat-api-cfn', 'apache2'],
+            'ec2_authtoken': ['heat-api-cfn', 'apache2'],
+            'paste_deploy': ['heat-api', 'heat-api-cfn', 'apache2'],
+            'clients': ['heat-engine'],
+            'clients_heat': ['heat-engine'],
+            'clients_keystone': ['heat-engine'],
+        })
+
+    def test_restart_functions(self):
+        self.assertEqual(utils.restart_functions(),
+                         {'apache2': utils.graceful_restart,
+                          'haproxy': utils.graceful_restart,
+                          'heat-api': utils.drained_restart,
+                          'heat-api-cfn': utils.drained_restart})
+
+    def test_service_binary_replaced(self):
+        self.os.readlink.return_value = '/usr/sbin/apache2'
+        self.assertFalse(utils.service_binary_replaced(10))
+        self.os.readlink.assert_called_once_with('/proc/10/exe')
+        self.os.readlink.return_value = '/usr/sbin/apache2 (deleted)'
+        self.assertTrue(utils.service_binary_replaced(10))
+        self.os.readlink.side_effect = OSError
+        self.assertFalse(utils.service_binary_replaced(10))
+
+    @patch.object(utils, 'service_restart')
+    @patch.object(utils, 'service_binary_replaced')
+    @patch.object(utils, 'service_main_pids')
+    def test_graceful_restart(self, service_main_pids,
+                              service_binary_replaced, service_restart):
+        service_main_pids.return_value = {'apache2': 10}
+        service_binary_replaced.return_value = False
+        utils.graceful_restart('apache2')
+        self.check_call.assert_called_once_with(['apache2ctl', 'graceful'])
+        service_restart.assert_not_called()
+
+        service_main_pids.return_value = {'haproxy': 11}
+        self.check_call.reset_mock()
+        utils.graceful_restart('haproxy')
+        self.check_call.assert_called_once_with(
+            ['systemctl', 'reload', 'haproxy'])
+        service_restart.assert_not_called()
+
+    @patch.object(utils, 'service_restart')
+    @patch.object(utils, 'service_binary_replaced')
+    @patch.object(utils, 'service_main_pids')
+    def test_graceful_restart_full(self, service_main_pids,
+                                   service_binary_replaced, service_restart):
+        # not running
+        service_main_pids.return_value = {'apache2': 0}
+        service_binary_replaced.return_value = False
+        utils.graceful_restart('apache2')
+        self.check_call.assert_not_called()
+        service_restart.assert_called_once_with('apache2')
+
+        # upgraded
+        service_restart.reset_mock()
+        service_main_pids.return_value = {'apache2': 10}
+        service_binary_replaced.return_value = True
+        utils.graceful_restart('apache2')
+        self.check_call.assert_not_called()
+        service_restart.assert_called_once_with('apache2')
+
+        # reload failed
+        service_restart.reset_mock()
+        service_binary_replaced.return_value = False
+        self.check_call.side_effect = utils.CalledProcessError(1, 'apache2')
+        utils.graceful_restart('apache2')
+        service_restart.assert_called_once_with('apache2')
+
+    @patch.object(utils, 'time')
+    @patch.object(utils, 'related_units')
+    @patch.object(utils, 'expected_peers')
+    @patch.object(utils, 'relation_ids')
+    def test_peers_at_expected_scale(self, relation_ids, expected_peers,
+                                     related_units, _time):
+        relation_ids.return_value = []
+        self.assertTrue(utils.peers_at_expected_scale())
+
+        relation_ids.return_value = ['cluster:1']
+        expected_peers.side_effect = NotImplementedError
+        self.assertTrue(utils.peers_at_expected_scale())
+
+        # scale out from 3 to 5 units
+        expected_peers.side_effect = None
+        expected_peers.return_value = {'heat/1', 'heat/2', 'heat/3',
+                                       'heat/4'}
+        related_units.return_value = ['heat/1', 'heat/2', 'heat/3']
+        _time.time.return_value = 1000
+        self.assertFalse(utils.peers_at_expected_scale())
+        self.assertTrue(utils.peer_scale_pending())
+        related_units.assert_called_with('cluster:1')
+        _time.time.return_value = 1000 + utils.PEER_SCALE_TIMEOUT - 1
+        self.assertFalse(utils.peers_at_expected_scale())
+        related_units.return_value = ['heat/1', 'heat/2', 'heat/3', 'heat/4']
+        self.assertTrue(utils.peers_at_expected_scale())
+        self.assertFalse(utils.peer_scale_pending())
+
+        # a peer never joins
+        expected_peers.return_value = {'heat/1', 'heat/2', 'heat/3',
+                                       'heat/4', 'heat/5'}
+        _time.time.return_value = 2000
+        self.assertFalse(utils.peers_at_expected_scale())
+        _time.time.return_value = 2000 + utils.PEER_SCALE_TIMEOUT
+        self.assertTrue(utils.peers_at_expected_scale())
+        self.assertFalse(utils.peer_scale_pending())
+
+    @patch.object(utils, 'goal_state')
+    @patch.object(utils, 'expected_peer_units')
+    def test_expected_peers(self, expected_peer_units, goal_state):
+        expected_peer_units.side_effect = NotImplementedError
+        self.assertRaises(NotImplementedError, utils.expected_peers)
+
+        # heat/2 is being removed
+        expected_peer_units.side_effect = None
+        expected_peer_units.return_value = iter(['heat/1', 'heat/2'])
+        goal_state.return_value = {'units': {
+            'heat/0': {'status': 'active'},
+            'heat/1': {'status': 'active'},
+            'heat/2': {'status': 'dying'}}}
+        self.assertEqual(utils.expected_peers(), {'heat/1'})
+
+    @patch.object(utils, 'local_unit')
+    @patch.object(utils.socket, 'socket')
+    def test_haproxy_server_states(self, _socket, local_unit):
+        local_unit.return_value = 'heat/0'
+        sock = _socket.return_value
+        sock.recv.side_effect = [
+            b'# pxname,svname,qcur,qmax,scur,smax,status\n'
+            b'heat_api_admin,heat-0,0,0,2,5,UP\n'
+            b'heat_api_admin,heat-1,0,0,1,5,UP\n'
+            b'heat_cfn_api_admin,heat-0,0,0,0,3,DOWN\n',
+            b'heat_cfn_api_admin,BACKEND,0,0,0,3,UP\n',
+            b'']
+        self.assertEqual(utils.haproxy_server_states(),
+                         {'heat_api_admin': ('UP', 2),
+                          'heat_cfn_api_admin': ('DOWN', 0)})
+        sock.connect.assert_called_once_with(utils.HAPROXY_ADMIN_SOCKET)
+        sock.sendall.assert_called_once_with(b'show stat\n')
+        sock.close.assert_called_once_with()
+
+    @patch.object(utils, 'established_connections')
+    @patch.object(utils, 'haproxy_server_states')
+    def test_drained(self, haproxy_server_states, established_connections):
+        established_connections.return_value = 0
+        haproxy_server_states.return_value = {
+            'heat_api_admin': ('DOWN', 0),
+            'heat_api_int': ('MAINT', 0),
+            'heat_cfn_api_admin': ('UP', 1)}
+        self.assertTrue(utils._drained(['heat_api'], [7994]))
+        self.assertFalse(utils._drained(['heat_api', 'heat_cfn_api'],
+                                        [7994, 7990]))
+        haproxy_server_states.return_value['heat_api_int'] = ('DOWN', 1)
+        self.assertFalse(utils._drained(['heat_api'], [7994]))
+
+        haproxy_server_states.side_effect = OSError
+        self.assertTrue(utils._drained(['heat_api'], [7994]))
+        established_connections.assert_called_with([7994])
+        established_connections.return_value = 2
+        self.assertFalse(utils._drained(['heat_api'], [7994]))
+
+    @patch('builtins.open')
+    @patch.object(utils, 'determine_api_port')
+    @patch.object(utils, '_drained')
+    @patch.object(utils, 'related_units')
+    @patch.object(utils, 'relation_ids')
+    @patch.object(utils, 'time')
+    def test_drain_unit(self, _time, relation_ids, related_units, _drained,
+                        determine_api_port, _open):
+        self.os_release.return_value = 'yoga'
+        relation_ids.return_value = ['cluster:1']
+        related_units.return_value = []
+        self.assertFalse(utils.drain_unit(['heat-api']))
+        related_units.return_value = ['heat/1']
+        self.assertFalse(utils.drain_unit(['heat-engine']))
+        # no healthcheck to disable before queens
+        self.os_release.return_value = 'pike'
+        self.assertFalse(utils.drain_unit(['heat-api']))
+        _open.assert_not_called()
+        self.os_release.return_value = 'queens'
+
+        determine_api_port.side_effect = lambda port, **kw: port - 10
+        _time.time.side_effect = [100, 100, 104, 108, 110]
+        _drained.side_effect = [False, True]
+        self.assertTrue(utils.drain_unit(['heat-engine', 'heat-api']))
+        _open.assert_called_once_with(
+            '/var/lib/heat/healthcheck-disable-heat-api', 'w')
+        _drained.assert_called_with(['heat_api'], [7994])
+        self.assertEqual(_drained.call_count, 2)
+
+        _time.time.side_effect = None
+        _time.time.return_value = 100
+        _drained.reset_mock()
+        _drained.side_effect = None
+        _drained.return_value = False
+        _time.sleep.side_effect = lambda s: setattr(
+            _time.time, 'return_value', _time.time.return_value + s)
+        self.assertTrue(utils.drain_unit(['heat-api-cfn']))
+        self.assertEqual(_drained.call_count,
+                         utils.DRAIN_TIMEOUT - utils.HAPROXY_CHECK_WINDOW + 1)
+        _drained.assert_called_with(['heat_cfn_api'], [7990])
+        _open.assert_called_with(
+            '/var/lib/heat/healthcheck-disable-heat-api-cfn', 'w')
+
+    @patch.object(utils, 'undrain_unit')
+    @patch.object(utils, 'drain_unit')
+    @patch.object(utils, 'service_restart')
+    def test_drained_restart(self, service_restart, drain_unit,
+                             undrain_unit):
+        utils.drained_restart('heat-api')
+        drain_unit.assert_called_once_with(['heat-api'])
+        service_restart.assert_called_once_with('heat-api')
+        undrain_unit.assert_called_once_with(['heat-api'])
+
+        service_restart.side_effect = Exception
+        self.assertRaises(Exception, utils.drained_restart, 'heat-api')
+        self.assertEqual(undrain_unit.call_count, 2)
+
+    def test_undrain_unit(self):
+        self.os.path.exists.return_value = False
+        utils.undrain_unit()
+        self.os.remove.assert_not_called()
+        self.os.path.exists.return_value = True
+        utils.undrain_unit(['heat-api-cfn'])
+        self.os.remove.assert_called_once_with(
+            '/var/lib/heat/healthcheck-disable-heat-api-cfn')
+        utils.undrain_unit()
+        self.os.remove.assert_has_calls([
+            call('/var/lib/heat/healthcheck-disable-heat-api'),
+            call('/var/lib/heat/healthcheck-disable-heat-api-cfn')])
+
+    @patch.object(utils, '_pause_resume_helper')
+    @patch.object(utils, 'undrain_unit')
+    @patch.object(utils, 'drain_unit')
+    @patch.object(utils, 'services')
+    def test_pause_resume_unit_helper(self, services, drain_unit,
+                                      undrain_unit, _pause_resume_helper):
+        services.return_value = ['heat-api', 'heat-engine']
+        utils.pause_unit_helper('configs')
+        drain_unit.assert_called_once_with(['heat-api', 'heat-engine'])
+        _pause_resume_helper.assert_called_once_with(utils.pause_unit,
+                                                     'configs')
+        undrain_unit.assert_not_called()
+        utils.resume_unit_helper('configs')
+        undrain_unit.assert_called_once_with()
+        _pause_resume_helper.assert_called_with(utils.resume_unit, 'configs')
+
+    @patch.object(utils, 'haproxy_stats')
+    def test_peers_healthy(self, haproxy_stats):
+        haproxy_stats.return_value = [
+            {'pxname': 'heat_api_admin', 'svname': 'heat-0', 'status': 'UP'},
+            {'pxname': 'heat_api_admin', 'svname': 'heat-1',
+             'status': 'UP 1/3'},
+            {'pxname': 'heat_api_admin', 'svname': 'heat-2',
+             'status': 'DOWN'},
+            {'pxname': 'heat_cfn_api_int', 'svname': 'heat-1',
+             'status': 'UP'},
+            {'pxname': 'stats', 'svname': 'heat-3', 'status': 'DOWN'}]
+        self.assertTrue(utils.peers_healthy(['heat/0', 'heat/1', 'heat/3']))
+        self.assertFalse(utils.peers_healthy(['heat/0', 'heat/2']))
+        haproxy_stats.side_effect = OSError
+        self.assertTrue(utils.peers_healthy(['heat/2']))
+
+    def peers(self, settings, leader_settings):
+        """Back the cluster relation and leader settings by dicts."""
+        for name in ('relation_ids', 'related_units', 'relation_get',
+                     'relation_set', 'local_unit'):
+            _p = patch.object(utils, name)
+            setattr(self, name, _p.start())
+            self.addCleanup(_p.stop)
+        self.relation_ids.return_value = ['cluster:1']
+        self.related_units.side_effect = lambda rid: sorted(
+            u for u in settings if u != self.local_unit.return_value)
+        self.relation_get.side_effect = (
+            lambda attribute, rid, unit: settings[unit].get(attribute))
+        self.relation_set.side_effect = (
+            lambda relation_id, relation_settings: settings[
+                self.local_unit.return_value].update(relation_settings))
+        self.leader_get.side_effect = leader_settings.get
+        self.leader_set.side_effect = leader_settings.update
+        self.is_leader.side_effect = (
+            lambda: self.local_unit.return_value == 'heat/0')
+
+    @patch.object(utils, 'peers_healthy')
+    @patch.object(utils, 'time')
+    def test_grant_restart_slots(self, _time, peers_healthy):
+        settings = {'heat/0': {}, 'heat/1': {}, 'heat/2': {}, 'heat/10': {}}
+        leader_settings = {}
+        self.peers(settings, leader_settings)
+        self.local_unit.return_value = 'heat/0'
+        _time.time.return_value = 1000
+        peers_healthy.return_value = False
+        self.assertEqual(utils.grant_restart_slots(), [])
+
+        self.test_config.set('restart-batch-size', 2)
+        for unit in ('heat/10', 'heat/2', 'heat/1'):
+            settings[unit][utils.RESTART_REQUEST_SETTING] = '990'
+        self.assertEqual(utils.grant_restart_slots(), ['heat/1', 'heat/2'])
+        self.assertEqual(leader_settings[utils.RESTART_SLOTS_KEY],
+                         'heat/1 heat/2')
+        self.assertEqual(utils.grant_restart_slots(), [])
+
+        # heat/1 restarted, its slot is free once it is healthy again
+        settings['heat/1'][utils.RESTART_REQUEST_SETTING] = None
+        self.assertEqual(utils.grant_restart_slots(), [])
+        peers_healthy.side_effect = lambda units: units == ['heat/1']
+        self.assertEqual(utils.grant_restart_slots(), ['heat/10'])
+        self.assertEqual(leader_settings[utils.RESTART_SLOTS_KEY],
+                         'heat/2 heat/10')
+
+        # or once it had long enough to become healthy
+        peers_healthy.side_effect = None
+        settings['heat/2'][utils.RESTART_REQUEST_SETTING] = None
+        settings['heat/1'][utils.RESTART_REQUEST_SETTING] = '1010'
+        self.assertEqual(utils.grant_restart_slots(), [])
+        _time.time.return_value = 1000 + utils.RESTART_HEALTH_TIMEOUT
+        self.assertEqual(utils.grant_restart_slots(), ['heat/1'])
+
+        # only the leader hands out slots
+        self.local_unit.return_value = 'heat/1'
+        self.assertEqual(utils.grant_restart_slots(), [])
+
+    @patch.object(utils, 'service_restart')
+    @patch.object(utils, 'restart_functions')
+    @patch.object(utils, '_restarted_since')
+    @patch.object(utils, 'is_unit_paused_set')
+    @patch.object(utils, 'peers_healthy')
+    def test_restart_slots(self, peers_healthy, is_unit_paused_set,
+                           _restarted_since, restart_functions,
+                           service_restart):
+        settings = {'heat/0': {}, 'heat/1': {}}
+        leader_settings = {}
+        self.peers(settings, leader_settings)
+        peers_healthy.return_value = True
+        is_unit_paused_set.return_value = False
+        _restarted_since.return_value = False
+        restart_functions.return_value = {}
+        self.test_config.set('restart-batch-size', 1)
+        self.local_unit.return_value = 'heat/1'
+
+        # the heat services wait for a slot, the frontends reload at once
+        self.assertTrue(utils.can_restart_now('haproxy', ['/a']))
+        self.assertFalse(utils.can_restart_now('heat-api', ['/a']))
+        self.assertEqual(utils.flush_pending_restarts(), [])
+        self.assertTrue(settings['heat/1'][utils.RESTART_REQUEST_SETTING])
+        service_restart.assert_not_called()
+
+        # the leader has given heat/1 its slot
+        self.local_unit.return_value = 'heat/0'
+        self.assertEqual(utils.grant_restart_slots(), ['heat/1'])
+        self.local_unit.return_value = 'heat/1'
+        self.assertEqual(utils.flush_pending_restarts(), ['heat-api'])
+        service_restart.assert_called_once_with('heat-api')
+        self.assertIsNone(settings['heat/1'][utils.RESTART_REQUEST_SETTING])
+
+        # the leader takes a free slot straight away
+        self.local_unit.return_value = 'heat/0'
+        self.assertFalse(utils.can_restart_now('heat-engine', ['/a']))
+        self.assertEqual(utils.flush_pending_restarts(), ['heat-engine'])
+        self.assertIsNone(leader_settings[utils.RESTART_SLOTS_KEY])
+
+        # without peers, nothing to wait for
+        settings.pop('heat/1')
+        self.assertTrue(utils.can_restart_now('heat-engine', ['/a']))
+
+    @patch.object(utils, 'time')
+    def test_coalesce_restart(self, _time):
+        _time.time.return_value = 1000
+        self.assertTrue(utils.coalesce_restart('heat-engine', ['/a']))
+        self.test_config.set('restart-coalesce-window', 60)
+        self.assertTrue(utils.coalesce_restart('haproxy', ['/a']))
+        self.assertFalse(utils.coalesce_restart('heat-engine', ['/a', '/a']))
+        _time.time.return_value = 1010
+        self.assertFalse(utils.coalesce_restart('heat-engine', ['/b']))
+        pending = utils.kv().get(utils.PENDING_RESTARTS_KEY)
+        self.assertEqual(list(pending), ['heat-engine'])
+        self.assertEqual(pending['heat-engine']['timestamp'], 1010)
+        self.assertEqual(pending['heat-engine']['reason'],
+                         'File(s) changed: /b')
+        self.assertEqual(pending['heat-engine']['action'], 'restart')
+
+    @patch.object(utils, 'drain_unit')
+    @patch.object(utils, 'is_unit_paused_set')
+    @patch.object(utils, '_restarted_since')
+    @patch.object(utils, 'service_restart')
+    @patch.object(utils, 'time')
+    def test_flush_pending_restarts(self, _time, service_restart,
+                                    _restarted_since, is_unit_paused_set,
+                                    drain_unit):
+        is_unit_paused_set.return_value = False
+        _restarted_since.return_value = False
+        self.test_config.set('restart-coalesce-window', 60)
+        self.assertEqual(utils.flush_pending_restarts(), [])
+
+        # a burst of hooks each changing the config
+        for now in (1000, 1010, 1020, 1030):
+            _time.time.return_value = now
+            for svc in ('heat-engine', 'heat-api'):
+                utils.coalesce_restart(svc, ['/etc/heat/heat.conf'])
+            self.assertEqual(utils.flush_pending_restarts(), [])
+        service_restart.assert_not_called()
+
+        _time.time.return_value = 1089
+        self.assertEqual(utils.flush_pending_restarts(), [])
+        is_unit_paused_set.return_value = True
+        _time.time.return_value = 1090
+        self.assertEqual(utils.flush_pending_restarts(), [])
+        is_unit_paused_set.return_value = False
+        self.assertEqual(utils.flush_pending_restarts(),
+                         ['heat-api', 'heat-engine'])
+        service_restart.assert_has_calls([call('heat-api'),
+                                          call('heat-engine')])
+        drain_unit.assert_called_once_with(['heat-api'])
+        self.assertIsNone(utils.kv().get(utils.PENDING_RESTARTS_KEY))
+        self.assertEqual(utils.flush_pending_restarts(), [])
+        self.assertEqual(service_restart.call_count, 2)
+
+    @patch.object(utils, '_restarted_since')
+    @patch.object(utils, 'service_restart')
+    @patch.object(utils, 'time')
+    def test_flush_pending_restarts_force(self, _time, service_restart,
+                                          _restarted_since):
+        _time.time.return_value = 1000
+        self.test_config.set('restart-coalesce-window', 60)
+        utils.coalesce_restart('heat-engine', ['/etc/heat/heat.conf'])
+        utils.coalesce_restart('heat-api', ['/etc/heat/heat.conf'])
+        _restarted_since.side_effect = lambda svc, ts: svc == 'heat-api'
+        # not while waiting for the database migration
+        utils.kv().set(utils.DB_REVISION_WAIT_KEY, '86')
+        utils.kv().flush()
+        self.assertEqual(utils.flush_pending_restarts(force=True), [])
+        utils.kv().unset(utils.DB_REVISION_WAIT_KEY)
+        utils.kv().flush()
+        self.assertEqual(utils.flush_pending_restarts(force=True),
+                         ['heat-engine'])
+        service_restart.assert_called_once_with('heat-engine')
+
+    @patch.object(utils, 'get_service_start_time')
+    def test_restarted_since(self, get_service_start_time):
+        get_service_start_time.return_value = datetime.datetime(2021, 1, 1)
+        ts = datetime.datetime(2021, 1, 1, 1).timestamp()
+        self.assertFalse(utils._restarted_since('heat-engine', ts))
+        ts = datetime.datetime(2020, 12, 31).timestamp()
+        self.assertTrue(utils._restarted_since('heat-engine', ts))
+        get_service_start_time.return_value = None
+        self.assertFalse(utils._restarted_since('heat-engine', ts))
+        get_service_start_time.side_effect = OSError
+        self.assertFalse(utils._restarted_since('heat-engine', ts))
+
+    @patch.object(utils, 'determine_api_port')
+    @patch.object(utils, 'ports_have_listeners')
+    @patch.object(utils, '_status_fingerprint')
+    @patch.object(utils, 'service_main_pids')
+    @patch.object(utils, 'get_managed_services_and_ports')
+    @patch.object(utils, 'services')
+    @patch.object(utils, 'time')
+    def test_record_status_unchanged(self, _time, _services,
+                                     get_managed_services_and_ports,
+                                     service_main_pids, _status_fingerprint,
+                                     ports_have_listeners,
+                                     determine_api_port):
+        determine_api_port.side_effect = lambda port, **kw: port - 10
+        ports_have_listeners.side_effect = lambda ports: [True] * len(ports)
+        _time.time.return_value = 1000
+        _services.return_value = ['heat-api', 'heat-engine']
+        get_managed_services_and_ports.side_effect = lambda s, p: (s, p)
+        _status_fingerprint.return_value = 'abc'
+        service_main_pids.return_value = {'heat-api': 10, 'heat-engine': 0}
+        utils.record_status()
+        self.assertFalse(utils.status_unchanged())
+
+        service_main_pids.return_value = {'heat-api': 10, 'heat-engine': 11}
+        utils.record_status()
+        self.os.path.exists.return_value = True
+        self.assertTrue(utils.status_unchanged())
+        self.os.path.exists.assert_has_calls([call('/proc/10'),
+                                              call('/proc/11')])
+
+        self.os.path.exists.return_value = False
+        self.assertFalse(utils.status_unchanged())
+        self.os.path.exists.return_value = True
+
+        _status_fingerprint.return_value = 'def'
+        self.assertFalse(utils.status_unchanged())
+        _status_fingerprint.return_value = 'abc'
+
+        ports_have_listeners.side_effect = lambda ports: [
+            p != 7994 for p in ports]
+        self.assertFalse(utils.status_unchanged())
+        ports_have_listeners.assert_called_with([7990, 7994, 8000, 8004])
+        utils.record_status()
+        self.assertIsNone(utils.kv().get(utils.STATUS_CACHE_KEY))
+        ports_have_listeners.side_effect = lambda ports: [True] * len(ports)
+        utils.record_status()
+        self.assertTrue(utils.status_unchanged())
+
+        _time.time.return_value = 1000 + utils.STATUS_CACHE_MAX_AGE + 1
+        self.assertFalse(utils.status_unchanged())
+
+    @patch.object(utils, 'dpkg_status_stamp')
+    def test_hardening_required(self, dpkg_status_stamp):
+        dpkg_status_stamp.return_value = [1, 2]
+        self.assertFalse(utils.hardening_required())
+        self.test_config.set('harden', 'os')
+        self.assertTrue(utils.hardening_required())
+        utils.record_hardening()
+        self.assertFalse(utils.hardening_required())
+        dpkg_status_stamp.return_value = [1, 3]
+        self.assertTrue(utils.hardening_required())
+        utils.record_hardening()
+        self.test_config.set('harden', 'os ssh')
+        self.assertTrue(utils.hardening_required())
+
+
+def _backend_stats(requests, errors):
+    return [
+        {'pxname': 'heat_api', 'svname': 'heat-0', 'status': 'UP'},
+        {'pxname': 'heat_api', 'svname': 'heat-1', 'status': 'UP'},
+        {'pxname': 'heat_api', 'svname': 'BACKEND', 'status': 'UP',
+         'req_tot': str(requests), 'hrsp_5xx': str(errors)},
+        {'pxname': 'heat_cfn_api', 'svname': 'BACKEND', 'status': 'UP',
+         'req_tot': '0', 'hrsp_5xx': '0'},
+    ]
+
+
+class CanaryUpgradeTests(CharmTestCase):
+
+    def setUp(self):
+        super(CanaryUpgradeTests, self).setUp(
+            utils, ['config', 'log', 'is_leader', 'leader_get', 'leader_set',
+                    'local_unit', 'haproxy_stats', 'relation_ids',
+                    'related_units', 'graceful_restart', 'unit_releases',
+                    'get_os_codename_install_source'])
+        self.config.side_effect = self.test_config.get
+        self.test_config.set('canary-upgrade', True)
+        self.test_config.set('openstack-origin', 'cloud:focal-yoga')
+        self.settings = {}
+        self.leader_get.side_effect = self.settings.get
+        self.leader_set.side_effect = self.settings.update
+        self.local_unit.return_value = 'heat/0'
+        self.is_leader.return_value = True
+        self.haproxy_stats.return_value = _backend_stats(100, 1)
+        self.get_os_codename_install_source.return_value = 'yoga'
+        self.relation_ids.return_value = ['cluster:1']
+        self.related_units.return_value = ['heat/1']
+
+    def test_upgrade_slot_granted_leader(self):
+        self.assertTrue(utils.upgrade_slot_granted())
+        self.assertEqual(self.settings[utils.UPGRADE_ORIGIN_KEY],
+                         'cloud:focal-yoga')
+        self.assertEqual(self.settings[utils.UPGRADE_UNITS_KEY], 'heat/0')
+        self.assertEqual(utils.kv().get(utils.UPGRADE_ERRORS_KEY), [100, 1])
+        self.assertFalse(utils.upgrade_waiting())
+
+    def test_upgrade_slot_granted_non_leader(self):
+        self.is_leader.return_value = False
+        self.local_unit.return_value = 'heat/1'
+        self.assertFalse(utils.upgrade_slot_granted())
+        self.assertTrue(utils.upgrade_waiting())
+        self.settings.update({utils.UPGRADE_ORIGIN_KEY: 'cloud:focal-yoga',
+                              utils.UPGRADE_UNITS_KEY: 'heat/0 heat/1'})
+        self.assertTrue(utils.upgrade_slot_granted())
+        self.assertFalse(utils.upgrade_waiting())
+
+    def test_upgrade_slot_granted_disabled(self):
+        self.test_config.set('canary-upgrade', False)
+        self.assertTrue(utils.upgrade_slot_granted())
+        self.leader_set.assert_not_called()
+
+    def test_upgrade_error_rate(self):
+        self.assertEqual(utils.upgrade_error_rate(), 0.0)
+        utils.kv().set(utils.UPGRADE_ERRORS_KEY, [60, 1])
+        self.assertEqual(utils.upgrade_error_rate(), 0.0)
+        self.haproxy_stats.return_value = _backend_stats(160, 11)
+        self.assertEqual(utils.upgrade_error_rate(), 0.1)
+        # haproxy restarted
+        self.haproxy_stats.return_value = _backend_stats(10, 0)
+        self.assertEqual(utils.upgrade_error_rate(), 0.0)
+
+    @patch.object(utils, 'peers_healthy')
+    @patch.object(utils, 'canary_healthy')
+    def test_advance_upgrade(self, canary_healthy, peers_healthy):
+        peers_healthy.return_value = True
+        canary_healthy.return_value = (True, '')
+        self.test_config.set('upgrade-batch-size', 2)
+        self.settings.update({utils.UPGRADE_ORIGIN_KEY: 'cloud:focal-yoga',
+                              utils.UPGRADE_UNITS_KEY: 'heat/0'})
+        # heat/3 hasn't published its release yet
+        self.related_units.return_value = ['heat/1', 'heat/10', 'heat/2',
+                                           'heat/3']
+        releases = {'heat/0': 'xena', 'heat/1': 'xena', 'heat/10': 'xena',
+                    'heat/2': 'xena'}
+        self.unit_releases.return_value = releases
+        # the canary hasn't upgraded yet
+        self.assertEqual(utils.advance_upgrade(), [])
+        releases['heat/0'] = 'yoga'
+        self.assertEqual(utils.advance_upgrade(), ['heat/1', 'heat/2'])
+        canary_healthy.assert_called_once_with()
+        self.assertEqual(self.settings[utils.UPGRADE_UNITS_KEY],
+                         'heat/0 heat/1 heat/2')
+        releases.update({'heat/1': 'yoga', 'heat/2': 'yoga'})
+        self.assertEqual(utils.advance_upgrade(), ['heat/3', 'heat/10'])
+        releases['heat/10'] = 'yoga'
+        self.assertEqual(utils.advance_upgrade(), [])
+        self.assertEqual(self.settings[utils.UPGRADE_ORIGIN_KEY],
+                         'cloud:focal-yoga')
+        releases['heat/3'] = 'yoga'
+        self.assertEqual(utils.advance_upgrade(), [])
+        self.assertIsNone(self.settings[utils.UPGRADE_ORIGIN_KEY])
+        self.assertEqual(canary_healthy.call_count, 1)
+
+    @patch.object(utils, 'canary_healthy')
+    def test_advance_upgrade_canary_unhealthy(self, canary_healthy):
+        canary_healthy.return_value = (False, 'heat-engine is not running')
+        self.settings.update({utils.UPGRADE_ORIGIN_KEY: 'cloud:focal-yoga',
+                              utils.UPGRADE_UNITS_KEY: 'heat/0'})
+        self.unit_releases.return_value = {'heat/0': 'yoga', 'heat/1': 'xena'}
+        self.assertEqual(utils.advance_upgrade(), [])
+        self.assertEqual(self.settings[utils.UPGRADE_PAUSED_KEY],
+                         'canary heat/0: heat-engine is not running')
+        self.assertEqual(self.settings[utils.UPGRADE_UNITS_KEY], 'heat/0')
+
+    def test_advance_upgrade_error_rate(self):
+        self.settings.update({utils.UPGRADE_ORIGIN_KEY: 'cloud:focal-yoga',
+                              utils.UPGRADE_UNITS_KEY: 'heat/0 heat/1'})
+        self.unit_releases.return_value = {'heat/0': 'yoga', 'heat/1': 'xena'}
+        utils.kv().set(utils.UPGRADE_ERRORS_KEY, [0, 0])
+        self.assertEqual(utils.advance_upgrade(), [])
+        self.assertNotIn(utils.UPGRADE_PAUSED_KEY, self.settings)
+        self.haproxy_stats.return_value = _backend_stats(100, 10)
+        self.assertEqual(utils.advance_upgrade(), [])
+        self.assertEqual(self.settings[utils.UPGRADE_PAUSED_KEY],
+                         'heat API error rate 10.0% above 5.0%')
+
+    def test_apply_upgrade_weights(self):
+        configs = MagicMock()
+        configs.write.return_value = True
+        self.settings.update({utils.UPGRADE_ORIGIN_KEY: 'cloud:focal-yoga',
+                              utils.UPGRADE_UNITS_KEY: 'heat/1'})
+        self.unit_releases.return_value = {'heat/0': 'xena', 'heat/1': 'xena'}
+        # the canary hasn't upgraded yet
+        self.assertFalse(utils.apply_upgrade_weights(configs))
+        configs.write.assert_not_called()
+
+        self.unit_releases.return_value = {'heat/0': 'xena', 'heat/1': 'yoga'}
+        self.assertTrue(utils.apply_upgrade_weights(configs))
+        self.assertEqual(utils.kv().get(utils.UPGRADE_WEIGHTS_KEY), 'heat-1')
+        configs.reset_context_cache.assert_called_once_with()
+        configs.write.assert_called_once_with(utils.HAPROXY_CONF)
+        self.graceful_restart.assert_called_once_with('haproxy')
+
+        # haproxy is only reloaded when the canary changes
+        self.assertFalse(utils.apply_upgrade_weights(configs))
+        self.assertEqual(configs.write.call_count, 1)
+
+        self.settings[utils.UPGRADE_UNITS_KEY] = 'heat/1 heat/0'
+        self.assertTrue(utils.apply_upgrade_weights(configs, reload=False))
+        self.assertIsNone(utils.kv().get(utils.UPGRADE_WEIGHTS_KEY))
+        self.assertEqual(configs.write.call_count, 2)
+        self.assertEqual(self.graceful_restart.call_count, 1)
+
+        # nothing to reload if haproxy.cfg came out unchanged
+        configs.write.return_value = False
+        self.settings[utils.UPGRADE_UNITS_KEY] = 'heat/1'
+        self.assertFalse(utils.apply_upgrade_weights(configs))
+        self.assertEqual(self.graceful_restart.call_count, 1)
+
+    @patch.object(heat_context, 'config')
+    @patch.object(heat_context, 'https')
+    @patch.object(heat_context, 'determine_apache_port')
+    @patch.object(heat_context, 'determine_api_port')
+    def test_apply_upgrade_weights_after_config_changed(
+            self, determine_api_port, determine_apache_port, https,
+            context_config):
+        determine_api_port.side_effect = lambda port, **kwargs: port - 10
+        determine_apache_port.side_effect = lambda port, **kwargs: port - 20
+        https.return_value = False
+        context_config.side_effect = self.test_config.get
+        self.test_config.set('canary-weight', 25)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with open(os.path.join(tmpdir, 'haproxy.cfg'), 'w') as f:
+            f.write('{% for unit, weight in (server_weights or {}).items() %}'
+                    '{{ unit }} {{ weight }}{% endfor %}')
+        target = os.path.join(tmpdir, 'etc', 'haproxy.cfg')
+        os.mkdir(os.path.dirname(target))
+        configs = utils.templating.OSConfigRenderer(
+            templates_dir=tmpdir, openstack_release='yoga')
+        configs.register(target, [heat_context.HeatHAProxyContext()])
+        self.settings.update({utils.UPGRADE_ORIGIN_KEY: 'cloud:focal-yoga',
+                              utils.UPGRADE_UNITS_KEY: 'heat/1'})
+        self.unit_releases.return_value = {'heat/0': 'xena', 'heat/1': 'yoga'}
+        with patch.object(utils, 'HAPROXY_CONF', target):
+            # config_changed renders haproxy.cfg earlier in the same hook
+            configs.write_all()
+            self.assertTrue(utils.apply_upgrade_weights(configs))
+        with open(target) as f:
+            self.assertEqual(f.read(), 'heat-1 25')
+        self.graceful_restart.assert_called_once_with('haproxy')
+
+    @patch.object(utils.urllib.request, 'urlopen')
+    @patch.object(utils, 'determine_api_port')
+    @patch.object(utils, 'services_running')
+    def test_canary_healthy(self, services_running, determine_api_port,
+                            urlopen):
+        determine_api_port.return_value = 8004
+        self.test_config.set('canary-max-latency', 1000)
+        services_running.return_value = [True]
+        urlopen.side_effect = utils.urllib.error.HTTPError(
+            'http://127.0.0.1:8004/', 300, 'Multiple Choices', {}, None)
+        self.assertEqual(utils.canary_healthy(), (True, ''))
+        urlopen.side_effect = utils.urllib.error.HTTPError(
+            'http://127.0.0.1:8004/', 503, 'Unavailable', {}, None)
+        self.assertEqual(utils.canary_healthy(),
+                         (False, 'heat-api answered 503'))
+        services_running.return_value = [False]
+        self.assertEqual(utils.canary_healthy(),
+                         (False, 'heat-engine is not running'))
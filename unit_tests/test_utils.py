@@ -20,6 +20,8 @@ import yaml
 from contextlib import contextmanager
 from unittest.mock import patch, MagicMock
 
+from charmhelpers.core import unitdata
+
 
 def load_config():
     """Loads config.
@@ -65,6 +67,10 @@ class CharmTestCase(unittest.TestCase):
         self.obj = obj
         self.test_config = TestConfig()
         self.test_relation = TestRelation()
+        # Each test gets an empty unit kv store, kept in memory.
+        _kv = patch.object(unitdata, '_KV', unitdata.Storage(':memory:'))
+        _kv.start()
+        self.addCleanup(_kv.stop)
         self.patch_all()
 
     def patch(self, method):